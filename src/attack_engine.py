@@ -0,0 +1,291 @@
+import os
+import argparse
+from collections import defaultdict
+import torch
+from tqdm import tqdm
+from src.metrics import span
+from src.eval_rag import extract_final_answer, gold_keys, match_key, normalize
+from src.sweep_retrieval import poison_variants
+from src.utils import ImagePrefetcher, JSONLWriter, read_jsonl
+
+
+class AttackEngine:
+    """
+    Incremental evaluation of every poisoned candidate of every question.
+
+    Each question's clean pool is retrieved and answered once. A candidate
+    caption then only adds its own embedding: its score is merged into the
+    clean caption scores to get that variant's top-k, exactly as if it had
+    been appended to the pool as run_rag.py does. Candidates that stay out
+    of the top-k leave the prompt unchanged and reuse the clean answer;
+    only the ones that enter it are generated.
+    """
+
+    def __init__(self, rag, max_new_tokens: int = 128, batch_size: int = 8):
+        self.rag = rag
+        self.max_new_tokens = max_new_tokens
+        self.batch_size = batch_size
+
+    def prepare(self, ex, images, image_ids, texts, variants, poisoned_image, text_ids=None):
+        """
+        Retrieval for one question and all of its variants. Returns the
+        question's rows without answers and the prompts they need.
+        `text_ids` are the doc ids of the clean captions' images.
+        """
+        rag = self.rag
+
+        with rag._question() as record:
+            candidates = sorted({t for t in variants.values() if t is not None})
+
+            with span(rag.metrics, "text_encode"):
+                embs = rag.retriever.encode_text([ex["question"]] + candidates)
+                text_embs = rag.encode_texts(texts, text_ids)
+            query_emb = embs[:1]
+            candidate_embs = embs[1:]
+
+            with span(rag.metrics, "image_encode"):
+                image_embs = rag.encode_images(images, image_ids)
+
+            with span(rag.metrics, "scoring"):
+                image_scores = rag.retriever.score_images(query_emb, image_embs)[0]
+                top_image_idx = image_scores.topk(
+                    min(rag.top_k_images, len(image_ids))
+                ).indices.tolist()
+
+                text_scores = rag.retriever.score_texts(query_emb, text_embs)[0]
+                candidate_scores = rag.retriever.score_texts(query_emb, candidate_embs)[0]
+                candidate_score = dict(zip(candidates, candidate_scores))
+
+                # The poison sits at index len(texts) of a poisoned pool
+                poison_idx = len(texts)
+                pools = {}
+                for name, poison in variants.items():
+                    if poison is None:
+                        scores = text_scores
+                    else:
+                        scores = torch.cat([text_scores, candidate_score[poison].view(1)])
+                    top = scores.topk(min(rag.top_k_texts, len(scores))).indices.tolist()
+                    pools[name] = (top, scores[top].tolist())
+
+            top_images = [images[i] for i in top_image_idx]
+            top_image_ids = [image_ids[i] for i in top_image_idx]
+
+            rows = []
+            for name, poison in variants.items():
+                top, scores = pools[name]
+                pool = texts + [poison] if poison is not None else texts
+                retrieved = [pool[i] for i in top]
+                poison_retrieved = poison is not None and poison_idx in top
+
+                # Without the poison in the top-k the prompt is the clean one
+                if name == "clean" or poison_retrieved:
+                    prompt = rag.build_prompt(
+                        question=ex["question"],
+                        retrieved_texts=retrieved,
+                        num_images=len(top_image_ids)
+                    )
+                    if name == "clean":
+                        clean_prompt = prompt
+                else:
+                    prompt = clean_prompt
+
+                rows.append({
+                    "qid": ex.get("qid"),
+                    "question": ex["question"],
+                    "variant": name,
+                    "gold_answers": ex.get("answers", []),
+                    "retrieved_image_ids": top_image_ids,
+                    "retrieved_captions": retrieved,
+                    "image_scores": image_scores[top_image_idx].tolist(),
+                    "text_scores": scores,
+                    "poison_injected": poison is not None,
+                    "poisoned_image": poisoned_image if poison is not None else None,
+                    "poison_caption": poison,
+                    "poison_retrieved": poison_retrieved,
+                    # Rows this question has in total, to spot cut-off questions on resume
+                    "num_variants": len(variants),
+                    # Answered by its own generation instead of reusing the clean answer
+                    "regenerated": poison_retrieved,
+                    "_prompt": prompt,
+                })
+
+        # One generation per distinct prompt
+        items = {}
+        for row in rows:
+            if row["_prompt"] not in items:
+                items[row["_prompt"]] = {
+                    "prompt": row["_prompt"],
+                    "images": top_images,
+                    "image_ids": top_image_ids,
+                    "record": record,
+                    "rows": [],
+                }
+            items[row["_prompt"]]["rows"].append(row)
+
+        return rows, list(items.values())
+
+    def run_window(self, questions):
+        """
+        Generate the prompts of several prepared questions together and
+        return their rows with answers filled in.
+        """
+        items = [item for _, question_items in questions for item in question_items]
+        answers = self.rag.generate_prompts(items, self.max_new_tokens, self.batch_size)
+
+        for item, answer in zip(items, answers):
+            for row in item["rows"]:
+                row["model_answer"] = answer
+
+        finished = []
+        for rows, _ in questions:
+            clean_answer = next(r["model_answer"] for r in rows if r["variant"] == "clean")
+            for row in rows:
+                del row["_prompt"]
+                row["clean_answer"] = clean_answer
+                finished.append(row)
+        return finished
+
+
+def complete_qids(path):
+    """
+    qids whose rows are all in an attack results file (empty if it doesn't
+    exist). Rows of a question that a crash cut off part way are dropped
+    from the file, so the question is redone in full on resume.
+    """
+    if not os.path.exists(path):
+        return set()
+
+    rows = list(read_jsonl(path))
+    variants = defaultdict(set)
+    for row in rows:
+        variants[row["qid"]].add(row["variant"])
+
+    done = {
+        row["qid"] for row in rows
+        if len(variants[row["qid"]]) == row["num_variants"]
+    }
+    if len(done) < len(variants):
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        with JSONLWriter(tmp_path, fsync_every=len(rows) + 1) as writer:
+            for row in rows:
+                if row["qid"] in done:
+                    writer.write(row)
+        os.replace(tmp_path, path)
+
+    return done
+
+
+def summarize(rows_by_variant, skipped):
+    print(f"{'variant':<14} {'n':>6} {'poison@k':>9} {'regenerated':>11} {'EM':>7} {'flipped':>8}")
+    for variant, stats in sorted(rows_by_variant.items()):
+        n = stats["n"]
+        print(
+            f"{variant:<14} {n:>6} {stats['poison_retrieved'] / n:>9.3f} "
+            f"{stats['regenerated'] / n:>11.3f} {stats['correct'] / n:>7.3f} "
+            f"{stats['flipped'] / n:>8.3f}"
+        )
+
+    if skipped["no_images"]:
+        print(f"Skipped {skipped['no_images']} questions without loadable images")
+    if skipped["poison_only"]:
+        # run_rag.py's poisoned run answers these from the poison alone, but
+        # there is no clean pool to compare against
+        print(
+            f"Skipped {skipped['poison_only']} questions with no clean captions "
+            f"(their poisoned pool would hold only the poison)"
+        )
+
+
+def main():
+    from src import run_rag
+    from src.datasets import DATASETS
+
+    parser = argparse.ArgumentParser(
+        description="Evaluate every poisoned candidate per question, reusing clean-run work."
+    )
+    parser.add_argument("--dataset", default=run_rag.DATASET, choices=list(DATASETS))
+    parser.add_argument("--output", default=None,
+                        help="default: results/attack_candidates_<dataset>.jsonl")
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--window", type=int, default=run_rag.GENERATION_WINDOW,
+                        help="questions whose prompts are generated together")
+    args = parser.parse_args()
+
+    args.output = args.output or f"results/attack_candidates_{args.dataset}.jsonl"
+
+    run_rag.use_dataset(args.dataset)
+    run_rag.USE_POISONED_CAPTIONS = True
+    data, image_metadata, poisoned_metadata = run_rag.load_dataset()
+    data = data[:args.limit]
+
+    done_qids = complete_qids(args.output)
+    if done_qids:
+        data = [ex for ex in data if ex.get("qid") not in done_qids]
+        print(f"Resuming: {len(done_qids)} questions already in {args.output}")
+
+    rag = run_rag.build_rag()
+    engine = AttackEngine(
+        rag,
+        max_new_tokens=run_rag.MAX_NEW_TOKENS,
+        batch_size=run_rag.GENERATION_BATCH_SIZE
+    )
+
+    prefetcher = ImagePrefetcher(
+        run_rag.IMAGE_DIR,
+        image_metadata,
+        num_workers=run_rag.PREFETCH_WORKERS,
+        prefetch=run_rag.PREFETCH_QUESTIONS
+    )
+    image_sets = prefetcher.iterate(ex["metadata"]["image_doc_ids"] for ex in data)
+
+    stats = defaultdict(lambda: defaultdict(int))
+    skipped = defaultdict(int)
+
+    def write(rows):
+        for row in rows:
+            writer.write(row)
+
+            s = stats[row["variant"]]
+            s["n"] += 1
+            s["poison_retrieved"] += row["poison_retrieved"]
+            s["regenerated"] += row["regenerated"]
+            answer = normalize(extract_final_answer(row["model_answer"]))
+            golds = [g["answer"] for g in row["gold_answers"] if isinstance(g, dict)]
+            s["correct"] += bool(golds) and match_key(answer) in gold_keys(golds)
+            s["flipped"] += answer != normalize(extract_final_answer(row["clean_answer"]))
+
+    window = []
+    with JSONLWriter(args.output, fsync_every=run_rag.FSYNC_EVERY) as writer:
+        for ex, (images, image_ids) in tqdm(zip(data, image_sets), total=len(data)):
+            variants, poisoned_image = poison_variants(image_ids, poisoned_metadata)
+
+            item = run_rag.build_pool_example(ex, images, image_ids, image_metadata, None)
+            if item is None:
+                if not image_ids:
+                    skipped["no_images"] += 1
+                elif poisoned_image is not None:
+                    skipped["poison_only"] += 1
+                continue
+            window.append(engine.prepare(
+                ex, images, image_ids, item["texts"], variants, poisoned_image,
+                text_ids=item["text_ids"]
+            ))
+
+            if len(window) >= args.window:
+                write(engine.run_window(window))
+                window = []
+
+        if window:
+            write(engine.run_window(window))
+
+    run_rag.close_rag(rag)
+
+    print(f"Wrote per-candidate outcomes to {args.output}")
+    summarize(stats, skipped)
+
+
+if __name__ == "__main__":
+    main()
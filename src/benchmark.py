@@ -0,0 +1,495 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import numpy as np
+import torch
+from PIL import Image
+from transformers import (
+    CLIPConfig,
+    CLIPModel,
+    CLIPProcessor,
+    CLIPTokenizerFast,
+    CLIPImageProcessor,
+    CLIPVisionConfig,
+    LlamaConfig,
+    LlavaConfig,
+    LlavaForConditionalGeneration,
+    LlavaProcessor,
+    PreTrainedTokenizerFast,
+)
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+from src.retriever import Retriever
+from src.generator import Generator
+from src.rag_model import RAGModel
+from src.eval_rag import score_results
+from src.utils import load_images_from_metadata, ImagePrefetcher
+
+
+# Tiny randomly initialized models: every benchmark runs offline on CPU
+IMAGE_SIZE = 32
+PATCH_SIZE = 8
+HIDDEN_SIZE = 64
+NUM_LAYERS = 2
+
+WORDS = (
+    "the a red blue small large dog cat horse car building river city "
+    "statue painting bridge tower flag team player stadium mountain"
+).split()
+
+BENCHMARKS = ("encode", "scoring", "image_load", "end_to_end", "eval")
+
+
+def random_sentence(rng, min_words=3, max_words=20):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+
+def random_image(rng, width=64, height=48):
+    pixels = np.random.default_rng(rng.randint(0, 2**31)).integers(
+        0, 256, (height, width, 3), dtype=np.uint8
+    )
+    return Image.fromarray(pixels)
+
+
+def write_clip_tokenizer(directory):
+    """
+    Write a byte-level CLIP vocabulary with no merges, so the real CLIP
+    tokenizer can be used without downloading one.
+    """
+    chars = list(bytes_to_unicode().values())
+    vocab = {}
+    for suffix in ("", "</w>"):
+        for c in chars:
+            vocab[c + suffix] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+
+    with open(os.path.join(directory, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+    with open(os.path.join(directory, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+
+    return directory
+
+
+def llama_tokenizer():
+    """
+    Byte-level tokenizer that prepends BOS, like LLaVA's Llama tokenizer.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders, processors
+
+    vocab = {
+        c: i for i, c in enumerate(["<s>", "</s>", "<pad>"] + list(bytes_to_unicode().values()))
+    }
+    backend = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    backend.decoder = decoders.ByteLevel()
+    backend.post_processor = processors.TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", 0)]
+    )
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=backend, bos_token="<s>", eos_token="</s>", pad_token="<pad>"
+    )
+    tokenizer.model_input_names = ["input_ids", "attention_mask"]
+    tokenizer.add_special_tokens({"additional_special_tokens": ["<image>"]})
+    return tokenizer
+
+
+def image_processor():
+    return CLIPImageProcessor(
+        size={"shortest_edge": IMAGE_SIZE},
+        crop_size={"height": IMAGE_SIZE, "width": IMAGE_SIZE}
+    )
+
+
+def vision_config():
+    return CLIPVisionConfig(
+        hidden_size=HIDDEN_SIZE,
+        intermediate_size=HIDDEN_SIZE * 2,
+        num_hidden_layers=NUM_LAYERS,
+        num_attention_heads=2,
+        image_size=IMAGE_SIZE,
+        patch_size=PATCH_SIZE
+    )
+
+
+class TinyRetriever(Retriever):
+    """
+    Retriever over a tiny random CLIP.
+    """
+
+    def __init__(self, tokenizer_dir, **kwargs):
+        self.tokenizer_dir = tokenizer_dir
+        super().__init__("tiny/clip", device="cpu", **kwargs)
+
+    def _load_model(self):
+        tokenizer = CLIPTokenizerFast.from_pretrained(self.tokenizer_dir, model_max_length=77)
+        self.processor = CLIPProcessor(image_processor=image_processor(), tokenizer=tokenizer)
+
+        config = CLIPConfig(
+            text_config=dict(
+                hidden_size=HIDDEN_SIZE,
+                intermediate_size=HIDDEN_SIZE * 2,
+                num_hidden_layers=NUM_LAYERS,
+                num_attention_heads=2,
+                vocab_size=len(tokenizer),
+                max_position_embeddings=77,
+                bos_token_id=tokenizer.bos_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.pad_token_id
+            ),
+            vision_config=vision_config().to_dict(),
+            projection_dim=32
+        )
+        torch.manual_seed(0)
+        self.model = CLIPModel(config).eval()
+
+
+class TinyGenerator(Generator):
+    """
+    Generator over a tiny random LLaVA. EOS is disabled so every call
+    generates exactly max_new_tokens tokens.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__("tiny/llava", device="cpu", dtype=torch.float32, **kwargs)
+
+    def _load_model(self):
+        tokenizer = llama_tokenizer()
+        self.processor = LlavaProcessor(
+            image_processor=image_processor(),
+            tokenizer=tokenizer,
+            patch_size=PATCH_SIZE,
+            vision_feature_select_strategy="default",
+            num_additional_image_tokens=1
+        )
+
+        config = LlavaConfig(
+            vision_config=vision_config(),
+            text_config=LlamaConfig(
+                hidden_size=HIDDEN_SIZE,
+                intermediate_size=HIDDEN_SIZE * 2,
+                num_hidden_layers=NUM_LAYERS,
+                num_attention_heads=2,
+                num_key_value_heads=2,
+                vocab_size=len(tokenizer),
+                bos_token_id=tokenizer.bos_token_id,
+                pad_token_id=tokenizer.pad_token_id
+            ),
+            image_token_index=tokenizer.convert_tokens_to_ids("<image>")
+        )
+        torch.manual_seed(0)
+        self.model = LlavaForConditionalGeneration(config).eval()
+        self.model.generation_config.pad_token_id = tokenizer.pad_token_id
+        self.model.generation_config.eos_token_id = None
+
+
+def measure(fn, repeats):
+    """
+    Median wall time of `fn()` over `repeats` runs, after one warmup run.
+    """
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+
+def metric(value, unit, higher_is_better):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def bench_encode(retriever, rng, repeats, batch_sizes=(1, 8, 32, 128),
+                 num_texts=256, num_images=128):
+    """
+    Text and image encoding throughput for each micro-batch size.
+    """
+    texts = [random_sentence(rng) for _ in range(num_texts)]
+    images = [random_image(rng) for _ in range(num_images)]
+
+    results = {}
+    for batch_size in batch_sizes:
+        retriever.batch_size = batch_size
+        seconds = measure(lambda: retriever.encode_text(texts), repeats)
+        results[f"encode_text/batch={batch_size}"] = metric(
+            num_texts / seconds, "texts/s", True
+        )
+        seconds = measure(lambda: retriever.encode_images(images), repeats)
+        results[f"encode_images/batch={batch_size}"] = metric(
+            num_images / seconds, "images/s", True
+        )
+
+    return results
+
+
+def bench_scoring(retriever, rng, repeats, pool_sizes=(16, 256, 4096, 65536), k=3,
+                  queries=64):
+    """
+    score_texts + top-k latency per query against pools of each size.
+    """
+    generator = torch.Generator().manual_seed(rng.randint(0, 2**31))
+    dim = retriever.model.config.projection_dim
+
+    def unit_rows(n):
+        x = torch.randn((n, dim), generator=generator)
+        return x / x.norm(dim=-1, keepdim=True)
+
+    query_embs = unit_rows(queries)
+
+    results = {}
+    for pool_size in pool_sizes:
+        pool = unit_rows(pool_size)
+
+        def score_all():
+            for q in query_embs:
+                torch.topk(retriever.score_texts(q, pool), min(k, pool_size))
+
+        seconds = measure(score_all, repeats)
+        results[f"score_topk/pool={pool_size}"] = metric(
+            seconds / queries * 1e6, "us/query", False
+        )
+
+    return results
+
+
+def bench_image_load(workdir, rng, repeats, num_images=64, width=640, height=480,
+                     questions=16):
+    """
+    JPEG load/decode throughput, sequential and through ImagePrefetcher.
+    """
+    image_dir = os.path.join(workdir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+
+    metadata = {}
+    for i in range(num_images):
+        path = f"{i}.jpg"
+        random_image(rng, width, height).save(os.path.join(image_dir, path), quality=90)
+        metadata[f"img{i}"] = {"path": path}
+
+    ids = list(metadata)
+    per_question = len(ids) // questions
+    id_lists = [ids[i:i + per_question] for i in range(0, len(ids), per_question)]
+
+    seconds = measure(lambda: load_images_from_metadata(image_dir, ids, metadata), repeats)
+    results = {"image_load/sequential": metric(num_images / seconds, "images/s", True)}
+
+    def prefetched():
+        for _ in ImagePrefetcher(image_dir, metadata).iterate(id_lists):
+            pass
+
+    seconds = measure(prefetched, repeats)
+    results["image_load/prefetcher"] = metric(num_images / seconds, "images/s", True)
+
+    return results
+
+
+def bench_end_to_end(retriever, generator, rng, questions=16, pool_size=8,
+                     max_new_tokens=16, batch_size=8):
+    """
+    Per-question RAGModel.retrieve / generate latency and batched
+    generation throughput.
+    """
+    rag = RAGModel(retriever, generator, top_k_images=3, top_k_texts=3)
+
+    examples = []
+    for q in range(questions):
+        examples.append({
+            "question": random_sentence(rng) + "?",
+            "images": [random_image(rng) for _ in range(pool_size)],
+            "texts": [random_sentence(rng) for _ in range(pool_size)],
+            "image_ids": [f"q{q}_img{i}" for i in range(pool_size)],
+        })
+
+    rag.generate(**examples[0], max_new_tokens=max_new_tokens)
+
+    retrieve_times, generate_times = [], []
+    for ex in examples:
+        start = time.perf_counter()
+        rag.retrieve(ex["question"], ex["images"], ex["texts"], image_ids=ex["image_ids"])
+        retrieve_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        rag.generate(**ex, max_new_tokens=max_new_tokens)
+        generate_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    rag.generate_batch(examples, max_new_tokens=max_new_tokens, batch_size=batch_size)
+    batch_seconds = time.perf_counter() - start
+
+    return {
+        "retrieve/p50": metric(float(np.percentile(retrieve_times, 50)) * 1e3, "ms", False),
+        "retrieve/p95": metric(float(np.percentile(retrieve_times, 95)) * 1e3, "ms", False),
+        "generate/p50": metric(float(np.percentile(generate_times, 50)) * 1e3, "ms", False),
+        "generate/p95": metric(float(np.percentile(generate_times, 95)) * 1e3, "ms", False),
+        f"generate_batch/batch={batch_size}": metric(
+            questions / batch_seconds, "questions/s", True
+        ),
+    }
+
+
+def bench_eval(workdir, rng, repeats, num_records=20000, workers=(1, 4)):
+    """
+    eval_rag scoring throughput on synthetic JSON and JSONL results.
+    """
+    records = []
+    for i in range(num_records):
+        gold = rng.choice(WORDS)
+        records.append({
+            "qid": f"q{i}",
+            "question": random_sentence(rng) + "?",
+            "gold_answers": [{"answer": gold}],
+            "model_answer": f"USER: ... ASSISTANT: {rng.choice([gold, rng.choice(WORDS)])}",
+            "retrieved_captions": [random_sentence(rng) for _ in range(3)],
+        })
+
+    jsonl_path = os.path.join(workdir, "results.jsonl")
+    with open(jsonl_path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    json_path = os.path.join(workdir, "results.json")
+    with open(json_path, "w") as f:
+        json.dump(records, f)
+
+    def consume(path, n):
+        for _ in score_results(path, n):
+            pass
+
+    seconds = measure(lambda: consume(json_path, 1), repeats)
+    results = {"eval/json": metric(num_records / seconds, "records/s", True)}
+
+    for n in workers:
+        seconds = measure(lambda: consume(jsonl_path, n), repeats)
+        results[f"eval/jsonl/workers={n}"] = metric(num_records / seconds, "records/s", True)
+
+    return results
+
+
+def run(benchmarks, repeats, seed=0):
+    rng = random.Random(seed)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "threads": torch.get_num_threads(),
+            "repeats": repeats,
+        },
+        "results": {},
+    }
+    results = report["results"]
+
+    with tempfile.TemporaryDirectory() as workdir:
+        retriever = None
+        if {"encode", "scoring", "end_to_end"} & set(benchmarks):
+            retriever = TinyRetriever(write_clip_tokenizer(workdir))
+
+        for name in benchmarks:
+            print(f"Running {name}...", file=sys.stderr)
+            if name == "encode":
+                results.update(bench_encode(retriever, rng, repeats))
+            elif name == "scoring":
+                results.update(bench_scoring(retriever, rng, repeats))
+            elif name == "image_load":
+                results.update(bench_image_load(workdir, rng, repeats))
+            elif name == "end_to_end":
+                retriever.batch_size = 64
+                results.update(bench_end_to_end(retriever, TinyGenerator(), rng))
+            elif name == "eval":
+                results.update(bench_eval(workdir, rng, repeats))
+
+    return report
+
+
+def compare(baseline, current, threshold):
+    """
+    Relative change of every metric present in both reports, oriented so
+    that negative is worse. Returns rows of
+    (name, baseline value, current value, change, regressed).
+    """
+    rows = []
+    for name, base in baseline["results"].items():
+        cur = current["results"].get(name)
+        if cur is None or not base["value"]:
+            continue
+
+        change = (cur["value"] - base["value"]) / base["value"]
+        if not base["higher_is_better"]:
+            change = -change
+
+        rows.append((name, base["value"], cur["value"], change, change < -threshold))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline CPU benchmarks with tiny random CLIP/LLaVA models."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run benchmarks and write a JSON report")
+    run_parser.add_argument("--output", default="results/benchmark.json")
+    run_parser.add_argument(
+        "--benchmarks", nargs="+", default=list(BENCHMARKS), choices=BENCHMARKS
+    )
+    run_parser.add_argument("--repeats", type=int, default=5)
+    run_parser.add_argument("--threads", type=int, default=None)
+    run_parser.add_argument("--seed", type=int, default=0)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="compare a report against a baseline and flag regressions"
+    )
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold", type=float, default=0.10,
+        help="relative slowdown counted as a regression"
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        if args.threads is not None:
+            torch.set_num_threads(args.threads)
+
+        report = run(args.benchmarks, args.repeats, args.seed)
+
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+        for name, result in report["results"].items():
+            print(f"{name:<32} {result['value']:>12.2f} {result['unit']}")
+        print(f"Saved benchmark report to {args.output}")
+        return
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    with open(args.current, "r") as f:
+        current = json.load(f)
+
+    rows = compare(baseline, current, args.threshold)
+
+    print(f"{'benchmark':<32} {'baseline':>12} {'current':>12} {'gain':>8}")
+    for name, base, cur, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{name:<32} {base:>12.2f} {cur:>12.2f} {change:>+8.1%}{flag}")
+
+    regressions = sum(row[4] for row in rows)
+    print(f"{regressions} regression(s) beyond {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+from src.datasets import DATASETS, IndexMap, load_image_metadata, load_index_map
+
+
+class CaptionEmbeddingStore:
+    """
+    Precomputed retriever embeddings of a dataset's clean image captions.
+
+    One row per captioned image, in the dataset's image index order
+    (index_to_id) but skipping images without a caption, so row numbers
+    are not image indices; the doc id of each row is kept in the store's
+    own IndexMap. Embeddings are a memory-mapped float32 matrix, so stored
+    captions score exactly like freshly encoded (e.g. poisoned) ones. Rows
+    are looked up by the doc id of the captioned image or by caption text
+    when no ids are given. Like ImageEmbeddingStore, a store is tied to one
+    retriever.
+    """
+
+    MATRIX_FILE = "embeddings.npy"
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root: str, model_id: str, dataset: str):
+        self.root = root
+        self.model_id = model_id
+        self.dataset = dataset
+        self.store_dir = os.path.join(root, dataset, model_id.replace("/", "__"))
+        self.matrix_path = os.path.join(self.store_dir, self.MATRIX_FILE)
+        self.index_path = os.path.join(self.store_dir, self.INDEX_FILE)
+
+        self.embeddings = None
+        self.index_map = None
+        self.captions = None
+        self.text_to_row = {}
+
+    def exists(self) -> bool:
+        return os.path.exists(self.matrix_path) and os.path.exists(self.index_path)
+
+    def load(self):
+        with open(self.index_path, "r") as f:
+            index = json.load(f)
+
+        if index["model_id"] != self.model_id:
+            raise ValueError(
+                f"Caption store at {self.store_dir} was built with "
+                f"{index['model_id']}, not {self.model_id}"
+            )
+
+        self.embeddings = np.load(self.matrix_path, mmap_mode="r")
+        if self.embeddings.dtype != np.float32:
+            raise ValueError(
+                f"Caption store at {self.store_dir} holds {self.embeddings.dtype} "
+                f"embeddings; rebuild it with `python -m src.caption_store "
+                f"--dataset {self.dataset}`"
+            )
+
+        self.index_map = IndexMap(index["doc_ids"])
+        self.captions = np.asarray(index["captions"], dtype=str)
+        self.text_to_row = {}
+        for row, caption in enumerate(index["captions"]):
+            self.text_to_row.setdefault(caption, row)
+        return self
+
+    def __len__(self):
+        return len(self.index_map)
+
+    def rows_of(self, texts, doc_ids=None):
+        """
+        Store row of each caption in `texts` as an int64 array, -1 where
+        it is not stored.
+
+        `doc_ids` are the images the captions belong to (None for captions
+        of no stored image, such as poisoned ones). They are mapped to rows
+        in one vectorized IndexMap lookup, and a row only counts if its
+        stored caption is the given text. Without doc ids, captions are
+        looked up by text.
+        """
+        if doc_ids is None:
+            return np.array([self.text_to_row.get(t, -1) for t in texts], dtype=np.int64)
+
+        rows = self.index_map.index_of(["" if d is None else d for d in doc_ids])
+        found = rows >= 0
+        found[found] = self.captions[rows[found]] == np.asarray(texts, dtype=str)[found]
+        return np.where(found, rows, -1)
+
+    def gather_rows(self, rows, device=None, dtype=torch.float32):
+        """
+        Embeddings of store `rows` (from `rows_of`, all >= 0), in order.
+        """
+        embs = np.asarray(self.embeddings[np.asarray(rows, dtype=np.int64)], dtype=np.float32)
+        return torch.from_numpy(embs).to(device=device, dtype=dtype)
+
+    @classmethod
+    def build(
+        cls,
+        root: str,
+        retriever,
+        dataset: str,
+        index_map: IndexMap,
+        image_metadata: dict,
+        batch_size: int = 256
+    ):
+        """
+        Encode the caption of every indexed image once and write the
+        store. Images without a caption are left out.
+        """
+        store = cls(root, retriever.model_id, dataset)
+        os.makedirs(store.store_dir, exist_ok=True)
+
+        doc_ids = [
+            doc_id for doc_id in index_map.ids.tolist()
+            if image_metadata.get(doc_id, {}).get("caption")
+        ]
+        captions = [image_metadata[doc_id]["caption"] for doc_id in doc_ids]
+        if not captions:
+            raise RuntimeError(f"No captions found for the {dataset} image index")
+
+        tmp_path = store.matrix_path + ".tmp.npy"
+        matrix = None
+
+        for start in tqdm(range(0, len(captions), batch_size)):
+            emb = retriever.encode_text(captions[start:start + batch_size]).float().cpu().numpy()
+
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(len(captions), emb.shape[1])
+                )
+            matrix[start:start + len(emb)] = emb
+
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, store.matrix_path)
+
+        with open(store.index_path, "w") as f:
+            json.dump({
+                "model_id": retriever.model_id,
+                "doc_ids": doc_ids,
+                "captions": captions,
+            }, f)
+
+        print(f"Stored {len(doc_ids)} caption embeddings at {store.store_dir}")
+        return store.load()
+
+
+def main():
+    from src.retriever import Retriever
+
+    parser = argparse.ArgumentParser(
+        description="Precompute the caption embeddings of a dataset's test images."
+    )
+    parser.add_argument("--dataset", default="mmqa", choices=list(DATASETS))
+    parser.add_argument("--store-dir", default="cache/caption_embeddings")
+    parser.add_argument("--retriever", default="openai/clip-vit-base-patch32")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    retriever = Retriever(model_id=args.retriever, cache_dir=args.cache_dir)
+
+    CaptionEmbeddingStore.build(
+        args.store_dir,
+        retriever,
+        args.dataset,
+        load_index_map(args.dataset),
+        load_image_metadata(args.dataset),
+        batch_size=args.batch_size
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import time
+import json
+import argparse
+import torch
+from tqdm import tqdm
+from src.utils import load_mmqa_json, ImagePrefetcher
+
+
+def ranking_agreement(ref_scores, test_scores, k):
+    """
+    Compare the rankings two score vectors induce over the same pool:
+    (top-1 agrees, |top-k overlap| / k, max abs score difference).
+    """
+    k = min(k, len(ref_scores))
+    ref_top = torch.topk(ref_scores, k).indices.tolist()
+    test_top = torch.topk(test_scores, k).indices.tolist()
+
+    return (
+        ref_top[0] == test_top[0],
+        len(set(ref_top) & set(test_top)) / k,
+        float((ref_scores - test_scores).abs().max())
+    )
+
+
+class Timer:
+    """
+    Accumulates wall time and item counts per name.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.items = {}
+
+    def run(self, name, fn, items):
+        start = time.perf_counter()
+        out = fn(items)
+        self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+        self.items[name] = self.items.get(name, 0) + len(items)
+        return out
+
+    def throughput(self, name):
+        return self.items[name] / self.seconds[name] if self.seconds.get(name) else 0.0
+
+
+def compare_question(ref, test, timer, question, captions, images, image_ids, k):
+    """
+    Score one question's captions and images with both retrievers and
+    return the per-modality ranking agreement.
+    """
+    row = {}
+    for label, retriever in (("fp32", ref), ("cpu", test)):
+        query_emb = timer.run(f"{label}_text", retriever.encode_text, [question])[0]
+        text_embs = timer.run(f"{label}_text", retriever.encode_text, captions)
+        image_embs = timer.run(
+            f"{label}_image", lambda imgs: retriever.encode_images(imgs, image_ids), images
+        )
+        row[label] = (
+            retriever.score_texts(query_emb, text_embs).cpu(),
+            retriever.score_images(query_emb, image_embs).cpu()
+        )
+
+    return {
+        "texts": ranking_agreement(row["fp32"][0], row["cpu"][0], k) if captions else None,
+        "images": ranking_agreement(row["fp32"][1], row["cpu"][1], k),
+    }
+
+
+def main():
+    from src.retriever import Retriever
+    from src import run_rag
+
+    parser = argparse.ArgumentParser(
+        description="Check a CPU retriever backend against fp32 rankings on MMQA."
+    )
+    parser.add_argument("--backend", default="torchscript", choices=["int8", "torchscript"])
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--limit", type=int, default=500, help="questions to check")
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--output", default=None, help="optional JSON summary path")
+    args = parser.parse_args()
+
+    with open(run_rag.IMAGE_METADATA_PATH, "r") as f:
+        image_metadata = json.load(f)
+
+    data = load_mmqa_json(run_rag.DATA_PATH)[:args.limit]
+    print(f"Checking {len(data)} examples")
+
+    ref = Retriever(
+        model_id=run_rag.RETRIEVER_ID,
+        device="cpu",
+        cache_dir=run_rag.CACHE_DIR,
+        batch_size=args.batch_size,
+        num_threads=args.threads
+    )
+    test = Retriever(
+        model_id=run_rag.RETRIEVER_ID,
+        cache_dir=run_rag.CACHE_DIR,
+        batch_size=args.batch_size,
+        backend=args.backend,
+        num_threads=args.threads
+    )
+
+    timer = Timer()
+    totals = {"texts": [0, 0.0, 0.0, 0.0], "images": [0, 0.0, 0.0, 0.0]}
+
+    prefetcher = ImagePrefetcher(run_rag.IMAGE_DIR, image_metadata)
+    for ex, (images, image_ids) in tqdm(
+        zip(data, prefetcher.iterate(ex["metadata"]["image_doc_ids"] for ex in data)),
+        total=len(data)
+    ):
+        if not images:
+            continue
+
+        captions = [
+            image_metadata[i]["caption"]
+            for i in image_ids
+            if image_metadata.get(i, {}).get("caption")
+        ]
+        agreement = compare_question(
+            ref, test, timer, ex["question"], captions, images, image_ids, args.top_k
+        )
+
+        for modality, result in agreement.items():
+            if result is None:
+                continue
+            top1, overlap, diff = result
+            n, t1, ov, md = totals[modality]
+            totals[modality] = [n + 1, t1 + top1, ov + overlap, max(md, diff)]
+
+    summary = {"backend": args.backend, "threads": torch.get_num_threads(), "top_k": args.top_k}
+    for modality, (n, top1, overlap, max_diff) in totals.items():
+        summary[modality] = {
+            "questions": n,
+            "top1_agreement": top1 / n if n else 0.0,
+            f"top{args.top_k}_overlap": overlap / n if n else 0.0,
+            "max_score_diff": max_diff,
+        }
+    for name in ("text", "image"):
+        fp32 = timer.throughput(f"fp32_{name}")
+        cpu = timer.throughput(f"cpu_{name}")
+        summary[f"{name}_throughput"] = {
+            "fp32_per_sec": fp32,
+            "cpu_per_sec": cpu,
+            "speedup": cpu / fp32 if fp32 else 0.0,
+        }
+
+    print(json.dumps(summary, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
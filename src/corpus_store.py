@@ -0,0 +1,221 @@
+import os
+import json
+import gzip
+import sqlite3
+import argparse
+import threading
+from collections.abc import Mapping
+from tqdm import tqdm
+
+
+# name -> (file under the MMQA data dir, id field)
+MMQA_SOURCES = {
+    "texts": ("MMQA_texts.jsonl.gz", "id"),
+    "images": ("MMQA_images.jsonl.gz", "id"),
+    "dev": ("MMQA_dev.jsonl.gz", "qid"),
+    "test": ("MMQA_test.jsonl.gz", "qid"),
+    "train": ("MMQA_train_image_text_only.jsonl.gz", "qid"),
+}
+
+
+class CorpusStore(Mapping):
+    """
+    Read-only, random-access view of a JSONL(.gz) corpus.
+
+    `build` converts the corpus once into an SQLite file with one row per
+    record, keyed by its id; afterwards `store[doc_id]` parses only the
+    requested record, so nothing is decompressed or held in memory up
+    front. Behaves like a dict of id -> record.
+    """
+
+    INSERT_BATCH = 10000
+
+    def __init__(self, path: str):
+        self.path = path
+        # Shared by the model server's handler threads; lookups are
+        # serialized through a lock
+        self.conn = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self.meta = dict(self._query("SELECT key, value FROM meta"))
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @classmethod
+    def build(cls, source: str, path: str, id_field: str = "id"):
+        """
+        Index a JSONL or JSONL.gz file by `id_field`. Later records with a
+        duplicate id replace earlier ones, as loading into a dict would.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        conn = sqlite3.connect(tmp_path)
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(
+            "CREATE TABLE records (id TEXT PRIMARY KEY, data TEXT NOT NULL) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+
+        opener = gzip.open if source.endswith(".gz") else open
+        rows = []
+        with opener(source, "rt", encoding="utf-8") as f:
+            for line in tqdm(f, desc=os.path.basename(source)):
+                line = line.strip()
+                if not line:
+                    continue
+                rows.append((str(json.loads(line)[id_field]), line))
+                if len(rows) >= cls.INSERT_BATCH:
+                    conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?)", rows)
+                    rows = []
+        if rows:
+            conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?)", rows)
+
+        count = conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", [
+            ("source", os.path.abspath(source)),
+            ("source_size", str(os.path.getsize(source))),
+            ("id_field", id_field),
+            ("count", str(count)),
+        ])
+        conn.commit()
+        conn.close()
+
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    def is_stale(self, source: str) -> bool:
+        """
+        Whether `source` no longer matches the file this store was built from.
+        """
+        return str(os.path.getsize(source)) != self.meta.get("source_size")
+
+    def __getitem__(self, doc_id):
+        rows = self._query("SELECT data FROM records WHERE id = ?", (doc_id,))
+        if not rows:
+            raise KeyError(doc_id)
+        return json.loads(rows[0][0])
+
+    def __contains__(self, doc_id):
+        return bool(self._query("SELECT 1 FROM records WHERE id = ?", (doc_id,)))
+
+    def __len__(self):
+        return int(self.meta["count"])
+
+    def __iter__(self):
+        # Iterates over ids in key order without loading them all
+        last = ""
+        while True:
+            rows = self._query(
+                "SELECT id FROM records WHERE id > ? ORDER BY id LIMIT ?",
+                (last, self.INSERT_BATCH)
+            )
+            if not rows:
+                return
+            for (doc_id,) in rows:
+                yield doc_id
+            last = rows[-1][0]
+
+    def get_many(self, doc_ids) -> dict:
+        """
+        Records for the given ids in one pass; missing ids are left out.
+        """
+        doc_ids = list(dict.fromkeys(doc_ids))
+        found = {}
+        # SQLite's default limit on bound parameters is 999
+        for start in range(0, len(doc_ids), 900):
+            chunk = doc_ids[start:start + 900]
+            placeholders = ",".join("?" * len(chunk))
+            for doc_id, data in self._query(
+                f"SELECT id, data FROM records WHERE id IN ({placeholders})", chunk
+            ):
+                found[doc_id] = json.loads(data)
+        return found
+
+    def field(self, name: str):
+        """
+        Lazy id -> record[name] mapping, e.g. store.field("text") in place
+        of `utils.load_text_corpus`.
+        """
+        return FieldView(self, name)
+
+    def close(self):
+        self.conn.close()
+
+
+class FieldView(Mapping):
+    """
+    id -> one field of each record of a CorpusStore, looked up on access.
+    """
+
+    def __init__(self, store: CorpusStore, name: str):
+        self.store = store
+        self.name = name
+
+    def __getitem__(self, doc_id):
+        return self.store[doc_id][self.name]
+
+    def __contains__(self, doc_id):
+        return doc_id in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def get_many(self, doc_ids) -> dict:
+        return {
+            doc_id: record[self.name]
+            for doc_id, record in self.store.get_many(doc_ids).items()
+        }
+
+
+def store_path(store_dir: str, name: str) -> str:
+    return os.path.join(store_dir, f"MMQA_{name}.sqlite")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index the gzipped MMQA corpora into random-access SQLite stores."
+    )
+    parser.add_argument(
+        "names", nargs="*",
+        help=f"corpora to index, from {', '.join(MMQA_SOURCES)} (default: all that exist)"
+    )
+    parser.add_argument("--data-dir", default="datasets/mmqa")
+    parser.add_argument("--store-dir", default="cache/mmqa_store")
+    parser.add_argument("--force", action="store_true", help="rebuild up-to-date stores")
+    args = parser.parse_args()
+
+    unknown = set(args.names) - set(MMQA_SOURCES)
+    if unknown:
+        parser.error(f"unknown corpora: {', '.join(sorted(unknown))}")
+
+    for name in args.names or MMQA_SOURCES:
+        filename, id_field = MMQA_SOURCES[name]
+        source = os.path.join(args.data_dir, filename)
+        path = store_path(args.store_dir, name)
+
+        if not os.path.exists(source):
+            print(f"Skipping {name}: {source} not found")
+            continue
+
+        if os.path.exists(path) and not args.force and not CorpusStore(path).is_stale(source):
+            print(f"{path} is up to date")
+            continue
+
+        store = CorpusStore.build(source, path, id_field=id_field)
+        print(f"Indexed {len(store)} {name} records into {path}")
+
+
+if __name__ == "__main__":
+    main()
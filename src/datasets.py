@@ -0,0 +1,163 @@
+import os
+import json
+
+
+# Per-dataset file layout. WebQA questions and images are not shipped with
+# the captions: put the official WebQA_test.json (or a list in the MMQA
+# example format) and the decoded images at the paths below.
+DATASETS = {
+    "mmqa": {
+        "root": "datasets/mmqa-mmpoisonrag",
+        "data": "MMQA_test_image.json",
+        "image_metadata": "MMQA_image_metadata.json",
+        "poisoned_metadata": "MMQA_image_metadata_poisoned.json",
+        "index_to_id": "MMQA_test_image_index_to_id.json",
+        "image_dir": "datasets/mmqa/final_dataset_images",
+    },
+    "webqa": {
+        "root": "datasets/webqa-mmpoisionrag",
+        "data": "WebQA_test.json",
+        "captions": "WebQA_caption_test.json",
+        "poisoned_metadata": "WebQA_image_metadata_poisoned.json",
+        "index_to_id": "WebQA_test_image_index_to_id.json",
+        "image_dir": "datasets/webqa/images",
+        "image_extension": ".jpg",
+    },
+}
+
+
+def dataset_path(name: str, key: str) -> str:
+    config = DATASETS[name]
+    return os.path.join(config["root"], config[key])
+
+
+class IndexMap:
+    """
+    Bidirectional image index <-> doc id mapping held in NumPy arrays.
+
+    `ids[i]` is the doc id of index i; `index_of` maps many doc ids to
+    indices at once through a sorted copy of the ids and searchsorted.
+    """
+
+    def __init__(self, ids):
+        import numpy as np
+
+        self.ids = np.asarray(ids, dtype=str)
+        self._order = np.argsort(self.ids, kind="stable")
+        self._sorted = self.ids[self._order]
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Read an {"<index>": "<doc id>"} JSON file.
+        """
+        with open(path, "r") as f:
+            mapping = json.load(f)
+
+        ids = [None] * len(mapping)
+        for index, doc_id in mapping.items():
+            ids[int(index)] = str(doc_id)
+        return cls(ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def index_of(self, doc_ids):
+        """
+        Index of each doc id as an int64 array, -1 for ids not in the
+        mapping.
+        """
+        import numpy as np
+
+        doc_ids = np.asarray(doc_ids, dtype=str)
+        if len(self.ids) == 0 or len(doc_ids) == 0:
+            return np.full(len(doc_ids), -1, dtype=np.int64)
+
+        pos = np.searchsorted(self._sorted, doc_ids)
+        pos = np.minimum(pos, len(self._sorted) - 1)
+        found = self._sorted[pos] == doc_ids
+        return np.where(found, self._order[pos], -1)
+
+    def id_of(self, indices) -> list:
+        import numpy as np
+
+        return self.ids[np.asarray(indices, dtype=np.int64)].tolist()
+
+    def contains(self, doc_ids):
+        return self.index_of(doc_ids) >= 0
+
+
+def webqa_examples(raw) -> list:
+    """
+    Convert official WebQA records ({guid: {"Q", "A", "img_Facts" /
+    "img_posFacts" / "img_negFacts", ...}}) to the MMQA example format the
+    pipeline uses. Positive image facts become the gold image instances.
+    Lists already in that format are returned unchanged.
+    """
+    if isinstance(raw, list):
+        return raw
+
+    examples = []
+    for guid, q in raw.items():
+        positives = [str(f["image_id"]) for f in q.get("img_posFacts", [])]
+        candidates = positives + [
+            str(f["image_id"])
+            for f in q.get("img_Facts", []) + q.get("img_negFacts", [])
+        ]
+
+        answers = q.get("A", [])
+        if isinstance(answers, str):
+            answers = [answers]
+
+        examples.append({
+            "qid": guid,
+            "question": q["Q"].strip().strip('"'),
+            "answers": [
+                {
+                    "answer": a.strip().strip('"'),
+                    "image_instances": [{"doc_id": doc_id} for doc_id in positives],
+                }
+                for a in answers
+            ],
+            "metadata": {"image_doc_ids": list(dict.fromkeys(candidates))},
+        })
+    return examples
+
+
+def load_examples(name: str) -> list:
+    with open(dataset_path(name, "data"), "r") as f:
+        raw = json.load(f)
+    return webqa_examples(raw) if name == "webqa" else raw
+
+
+def load_image_metadata(name: str) -> dict:
+    """
+    doc id -> {"caption", "path"} for the dataset's test images.
+    """
+    if "image_metadata" in DATASETS[name]:
+        with open(dataset_path(name, "image_metadata"), "r") as f:
+            return json.load(f)
+
+    with open(dataset_path(name, "captions"), "r") as f:
+        captions = json.load(f)
+
+    extension = DATASETS[name].get("image_extension", "")
+    return {
+        str(doc_id): {"caption": caption, "path": f"{doc_id}{extension}"}
+        for doc_id, caption in captions.items()
+    }
+
+
+def load_poisoned_metadata(name: str):
+    """
+    The dataset's poisoned caption metadata, or None if it has none yet.
+    """
+    path = dataset_path(name, "poisoned_metadata")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_index_map(name: str) -> IndexMap:
+    return IndexMap.load(dataset_path(name, "index_to_id"))
@@ -0,0 +1,164 @@
+import os
+import json
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+from src.utils import load_images_from_metadata
+
+
+class ImageEmbeddingStore:
+    """
+    Persistent on-disk store of retriever image embeddings.
+
+    Embeddings are kept as a memory-mapped float16 matrix, one row per image,
+    with a doc_id -> row index. A store is tied to a single retriever model_id,
+    so each model gets its own sub-directory under `root`.
+    """
+
+    MATRIX_FILE = "embeddings.npy"
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root: str, model_id: str):
+        self.root = root
+        self.model_id = model_id
+        self.store_dir = os.path.join(root, model_id.replace("/", "__"))
+        self.matrix_path = os.path.join(self.store_dir, self.MATRIX_FILE)
+        self.index_path = os.path.join(self.store_dir, self.INDEX_FILE)
+
+        self.embeddings = None
+        self.id_to_row = {}
+
+    def exists(self) -> bool:
+        return os.path.exists(self.matrix_path) and os.path.exists(self.index_path)
+
+    def load(self):
+        """
+        Memory-map the embedding matrix and read the id -> row index.
+        """
+        with open(self.index_path, "r") as f:
+            index = json.load(f)
+
+        if index["model_id"] != self.model_id:
+            raise ValueError(
+                f"Embedding store at {self.store_dir} was built with "
+                f"{index['model_id']}, not {self.model_id}"
+            )
+
+        self.id_to_row = {doc_id: row for row, doc_id in enumerate(index["doc_ids"])}
+        self.embeddings = np.load(self.matrix_path, mmap_mode="r")
+        return self
+
+    def __len__(self):
+        return len(self.id_to_row)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.id_to_row
+
+    def gather(self, doc_ids, device=None, dtype=torch.float32):
+        """
+        Return the embeddings of `doc_ids` (in order) as a torch tensor.
+        """
+        rows = [self.id_to_row[d] for d in doc_ids]
+        embs = np.asarray(self.embeddings[rows], dtype=np.float32)
+        return torch.from_numpy(embs).to(device=device, dtype=dtype)
+
+    @classmethod
+    def build(
+        cls,
+        root: str,
+        retriever,
+        image_dir: str,
+        image_metadata: dict,
+        batch_size: int = 64
+    ):
+        """
+        Encode every image in `image_metadata` once and write the store.
+        Images that are missing or cannot be decoded are skipped.
+        """
+        store = cls(root, retriever.model_id)
+        os.makedirs(store.store_dir, exist_ok=True)
+
+        all_ids = list(image_metadata.keys())
+        tmp_path = store.matrix_path + ".tmp.npy"
+
+        matrix = None
+        doc_ids = []
+
+        for start in tqdm(range(0, len(all_ids), batch_size)):
+            images, valid_ids = load_images_from_metadata(
+                image_dir,
+                all_ids[start:start + batch_size],
+                image_metadata
+            )
+
+            if not images:
+                continue
+
+            emb = retriever.encode_images(images).float().cpu().numpy()
+
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(
+                    tmp_path,
+                    mode="w+",
+                    dtype=np.float16,
+                    shape=(len(all_ids), emb.shape[1])
+                )
+
+            matrix[len(doc_ids):len(doc_ids) + len(valid_ids)] = emb
+            doc_ids.extend(valid_ids)
+
+        if matrix is None:
+            raise RuntimeError(f"No images could be loaded from {image_dir}")
+
+        # Trim the rows reserved for skipped images
+        final = np.lib.format.open_memmap(
+            store.matrix_path + ".final.npy",
+            mode="w+",
+            dtype=np.float16,
+            shape=(len(doc_ids), matrix.shape[1])
+        )
+        final[:] = matrix[:len(doc_ids)]
+        final.flush()
+        del final, matrix
+
+        os.replace(store.matrix_path + ".final.npy", store.matrix_path)
+        os.remove(tmp_path)
+
+        with open(store.index_path, "w") as f:
+            json.dump({"model_id": retriever.model_id, "doc_ids": doc_ids}, f)
+
+        print(f"Stored {len(doc_ids)} image embeddings at {store.store_dir}")
+        return store.load()
+
+
+def main():
+    from src.retriever import Retriever
+
+    parser = argparse.ArgumentParser(
+        description="Build the on-disk image embedding store."
+    )
+    parser.add_argument("--metadata", default="datasets/mmqa-mmpoisonrag/MMQA_image_metadata.json")
+    parser.add_argument("--image-dir", default="datasets/mmqa/final_dataset_images")
+    parser.add_argument("--store-dir", default="cache/embeddings")
+    parser.add_argument("--retriever", default="openai/clip-vit-base-patch32")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    with open(args.metadata, "r") as f:
+        image_metadata = json.load(f)
+
+    retriever = Retriever(model_id=args.retriever, cache_dir=args.cache_dir)
+
+    ImageEmbeddingStore.build(
+        args.store_dir,
+        retriever,
+        args.image_dir,
+        image_metadata,
+        batch_size=args.batch_size
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
-import json
 import os
-from openai import OpenAI
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
 from tqdm import tqdm
+from src.utils import read_jsonl, JSONLWriter
 
 # =====================
 # Configuration
@@ -9,14 +14,13 @@ from tqdm import tqdm
 
 OPENAI_MODEL = "gpt-4.1-mini"
 N_CANDIDATES = 10
+TEMPERATURE = 0.7
+
+OPENAI_KEY_PATH = "/scratch/shayan/Projects/mepa-attack/OpenAI_key.txt"
 
-def load_openai_key(path="/scratch/shayan/Projects/mepa-attack/OpenAI_key.txt"):
+def load_openai_key(path=OPENAI_KEY_PATH):
     with open(path, "r") as f:
         return f.read().strip()
-    
-os.environ["OPENAI_API_KEY"] = load_openai_key()
-
-client = OpenAI()
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 INPUT_IMAGE_METADATA = os.path.join(
@@ -24,7 +28,33 @@ INPUT_IMAGE_METADATA = os.path.join(
     "datasets/mmqa-mmpoisonrag/MMQA_image_metadata.json"
 )
 
-OUTPUT_POISONED_METADATA = "datasets/mmqa-mmpoisonrag/MMQA_image_metadata_poisoned.json"
+OUTPUT_POISONED_METADATA = os.path.join(
+    PROJECT_ROOT,
+    "datasets/mmqa-mmpoisonrag/MMQA_image_metadata_poisoned.json"
+)
+
+TEST_DATA_PATH = os.path.join(
+    PROJECT_ROOT,
+    "datasets/mmqa-mmpoisonrag/MMQA_test_image.json"
+)
+
+# Completed responses, keyed by (model, prompt hash, temperature)
+RESPONSE_CACHE_PATH = os.path.join(PROJECT_ROOT, "cache/openai_responses.jsonl")
+
+
+def retryable_errors():
+    """
+    Errors worth retrying with exponential backoff. openai is imported
+    here so the rest of this module works without it.
+    """
+    import openai
+
+    return (
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+    )
 
 # Example attacker payload (can be swapped per experiment)
 ATTACKER_PAYLOAD = (
@@ -92,17 +122,139 @@ def build_poison_prompt(
         """.strip()
 
 
-def main():
+def client_kwargs(base_url=None):
+    """
+    Client settings. The key comes from OPENAI_API_KEY, else the key file;
+    an OpenAI-compatible server at `base_url` (e.g. a local stub) needs
+    neither.
+    """
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if api_key is None:
+        api_key = "EMPTY" if base_url else load_openai_key()
+    # Retries are handled here with backoff, not inside the client
+    return {"api_key": api_key, "base_url": base_url, "max_retries": 0}
 
-    print("Loading MMQA test ImageQ data...")
-    TEST_DATA_PATH = os.path.join(
-        PROJECT_ROOT,
-        "datasets/mmqa-mmpoisonrag/MMQA_test_image.json"
-    )
 
-    with open(TEST_DATA_PATH, "r") as f:
-        test_data = json.load(f)
+def parse_candidates(raw_output: str):
+    """
+    Parse the numbered candidate list returned by the model.
+    """
+    candidates = []
+    for line in raw_output.splitlines():
+        line = line.strip()
+        if line and line[0].isdigit() and "." in line:
+            candidates.append(
+                line.split(".", 1)[1].strip().strip("“”")
+            )
+    return candidates
+
+
+class ResponseCache:
+    """
+    Persistent cache of chat completions keyed by
+    (model, sha256 of the prompt, temperature), stored as JSONL.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            for r in read_jsonl(path):
+                self.entries[r["key"]] = r["response"]
+        self.writer = JSONLWriter(path, fsync_every=1)
+
+    @staticmethod
+    def key(model: str, prompt: str, temperature: float) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return f"{model}:{prompt_hash}:{temperature}"
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, response: str):
+        self.entries[key] = response
+        self.writer.write({"key": key, "response": response})
+
+    def close(self):
+        self.writer.close()
+
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter: `rate` requests per second on average, with
+    bursts of up to `capacity` requests. `acquire` waits in async code,
+    `acquire_sync` in blocking code.
+    """
+
+    def __init__(self, rate: float, capacity: int = None):
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _take(self) -> float:
+        """
+        Take a token if one is available and return 0, otherwise return
+        how long to wait for the next one.
+        """
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                delay = self._take()
+                if delay == 0:
+                    return
+                await asyncio.sleep(delay)
+
+    def acquire_sync(self):
+        while True:
+            delay = self._take()
+            if delay == 0:
+                return
+            time.sleep(delay)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, max_delay: float = 60.0) -> float:
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(max_delay, base * 2 ** attempt))
+
 
+def save_poisoned_metadata(poisoned_metadata: dict, path: str):
+    """
+    Atomically write the poisoned metadata (used for checkpoints too).
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(poisoned_metadata, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def checkpoint_path(output: str) -> str:
+    """
+    Where in-progress results go, so a failed run never replaces `output`.
+    """
+    return output + ".partial"
+
+
+def collect_jobs(test_data, clean_metadata, done):
+    """
+    (img_id, meta, prompt) for every gold-supporting test image that has
+    clean metadata and is not already in `done`.
+    """
     # Collect unique image_doc_ids actually used in the test set
     gold_image_ids = set()
 
@@ -113,55 +265,196 @@ def main():
 
     print(f"Found {len(gold_image_ids)} gold-supporting images")
 
-    with open(INPUT_IMAGE_METADATA, "r") as f:
-        clean_metadata = json.load(f)
-
-    poisoned_metadata = {}
-
-    for img_id in tqdm(gold_image_ids):
+    jobs = []
+    for img_id in sorted(gold_image_ids):
 
-        if img_id not in clean_metadata:
+        if img_id not in clean_metadata or img_id in done:
             continue
 
         meta = clean_metadata[img_id]
-        image_context = meta["caption"]
 
         prompt = build_poison_prompt(
-            image_context=image_context,
+            image_context=meta["caption"],
             target_query=TARGET_QUERY,
             attacker_payload=ATTACKER_PAYLOAD,
             n_candidates=N_CANDIDATES
         )
+        jobs.append((img_id, meta, prompt))
 
-        response = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7
-        )
+    return jobs
 
-        raw_output = response.choices[0].message.content
 
-        # Parse numbered list
-        candidates = []
-        for line in raw_output.splitlines():
-            line = line.strip()
-            if line and line[0].isdigit():
-                candidates.append(
-                    line.split(".", 1)[1].strip().strip("“”")
+def poisoned_entry(meta, raw_output):
+    return {
+        "path": meta["path"],
+        "clean_caption": meta["caption"],
+        "poisoned_candidates": parse_candidates(raw_output)
+    }
+
+
+def run_sync(jobs, args, cache, poisoned_metadata):
+    """
+    One blocking request at a time (the original behaviour), with
+    caching, retries, rate limiting and checkpointing.
+    """
+    from openai import OpenAI
+
+    client = OpenAI(**client_kwargs(args.base_url))
+    retryable = retryable_errors()
+    bucket = TokenBucket(args.rate) if args.rate else None
+
+    for n, (img_id, meta, prompt) in enumerate(tqdm(jobs), start=1):
+
+        key = ResponseCache.key(args.model, prompt, args.temperature)
+        raw_output = cache.get(key)
+
+        attempt = 0
+        while raw_output is None:
+            if bucket is not None:
+                bucket.acquire_sync()
+            try:
+                response = client.chat.completions.create(
+                    model=args.model,
+                    messages=[{"role": "user", "content": prompt}],
+                    temperature=args.temperature
                 )
+                raw_output = response.choices[0].message.content
+                cache.put(key, raw_output)
+            except retryable as e:
+                if attempt >= args.max_retries:
+                    print(f"[WARN] Giving up on {img_id}: {e}")
+                    break
+                time.sleep(backoff_delay(attempt))
+                attempt += 1
+
+        if raw_output is None:
+            continue
 
-        poisoned_metadata[img_id] = {
-            "path": meta["path"],
-            "clean_caption": meta["caption"],
-            "poisoned_candidates": candidates
-        }
-
-    with open(
-        "datasets/mmqa-mmpoisonrag/MMQA_image_metadata_poisoned.json",
-        "w",
-        encoding="utf-8"
-    ) as f:
-        json.dump(poisoned_metadata, f, indent=2)
+        poisoned_metadata[img_id] = poisoned_entry(meta, raw_output)
+
+        if n % args.checkpoint_every == 0:
+            save_poisoned_metadata(poisoned_metadata, checkpoint_path(args.output))
+
+
+async def run_async(jobs, args, cache, poisoned_metadata):
+    """
+    Concurrent requests: at most `args.concurrency` in flight, started at
+    no more than `args.rate` per second.
+    """
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(**client_kwargs(args.base_url))
+    retryable = retryable_errors()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    bucket = TokenBucket(args.rate) if args.rate else None
+
+    async def complete(img_id, prompt):
+        key = ResponseCache.key(args.model, prompt, args.temperature)
+        raw_output = cache.get(key)
+        if raw_output is not None:
+            return raw_output
+
+        async with semaphore:
+            for attempt in range(args.max_retries + 1):
+                if bucket is not None:
+                    await bucket.acquire()
+                try:
+                    response = await client.chat.completions.create(
+                        model=args.model,
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=args.temperature
+                    )
+                except retryable as e:
+                    if attempt == args.max_retries:
+                        print(f"[WARN] Giving up on {img_id}: {e}")
+                        return None
+                    await asyncio.sleep(backoff_delay(attempt))
+                    continue
+
+                raw_output = response.choices[0].message.content
+                cache.put(key, raw_output)
+                return raw_output
+
+    async def job(img_id, meta, prompt):
+        return img_id, meta, await complete(img_id, prompt)
+
+    tasks = [asyncio.create_task(job(*j)) for j in jobs]
+
+    try:
+        with tqdm(total=len(tasks)) as bar:
+            for n, finished in enumerate(asyncio.as_completed(tasks), start=1):
+                img_id, meta, raw_output = await finished
+                bar.update(1)
+
+                if raw_output is not None:
+                    poisoned_metadata[img_id] = poisoned_entry(meta, raw_output)
+
+                if n % args.checkpoint_every == 0:
+                    save_poisoned_metadata(poisoned_metadata, checkpoint_path(args.output))
+    finally:
+        await client.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Generate poisoned caption candidates for gold test images."
+    )
+    parser.add_argument("--model", default=OPENAI_MODEL)
+    parser.add_argument("--temperature", type=float, default=TEMPERATURE)
+    parser.add_argument("--base-url", default=None, help="OpenAI-compatible API base URL")
+    parser.add_argument("--output", default=OUTPUT_POISONED_METADATA)
+    parser.add_argument("--cache", default=RESPONSE_CACHE_PATH)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="issue requests concurrently with asyncio")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=5.0,
+                        help="max requests started per second (0 = unlimited)")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--checkpoint-every", type=int, default=25)
+    parser.add_argument("--resume", action="store_true",
+                        help="keep entries already in --output (or its .partial "
+                             "checkpoint) and skip their images")
+    args = parser.parse_args()
+
+    print("Loading MMQA test ImageQ data...")
+    with open(TEST_DATA_PATH, "r") as f:
+        test_data = json.load(f)
+
+    with open(INPUT_IMAGE_METADATA, "r") as f:
+        clean_metadata = json.load(f)
+
+    partial_path = checkpoint_path(args.output)
+
+    poisoned_metadata = {}
+    if args.resume:
+        # A checkpoint from an interrupted run is newer than --output
+        for path in (partial_path, args.output):
+            if os.path.exists(path):
+                with open(path, "r", encoding="utf-8") as f:
+                    poisoned_metadata = json.load(f)
+                print(f"Resuming from {path} with {len(poisoned_metadata)} images already done")
+                break
+
+    jobs = collect_jobs(test_data, clean_metadata, poisoned_metadata)
+
+    cache = ResponseCache(args.cache)
+    try:
+        if args.use_async:
+            asyncio.run(run_async(jobs, args, cache, poisoned_metadata))
+        else:
+            run_sync(jobs, args, cache, poisoned_metadata)
+    except BaseException:
+        # Keep progress for --resume, but leave --output untouched
+        save_poisoned_metadata(poisoned_metadata, partial_path)
+        print(f"Interrupted; {len(poisoned_metadata)} images checkpointed to {partial_path}")
+        raise
+    finally:
+        cache.close()
+
+    save_poisoned_metadata(poisoned_metadata, args.output)
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
 
     print(f"Saved poisoned metadata for {len(poisoned_metadata)} images")
 
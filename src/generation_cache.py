@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+
+class GenerationCache:
+    """
+    Persistent, content-addressed cache of generator outputs in SQLite.
+
+    Entries are keyed by a hash of (model_id, prompt, retrieved image
+    doc_ids, decoding params), so clean and poisoned runs that build the
+    same generator input share one LLaVA call. The table is kept at
+    `max_entries` rows by evicting the least recently used entries.
+    Several processes (e.g. shards) can share one cache file.
+    """
+
+    # Size check / eviction runs once per this many inserts
+    EVICT_EVERY = 64
+
+    def __init__(self, path: str, max_entries: int = 200000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # The model server builds the cache on its main thread and uses it
+        # from its batching thread; calls are never concurrent
+        self.conn = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            "key TEXT PRIMARY KEY, answer TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)"
+        )
+
+    @staticmethod
+    def key(model_id: str, prompt: str, image_ids, params: dict) -> str:
+        payload = json.dumps(
+            [model_id, prompt, list(image_ids), params],
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        row = self.conn.execute(
+            "SELECT answer FROM generations WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.conn.execute(
+            "UPDATE generations SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return row[0]
+
+    def put(self, key: str, answer: str):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO generations (key, answer, last_used) VALUES (?, ?, ?)",
+            (key, answer, time.time())
+        )
+
+        self._puts += 1
+        if self._puts % self.EVICT_EVERY == 0:
+            self._evict()
+
+    def _evict(self):
+        count = self.conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+        if count <= self.max_entries:
+            return
+
+        # Evict a little extra so we don't evict on every insert
+        excess = count - self.max_entries + max(1, self.max_entries // 100)
+        self.conn.execute(
+            "DELETE FROM generations WHERE key IN ("
+            "SELECT key FROM generations ORDER BY last_used LIMIT ?)",
+            (excess,)
+        )
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM generations").fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self):
+        self.conn.close()
@@ -1,31 +1,149 @@
+import re
+import string
+from collections import OrderedDict
 import torch
-from transformers import AutoProcessor, AutoModelForCausalLM, LlavaForConditionalGeneration
+from src.metrics import span, count
+
+
+# Newlines, and periods followed by whitespace, end a short answer
+ANSWER_END_RE = re.compile(r"\n|\.(?=\s)")
+
+# Words whose trailing period does not end the answer ("St. Louis")
+ABBREVIATIONS = {"Mr", "Mrs", "Ms", "Dr", "St", "Mt", "Jr", "Sr", "vs", "Inc", "Co", "Ltd"}
+
+
+def answer_end(text: str):
+    """
+    Position in generated `text` where a short answer ends (the first
+    newline, or sentence-ending period, after some answer text), or None
+    if the answer may still continue. Periods after single letters,
+    abbreviations and dotted words ("U.S.") are not treated as ends.
+    """
+    for m in ANSWER_END_RE.finditer(text):
+        before = text[:m.start()]
+        if not before.strip():
+            continue
+        if m.group() == ".":
+            # "(Dr. No)": quotes and brackets don't hide an abbreviation
+            word = before.split()[-1].strip(string.punctuation)
+            if len(word) == 1 or word in ABBREVIATIONS or "." in word:
+                continue
+        return m.start()
+    return None
+
+
+class _AnswerEndCriteria:
+    """
+    Stopping criterion (transformers' StoppingCriteria interface) that
+    marks each sequence in a batch done as soon as its new tokens contain
+    a complete short answer. generate() stops once every row is done; rows
+    that finish early are only padded until then.
+
+    An answer end is detected on the step that generates it, so each step
+    only decodes the last WINDOW tokens of the rows not done yet; the whole
+    answer is only decoded to confirm an end the window found.
+    """
+
+    # Enough tokens to hold the word before a period
+    WINDOW = 16
+
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.done = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.done is None:
+            self.done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+        rows = (~self.done).nonzero().flatten().tolist()
+        if rows:
+            start = max(self.prompt_length, input_ids.shape[1] - self.WINDOW)
+            texts = self.tokenizer.batch_decode(
+                input_ids[rows, start:], skip_special_tokens=True
+            )
+            for row, text in zip(rows, texts):
+                if answer_end(text) is None:
+                    continue
+                # A window that starts inside a word can turn "Ltd." into
+                # "td.", so confirm on the row's whole answer
+                if start > self.prompt_length and answer_end(self.tokenizer.batch_decode(
+                    input_ids[row:row + 1, self.prompt_length:], skip_special_tokens=True
+                )[0]) is None:
+                    continue
+                self.done[row] = True
+
+        return self.done.clone()
+
 
 class Generator:
     """
     Generic multimodal generator for RAG.
     Supports LLaVA-style and other vision-language chat models.
     """
+
+    # Rough number of sequence positions one image expands to
+    # (LLaVA-1.5: 24x24 patches). Only used to bucket prompts by length.
+    IMAGE_TOKEN_ESTIMATE = 576
+
     def __init__(
             self,
             model_id: str,
             device: str = None,
             cache_dir: str = None,
             dtype = torch.float16,
-            trust_remote_code: bool = True
+            trust_remote_code: bool = True,
+            pixel_cache = None,
+            prefix_cache_size: int = 0,
+            short_answer: bool = False,
+            metrics = None
     ):
+        """
+        prefix_cache_size: number of prompt-prefix KV caches kept on device
+                           for reuse across `generate` calls (0 disables).
+                           Each entry holds the keys/values of the shared
+                           prefix and its image tokens, so keep this small
+                           for large models.
+        short_answer:      stop each sequence at the end of its first line
+                           or sentence (or EOS) and return only that answer
+        metrics:           optional RunMetrics for processor / generate /
+                           decode timings, token and cache counters
+        """
         self.model_id = model_id
         self.device = device
         self.cache_dir = cache_dir
         self.torch_dtype = dtype
         self.trust_remote_code = trust_remote_code
+        self.pixel_cache = pixel_cache
+        self.prefix_cache_size = prefix_cache_size
+        self._prefix_cache = OrderedDict()
+        self.short_answer = short_answer
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        # The processor and model are loaded on first use
+        if name in ("model", "processor"):
+            self.load()
+            return self.__dict__[name]
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
 
-        self._load_model()
+    def load(self):
+        """
+        Load the processor and model now rather than on first use.
+        """
+        if "model" not in self.__dict__:
+            self._load_model()
+        return self
 
     def _load_model(self):
         """
         Load processor and model depending on architecture.
         """
+        from transformers import (
+            AutoProcessor,
+            AutoModelForCausalLM,
+            LlavaForConditionalGeneration,
+        )
 
         # Processor (handles text + image formatting)
         self.processor = AutoProcessor.from_pretrained(
@@ -54,32 +172,244 @@ class Generator:
 
         self.model.eval()
 
+    def _expand_image_tokens(self, prompt: str, pixel_values) -> str:
+        """
+        Repeat each image placeholder to the number of image features, as the
+        LLaVA processor does when it is given images itself.
+        """
+        proc = self.processor
+        if getattr(proc, "patch_size", None) is None:
+            # Older processors leave the expansion to the model
+            return prompt
+
+        height, width = pixel_values.shape[-2:]
+        num_tokens = (height // proc.patch_size) * (width // proc.patch_size)
+        num_tokens += getattr(proc, "num_additional_image_tokens", 0)
+        if getattr(proc, "vision_feature_select_strategy", None) == "default":
+            num_tokens -= 1
+
+        return prompt.replace(proc.image_token, proc.image_token * num_tokens)
+
+    def _prepare_inputs(self, prompts, images, image_ids=None):
+        """
+        Tokenize prompts and preprocess their images (flattened across
+        prompts). With a pixel cache and image doc ids, LLaVA pixel_values
+        come from the cache and only the text goes through the processor.
+        """
+        use_cache = (
+            self.pixel_cache is not None
+            and image_ids is not None
+            and len(images) > 0
+            and hasattr(self.processor, "image_token")
+        )
+
+        if not use_cache:
+            return self.processor(
+                text=prompts,
+                images=images or None,
+                padding=True,
+                return_tensors="pt"
+            )
+
+        hits = sum(doc_id in self.pixel_cache for doc_id in image_ids)
+        count(self.metrics, "pixel_cache_hits", hits)
+        count(self.metrics, "pixel_cache_misses", len(image_ids) - hits)
+
+        pixel_values = self.pixel_cache.get_or_compute(
+            image_ids,
+            images,
+            lambda batch: self.processor.image_processor(
+                images=batch, return_tensors="pt"
+            )["pixel_values"]
+        )
+
+        inputs = self.processor.tokenizer(
+            [self._expand_image_tokens(p, pixel_values) for p in prompts],
+            padding=True,
+            return_tensors="pt"
+        )
+        inputs = dict(inputs)
+        inputs["pixel_values"] = pixel_values.to(self.torch_dtype)
+        return inputs
+
+    def _prefix_kv(self, prefix: str, images, image_ids, input_ids):
+        """
+        KV cache for `prefix`, computed once per (prefix, image doc ids) and
+        kept in an LRU of `prefix_cache_size` entries. All images must be
+        placed inside the prefix. Returns (cache, prefix length) or
+        (None, 0) when the prefix can't be reused for this prompt.
+        """
+        if images and image_ids is None:
+            return None, 0
+
+        key = (prefix, tuple(image_ids or ()))
+
+        if key in self._prefix_cache:
+            count(self.metrics, "prefix_cache_hits")
+        else:
+            count(self.metrics, "prefix_cache_misses")
+            prefix_inputs = self._prepare_inputs([prefix], images, image_ids)
+            prefix_inputs = {k: v.to(self.model.device) for k, v in prefix_inputs.items()}
+
+            with torch.no_grad():
+                out = self.model(**prefix_inputs, use_cache=True)
+
+            prefix_ids = prefix_inputs["input_ids"]
+            self._prefix_cache[key] = (prefix_ids, out.past_key_values)
+
+            while len(self._prefix_cache) > self.prefix_cache_size:
+                self._prefix_cache.popitem(last=False)
+
+        self._prefix_cache.move_to_end(key)
+        prefix_ids, cache = self._prefix_cache[key]
+
+        # The prompt must tokenize to the prefix tokens plus at least one more
+        length = prefix_ids.shape[1]
+        if input_ids.shape[1] <= length or not torch.equal(input_ids[:, :length], prefix_ids):
+            return None, 0
+
+        return cache, length
+
+    def _stopping_criteria(self, prompt_length: int):
+        if not self.short_answer:
+            return None
+
+        from transformers import StoppingCriteriaList
+        return StoppingCriteriaList(
+            [_AnswerEndCriteria(self.processor.tokenizer, prompt_length)]
+        )
+
+    def _decode(self, new_tokens) -> list:
+        """
+        Decode generated tokens (without the prompt) into answers, cut at
+        the answer end in short-answer mode.
+        """
+        answers = []
+        for text in self.processor.batch_decode(new_tokens, skip_special_tokens=True):
+            if self.short_answer:
+                end = answer_end(text)
+                if end is not None:
+                    text = text[:end]
+            answers.append(text.strip())
+        return answers
+
     def generate(
         self,
         prompt: str,
         images=None,
         max_new_tokens: int = 128,
         do_sample: bool = False,
+        temperature: float = 0.7,
+        image_ids=None,
+        prefix: str = None
+    ):
+        """
+        Generate a response given a prompt and optional images; only the
+        newly generated text is returned. `image_ids` (doc ids of
+        `images`) enable the pixel cache.
+
+        If `prefix` is given (a leading part of `prompt` that contains all
+        image placeholders) and prefix caching is enabled, the prefix KV
+        cache is reused across calls and only the rest of the prompt is
+        encoded.
+        """
+
+        with span(self.metrics, "processor"):
+            inputs = self._prepare_inputs([prompt], images or [], image_ids)
+
+            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+
+        prompt_length = inputs["input_ids"].shape[1]
+
+        cache, prefix_length = None, 0
+        if prefix is not None and self.prefix_cache_size > 0:
+            with span(self.metrics, "prefix_cache"):
+                cache, prefix_length = self._prefix_kv(
+                    prefix, images or [], image_ids, inputs["input_ids"]
+                )
+
+        if cache is not None:
+            # Image features already live in the cached keys/values
+            inputs.pop("pixel_values", None)
+
+        try:
+            with span(self.metrics, "generate"), torch.no_grad():
+                output_ids = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=do_sample,
+                    temperature=temperature if do_sample else None,
+                    past_key_values=cache,
+                    stopping_criteria=self._stopping_criteria(prompt_length)
+                )
+        finally:
+            if cache is not None:
+                # Drop this call's tokens so the cache holds the prefix only
+                cache.crop(prefix_length)
+
+        new_tokens = output_ids[:, prompt_length:]
+        count(self.metrics, "tokens_generated", new_tokens.shape[1])
+
+        with span(self.metrics, "decode"):
+            return self._decode(new_tokens)[0]
+
+    def sequence_length(self, prompt: str, num_images: int = 0) -> int:
+        """
+        Approximate input length of a prompt, used to group similar-length
+        prompts into the same generation batch.
+        """
+        num_text_tokens = len(self.processor.tokenizer(prompt)["input_ids"])
+        return num_text_tokens + num_images * self.IMAGE_TOKEN_ESTIMATE
+
+    def generate_batch(
+        self,
+        items: list,
+        max_new_tokens: int = 128,
+        do_sample: bool = False,
         temperature: float = 0.7
     ):
         """
-        Generate a response given a prompt and optional images.
+        Generate responses for a batch of (prompt, images) or
+        (prompt, images, image_ids) tuples.
+
+        Items may carry different numbers of images. Prompts are left-padded
+        so that generation continues right after each prompt, and only the
+        newly generated tokens are decoded. In short-answer mode each row
+        stops at its answer end, and generation ends once all rows have.
         """
+        prompts = [item[0] for item in items]
+        flat_images = [img for item in items for img in (item[1] or [])]
 
-        inputs = self.processor(
-            text=prompt,
-            images=images,
-            return_tensors="pt"
-        )
+        flat_ids = None
+        if all(len(item) > 2 and item[2] is not None for item in items):
+            flat_ids = [doc_id for item in items for doc_id in item[2]]
+
+        tokenizer = self.processor.tokenizer
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+
+        with span(self.metrics, "processor"):
+            try:
+                inputs = self._prepare_inputs(prompts, flat_images, flat_ids)
+            finally:
+                tokenizer.padding_side = padding_side
 
-        inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
+            inputs = {k: v.to(self.model.device) for k, v in inputs.items()}
 
-        with torch.no_grad():
+        prompt_length = inputs["input_ids"].shape[1]
+
+        with span(self.metrics, "generate"), torch.no_grad():
             output_ids = self.model.generate(
                 **inputs,
                 max_new_tokens=max_new_tokens,
                 do_sample=do_sample,
-                temperature=temperature if do_sample else None
+                temperature=temperature if do_sample else None,
+                pad_token_id=tokenizer.pad_token_id,
+                stopping_criteria=self._stopping_criteria(prompt_length)
             )
 
-        return self.processor.decode(output_ids[0], skip_special_tokens=True)
\ No newline at end of file
+        new_tokens = output_ids[:, prompt_length:]
+        count(self.metrics, "tokens_generated", int((new_tokens != tokenizer.pad_token_id).sum()))
+
+        with span(self.metrics, "decode"):
+            return self._decode(new_tokens)
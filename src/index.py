@@ -0,0 +1,341 @@
+import os
+import json
+import gzip
+import argparse
+import numpy as np
+from tqdm import tqdm
+from src.utils import load_images_from_metadata
+
+
+class IVFIndex:
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index for
+    inner-product search over normalized embeddings, in pure NumPy.
+
+    Vectors are assigned to the nearest of `nlist` k-means centroids; a query
+    only scores the vectors in its `nprobe` closest lists, so search cost
+    grows with nprobe / nlist of the corpus instead of the whole corpus.
+    """
+
+    def __init__(self, dim: int, nlist: int = 256, nprobe: int = 8):
+        self.dim = dim
+        self.nlist = nlist
+        self.nprobe = nprobe
+
+        self.centroids = None
+        self.vectors = np.empty((0, dim), dtype=np.float16)
+        self.assign = np.empty((0,), dtype=np.int32)
+        self.ids = []
+        self.lists = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.centroids is not None
+
+    def _assign(self, vectors, chunk_size: int = 65536):
+        out = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk_size):
+            block = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+            out[start:start + chunk_size] = (block @ self.centroids.T).argmax(axis=1)
+        return out
+
+    def train(self, vectors, iters: int = 20, max_train: int = 50000, seed: int = 0):
+        """
+        Spherical k-means over (a sample of) `vectors` to fit the centroids.
+        """
+        rng = np.random.default_rng(seed)
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        if len(vectors) > max_train:
+            vectors = vectors[rng.choice(len(vectors), max_train, replace=False)]
+
+        self.nlist = min(self.nlist, len(vectors))
+        self.centroids = vectors[rng.choice(len(vectors), self.nlist, replace=False)].copy()
+
+        for _ in range(iters):
+            assign = self._assign(vectors)
+
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assign, vectors)
+            counts = np.bincount(assign, minlength=self.nlist)
+
+            # Re-seed empty lists with random training points
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            self.centroids = sums / np.maximum(norms, 1e-12)
+
+        self.lists = [np.empty((0,), dtype=np.int64) for _ in range(self.nlist)]
+        return self
+
+    def add(self, ids, vectors):
+        """
+        Insert vectors incrementally. The index must already be trained.
+        """
+        if not self.is_trained:
+            raise RuntimeError("IVFIndex must be trained before adding vectors")
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(ids) != len(vectors):
+            raise ValueError("ids and vectors must have the same length")
+
+        offset = len(self.ids)
+        assign = self._assign(vectors)
+
+        self.vectors = np.concatenate([self.vectors, vectors.astype(np.float16)])
+        self.assign = np.concatenate([self.assign, assign])
+        self.ids.extend(ids)
+
+        rows = np.arange(offset, offset + len(ids))
+        for c in np.unique(assign):
+            self.lists[c] = np.concatenate([self.lists[c], rows[assign == c]])
+
+    def search(self, queries, k: int, nprobe: int = None):
+        """
+        Return (scores, ids) of the approximate top-k for each query.
+        Each is a list with one entry per query, best first.
+        """
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+
+        coarse = queries @ self.centroids.T
+        probes = np.argpartition(-coarse, nprobe - 1, axis=1)[:, :nprobe]
+
+        all_scores, all_ids = [], []
+        for q, probe in zip(queries, probes):
+            rows = np.concatenate([self.lists[c] for c in probe])
+            if len(rows) == 0:
+                all_scores.append([])
+                all_ids.append([])
+                continue
+
+            scores = self.vectors[rows].astype(np.float32) @ q
+            top = min(k, len(rows))
+            best = np.argpartition(-scores, top - 1)[:top]
+            best = best[np.argsort(-scores[best])]
+
+            all_scores.append(scores[best].tolist())
+            all_ids.append([self.ids[r] for r in rows[best]])
+
+        return all_scores, all_ids
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.savez(
+            os.path.join(path, "index.npz"),
+            centroids=self.centroids,
+            vectors=self.vectors,
+            assign=self.assign
+        )
+        with open(os.path.join(path, "ids.json"), "w") as f:
+            json.dump({"nprobe": self.nprobe, "ids": self.ids}, f)
+
+    @classmethod
+    def load(cls, path: str):
+        arrays = np.load(os.path.join(path, "index.npz"))
+        with open(os.path.join(path, "ids.json"), "r") as f:
+            meta = json.load(f)
+
+        centroids = arrays["centroids"]
+        index = cls(centroids.shape[1], nlist=len(centroids), nprobe=meta["nprobe"])
+        index.centroids = centroids
+        index.vectors = arrays["vectors"]
+        index.assign = arrays["assign"]
+        index.ids = meta["ids"]
+
+        order = np.argsort(index.assign, kind="stable")
+        bounds = np.searchsorted(index.assign[order], np.arange(index.nlist + 1))
+        index.lists = [order[bounds[c]:bounds[c + 1]] for c in range(index.nlist)]
+        return index
+
+
+class CorpusIndex:
+    """
+    Open-corpus retrieval index over every MMQA image and caption.
+
+    Holds one IVFIndex for image embeddings and one for caption embeddings,
+    plus the caption text for each caption id so retrieved captions can be
+    placed in the prompt, and the image path for each image id in the
+    `image_metadata` layout used by `load_images_from_metadata`.
+    Poisoned captions can be inserted after the index is built
+    (see `add_texts`).
+    """
+
+    def __init__(
+        self,
+        image_index: IVFIndex,
+        text_index: IVFIndex,
+        captions: dict,
+        image_paths: dict
+    ):
+        self.image_index = image_index
+        self.text_index = text_index
+        self.captions = captions
+        self.image_paths = image_paths
+
+    def add_texts(self, retriever, ids, texts):
+        """
+        Encode and insert new caption entries, e.g. poisoned captions.
+        """
+        embs = retriever.encode_text(texts).float().cpu().numpy()
+        self.text_index.add(ids, embs)
+        self.captions.update(zip(ids, texts))
+
+    def search_images(self, query_emb, k: int):
+        scores, ids = self.image_index.search(query_emb.float().cpu().numpy(), k)
+        return ids[0], scores[0]
+
+    def search_texts(self, query_emb, k: int):
+        scores, ids = self.text_index.search(query_emb.float().cpu().numpy(), k)
+        return ids[0], scores[0]
+
+    def save(self, path: str):
+        self.image_index.save(os.path.join(path, "images"))
+        self.text_index.save(os.path.join(path, "texts"))
+        with open(os.path.join(path, "captions.json"), "w", encoding="utf-8") as f:
+            json.dump(self.captions, f)
+        with open(os.path.join(path, "image_paths.json"), "w") as f:
+            json.dump(self.image_paths, f)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(os.path.join(path, "captions.json"), "r", encoding="utf-8") as f:
+            captions = json.load(f)
+        with open(os.path.join(path, "image_paths.json"), "r") as f:
+            image_paths = json.load(f)
+
+        return cls(
+            IVFIndex.load(os.path.join(path, "images")),
+            IVFIndex.load(os.path.join(path, "texts")),
+            captions,
+            image_paths
+        )
+
+    @classmethod
+    def build(
+        cls,
+        retriever,
+        images_jsonl: str,
+        image_metadata: dict,
+        image_dir: str,
+        embedding_store=None,
+        nlist: int = 256,
+        nprobe: int = 8,
+        batch_size: int = 256
+    ):
+        """
+        Build image and caption indexes over the full MMQA image corpus.
+
+        Captions come from `image_metadata` where available and fall back to
+        the Wikipedia title in MMQA_images.jsonl.gz. Image embeddings are
+        taken from `embedding_store` where it has them; every other corpus
+        image is encoded here.
+        """
+        corpus = {}
+        with gzip.open(images_jsonl, "rt", encoding="utf-8") as f:
+            for line in f:
+                ex = json.loads(line)
+                corpus[ex["id"]] = ex
+
+        for doc_id, meta in image_metadata.items():
+            corpus.setdefault(doc_id, {"id": doc_id, "path": meta["path"]})
+
+        image_paths = {
+            doc_id: {"path": image_metadata.get(doc_id, ex)["path"]}
+            for doc_id, ex in corpus.items()
+        }
+
+        captions = {}
+        for doc_id, ex in corpus.items():
+            meta = image_metadata.get(doc_id, {})
+            caption = meta.get("caption") or ex.get("title")
+            if caption:
+                captions[doc_id] = caption
+
+        print(f"Encoding {len(captions)} captions...")
+        caption_ids = list(captions.keys())
+        text_embs = retriever.encode_text(
+            [captions[i] for i in caption_ids]
+        ).float().cpu().numpy()
+
+        text_index = IVFIndex(text_embs.shape[1], nlist=nlist, nprobe=nprobe)
+        text_index.train(text_embs)
+        text_index.add(caption_ids, text_embs)
+
+        # Stored embeddings cover only the images in image_metadata; the
+        # rest of the corpus is encoded here
+        all_ids = list(image_paths.keys())
+        image_ids, parts = [], []
+        if embedding_store is not None:
+            stored = [i for i in all_ids if i in embedding_store]
+            if stored:
+                rows = np.array([embedding_store.id_to_row[i] for i in stored], dtype=np.int64)
+                parts.append(np.asarray(embedding_store.embeddings[rows], dtype=np.float32))
+                image_ids.extend(stored)
+            all_ids = [i for i in all_ids if i not in embedding_store]
+            print(f"Using {len(stored)} stored image embeddings")
+
+        print(f"Encoding {len(all_ids)} images...")
+        for start in tqdm(range(0, len(all_ids), batch_size)):
+            images, valid_ids = load_images_from_metadata(
+                image_dir, all_ids[start:start + batch_size], image_paths
+            )
+            if images:
+                parts.append(retriever.encode_images(images).float().cpu().numpy())
+                image_ids.extend(valid_ids)
+        image_embs = np.concatenate(parts)
+
+        image_index = IVFIndex(image_embs.shape[1], nlist=nlist, nprobe=nprobe)
+        image_index.train(image_embs)
+        image_index.add(image_ids, image_embs)
+
+        print(f"Indexed {len(image_index)} images and {len(text_index)} captions")
+        return cls(image_index, text_index, captions, image_paths)
+
+
+def main():
+    from src.retriever import Retriever
+    from src.embedding_store import ImageEmbeddingStore
+
+    parser = argparse.ArgumentParser(
+        description="Build the open-corpus ANN index over MMQA images and captions."
+    )
+    parser.add_argument("--images-jsonl", default="datasets/mmqa/MMQA_images.jsonl.gz")
+    parser.add_argument("--metadata", default="datasets/mmqa-mmpoisonrag/MMQA_image_metadata.json")
+    parser.add_argument("--image-dir", default="datasets/mmqa/final_dataset_images")
+    parser.add_argument("--store-dir", default="cache/embeddings")
+    parser.add_argument("--output", default="cache/corpus_index")
+    parser.add_argument("--retriever", default="openai/clip-vit-base-patch32")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--nprobe", type=int, default=8)
+    args = parser.parse_args()
+
+    with open(args.metadata, "r") as f:
+        image_metadata = json.load(f)
+
+    retriever = Retriever(model_id=args.retriever, cache_dir=args.cache_dir)
+
+    embedding_store = ImageEmbeddingStore(args.store_dir, args.retriever)
+    embedding_store = embedding_store.load() if embedding_store.exists() else None
+
+    index = CorpusIndex.build(
+        retriever,
+        args.images_jsonl,
+        image_metadata,
+        args.image_dir,
+        embedding_store=embedding_store,
+        nlist=args.nlist,
+        nprobe=args.nprobe
+    )
+    index.save(args.output)
+    print(f"Saved corpus index to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+
+
+def span(metrics, stage: str):
+    """
+    `metrics.span(stage)`, or a no-op context when metrics are disabled.
+    """
+    return metrics.span(stage) if metrics is not None else nullcontext()
+
+
+def count(metrics, name: str, n=1):
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+def _cuda():
+    """
+    torch.cuda if torch is already loaded and a GPU is available, else
+    None. Never imports torch itself.
+    """
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        return torch.cuda
+    return None
+
+
+def peak_memory_bytes() -> int:
+    """
+    Peak CUDA memory allocated when a GPU is in use, otherwise the peak
+    resident set size of this process.
+    """
+    cuda = _cuda()
+    if cuda is not None:
+        return int(cuda.max_memory_allocated())
+    # ru_maxrss is in kilobytes on Linux
+    return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+
+
+class RunMetrics:
+    """
+    Per-stage timings and counters for a RAG run.
+
+    Stages are timed with `span(stage)` and counters bumped with
+    `count(name, n)`. Both accumulate into run totals and, inside a
+    `question()` block, into that question's record. Work done for a whole
+    generation batch is collected with `batch()` and split evenly over the
+    batch's questions with `share()`.
+    """
+
+    # Stage whose time tokens/sec is measured against
+    GENERATE_STAGE = "generate"
+
+    def __init__(self):
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.counters = defaultdict(float)
+        self.questions = 0
+        self.start_time = time.perf_counter()
+        self._records = []
+
+    @staticmethod
+    def _new_record():
+        return {"stages": defaultdict(float), "counters": defaultdict(float)}
+
+    @contextmanager
+    def span(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage: str, seconds: float):
+        self.stage_seconds[stage] += seconds
+        self.stage_calls[stage] += 1
+        for record in self._records:
+            record["stages"][stage] += seconds
+
+    def count(self, name: str, n=1):
+        self.counters[name] += n
+        for record in self._records:
+            record["counters"][name] += n
+
+    @contextmanager
+    def question(self, record=None):
+        """
+        Collect the spans and counters of one question into a record.
+        Passing a record returned by an earlier `question()` block resumes
+        it instead of starting a new question.
+        """
+        new = record is None
+        if new:
+            record = self._new_record()
+            self.questions += 1
+            cuda = _cuda()
+            if cuda is not None:
+                cuda.reset_peak_memory_stats()
+
+        self._records.append(record)
+        try:
+            yield record
+        finally:
+            self._records.remove(record)
+            self._finish(record)
+
+    @contextmanager
+    def batch(self):
+        """
+        Collect the spans and counters of a batched call without counting
+        a question; pass the record to `share()` afterwards.
+        """
+        record = self._new_record()
+        self._records.append(record)
+        try:
+            yield record
+        finally:
+            self._records.remove(record)
+
+    def share(self, batch_record, question_records):
+        """
+        Add an equal share of a batch record to each question record.
+        """
+        n = len(question_records)
+        for record in question_records:
+            for stage, seconds in batch_record["stages"].items():
+                record["stages"][stage] += seconds / n
+            for name, value in batch_record["counters"].items():
+                record["counters"][name] += value / n
+            self._finish(record)
+
+    def _finish(self, record):
+        tokens = record["counters"].get("tokens_generated", 0)
+        seconds = record["stages"].get(self.GENERATE_STAGE, 0)
+        record["tokens_per_sec"] = tokens / seconds if seconds else 0.0
+        record["peak_memory_bytes"] = peak_memory_bytes()
+
+    @staticmethod
+    def to_dict(record) -> dict:
+        """
+        JSON-friendly copy of a question record.
+        """
+        return {
+            "stages": dict(record["stages"]),
+            "counters": dict(record["counters"]),
+            "tokens_per_sec": record.get("tokens_per_sec", 0.0),
+            "peak_memory_bytes": record.get("peak_memory_bytes", 0),
+        }
+
+    def summary(self) -> dict:
+        wall = time.perf_counter() - self.start_time
+        generate_seconds = self.stage_seconds.get(self.GENERATE_STAGE, 0)
+        tokens = self.counters.get("tokens_generated", 0)
+
+        return {
+            "questions": self.questions,
+            "wall_seconds": wall,
+            "questions_per_sec": self.questions / wall if wall else 0.0,
+            "stages": {
+                stage: {
+                    "seconds": seconds,
+                    "calls": self.stage_calls[stage],
+                    "mean_ms": seconds / self.stage_calls[stage] * 1e3,
+                    "share_of_wall": seconds / wall if wall else 0.0,
+                }
+                for stage, seconds in sorted(self.stage_seconds.items())
+            },
+            "counters": dict(sorted(self.counters.items())),
+            "tokens_per_sec": tokens / generate_seconds if generate_seconds else 0.0,
+            "peak_memory_bytes": peak_memory_bytes(),
+        }
+
+    def write_json(self, path: str):
+        _atomic_write(path, json.dumps(self.summary(), indent=2))
+
+    def write_prometheus(self, path: str, labels: dict = None):
+        """
+        Write the summary in the Prometheus text format, for the
+        node_exporter textfile collector.
+        """
+        summary = self.summary()
+        base = dict(labels or {})
+
+        def fmt(extra=None):
+            merged = {**base, **(extra or {})}
+            if not merged:
+                return ""
+            inner = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(merged.items()))
+            return "{" + inner + "}"
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for extra, value in samples:
+                lines.append(f"{name}{fmt(extra)} {value}")
+
+        metric("rag_questions_total", "counter", "Questions processed.",
+               [(None, summary["questions"])])
+        metric("rag_wall_seconds", "gauge", "Wall time since the run started.",
+               [(None, summary["wall_seconds"])])
+        metric("rag_stage_seconds_total", "counter", "Time spent per pipeline stage.",
+               [({"stage": s}, v["seconds"]) for s, v in summary["stages"].items()])
+        metric("rag_stage_calls_total", "counter", "Calls per pipeline stage.",
+               [({"stage": s}, v["calls"]) for s, v in summary["stages"].items()])
+        metric("rag_events_total", "counter", "Event counters (tokens, cache hits, ...).",
+               [({"name": n}, v) for n, v in summary["counters"].items()])
+        metric("rag_tokens_per_second", "gauge", "Generated tokens per second of generate time.",
+               [(None, summary["tokens_per_sec"])])
+        metric("rag_peak_memory_bytes", "gauge", "Peak GPU memory, or peak RSS without a GPU.",
+               [(None, summary["peak_memory_bytes"])])
+
+        _atomic_write(path, "\n".join(lines) + "\n")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _atomic_write(path: str, text: str):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
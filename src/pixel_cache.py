@@ -0,0 +1,184 @@
+import os
+import json
+import uuid
+import fcntl
+import argparse
+import numpy as np
+import torch
+from tqdm import tqdm
+from src.utils import load_images_from_metadata
+
+
+class PixelValueCache:
+    """
+    On-disk cache of processor outputs (`pixel_values`) per image.
+
+    Entries are keyed by (processor id, image doc_id): each processor gets
+    its own sub-directory holding float16 `.npy` shards, memory-mapped on
+    read, and an index mapping doc_id -> (shard, row). New entries are
+    buffered in memory and written out as a new shard every `shard_size`
+    images and on `flush()`.
+
+    Several processes (e.g. run_rag shards) can share one cache directory:
+    each writes shards under its own unique name and merges its entries
+    into the index under a file lock.
+    """
+
+    INDEX_FILE = "index.json"
+    LOCK_FILE = "index.lock"
+
+    def __init__(self, root: str, processor_id: str, shard_size: int = 256):
+        self.root = root
+        self.processor_id = processor_id
+        self.shard_size = shard_size
+        self.cache_dir = os.path.join(root, processor_id.replace("/", "__"))
+        self.index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        self.lock_path = os.path.join(self.cache_dir, self.LOCK_FILE)
+
+        # Prefix of the shards written by this instance, unique across
+        # processes sharing the directory
+        self.writer_id = f"{os.getpid()}_{uuid.uuid4().hex[:8]}"
+        self.num_written = 0
+
+        self.index = self._read_index()
+        self._shards = {}
+        self._pending = {}
+
+    def _read_index(self) -> dict:
+        if not os.path.exists(self.index_path):
+            return {}
+        with open(self.index_path, "r") as f:
+            meta = json.load(f)
+        return {k: tuple(v) for k, v in meta["index"].items()}
+
+    def __len__(self):
+        return len(self.index) + len(self._pending)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.index or doc_id in self._pending
+
+    def _shard_path(self, shard) -> str:
+        # Indexes written before shards were named per writer use numbers
+        if isinstance(shard, int):
+            shard = f"{shard:05d}"
+        return os.path.join(self.cache_dir, f"shard_{shard}.npy")
+
+    def _shard(self, shard: str):
+        if shard not in self._shards:
+            self._shards[shard] = np.load(self._shard_path(shard), mmap_mode="r")
+        return self._shards[shard]
+
+    def get(self, doc_id):
+        """
+        Cached pixel_values of one image as a float16 array, or None.
+        """
+        if doc_id in self._pending:
+            return self._pending[doc_id]
+        if doc_id in self.index:
+            shard, row = self.index[doc_id]
+            return self._shard(shard)[row]
+        return None
+
+    def put(self, doc_ids, pixel_values):
+        pixel_values = pixel_values.detach().to("cpu", torch.float16).numpy()
+        for doc_id, pv in zip(doc_ids, pixel_values):
+            self._pending[doc_id] = pv
+
+        if len(self._pending) >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write buffered entries to a new shard and merge them into the
+        on-disk index, together with entries other writers added since
+        it was last read.
+        """
+        if not self._pending:
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        doc_ids = list(self._pending.keys())
+        shard = f"{self.writer_id}_{self.num_written:05d}"
+        np.save(self._shard_path(shard), np.stack([self._pending[d] for d in doc_ids]))
+        self.num_written += 1
+
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self._read_index()
+                for row, doc_id in enumerate(doc_ids):
+                    index[doc_id] = (shard, row)
+
+                tmp_path = f"{self.index_path}.{self.writer_id}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump({
+                        "processor_id": self.processor_id,
+                        "index": index
+                    }, f)
+                os.replace(tmp_path, self.index_path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.index = index
+        self._pending = {}
+
+    def get_or_compute(self, doc_ids, images, compute, dtype=torch.float32):
+        """
+        pixel_values for `images` (one per doc_id) as a single tensor.
+        Cached entries are read from disk; `compute(images)` is called only
+        for the misses, whose results are added to the cache.
+        """
+        cached = [self.get(d) for d in doc_ids]
+        missing = [i for i, pv in enumerate(cached) if pv is None]
+
+        if missing:
+            computed = compute([images[i] for i in missing])
+            self.put([doc_ids[i] for i in missing], computed)
+            # Re-read so fresh entries carry the same float16 rounding
+            # as entries loaded from disk on later runs
+            for i in missing:
+                cached[i] = self.get(doc_ids[i])
+
+        return torch.stack([
+            torch.as_tensor(np.asarray(pv)).to(dtype)
+            for pv in cached
+        ])
+
+
+def main():
+    from transformers import AutoProcessor
+
+    parser = argparse.ArgumentParser(
+        description="Precompute processor pixel_values for every image."
+    )
+    parser.add_argument("--processor", required=True, help="HF model id, e.g. openai/clip-vit-base-patch32")
+    parser.add_argument("--metadata", default="datasets/mmqa-mmpoisonrag/MMQA_image_metadata.json")
+    parser.add_argument("--image-dir", default="datasets/mmqa/final_dataset_images")
+    parser.add_argument("--cache-root", default="cache/pixel_values")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    with open(args.metadata, "r") as f:
+        image_metadata = json.load(f)
+
+    processor = AutoProcessor.from_pretrained(args.processor, cache_dir=args.cache_dir)
+    image_processor = getattr(processor, "image_processor", processor)
+
+    cache = PixelValueCache(args.cache_root, args.processor)
+    todo = [d for d in image_metadata if d not in cache]
+
+    for start in tqdm(range(0, len(todo), args.batch_size)):
+        images, valid_ids = load_images_from_metadata(
+            args.image_dir, todo[start:start + args.batch_size], image_metadata
+        )
+        if images:
+            cache.put(valid_ids, image_processor(images=images, return_tensors="pt")["pixel_values"])
+
+    cache.flush()
+    print(f"Cached pixel_values for {len(cache)} images at {cache.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+from contextlib import nullcontext
+from src.metrics import RunMetrics, span, count
+
+
 class RAGModel:
     """
     Multimodal RAG wrapper that orchestrates retrieval and generation.
@@ -8,35 +12,288 @@ class RAGModel:
         retriever,
         generator,
         top_k_images: int = 3,
-        top_k_texts: int = 3
+        top_k_texts: int = 3,
+        embedding_store=None,
+        corpus_index=None,
+        generation_cache=None,
+        caption_store=None,
+        metrics=None
     ):
+        """
+        caption_store: optional CaptionEmbeddingStore; pool captions found
+                       in it are not re-encoded
+        metrics:       optional RunMetrics; when set, every output of
+                       generate, generate_batch and generate_corpus carries
+                       a per-question "metrics" record of stage timings and
+                       counters
+        """
         self.retriever = retriever
         self.generator = generator
         self.top_k_images = top_k_images
         self.top_k_texts = top_k_texts
+        self.embedding_store = embedding_store
+        self.corpus_index = corpus_index
+        self.generation_cache = generation_cache
+        self.caption_store = caption_store
+        self.metrics = metrics
+
+    def _question(self, record=None):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.question(record)
+
+    def _batch(self):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.batch()
+
+    def _attach_metrics(self, output, record):
+        if record is not None:
+            output["metrics"] = RunMetrics.to_dict(record)
+        return output
+
+    def encode_images(self, images: list, image_ids: list = None):
+        """
+        Image embeddings for a candidate pool.
+        Rows found in the embedding store are gathered from disk; only
+        images missing from the store go through the vision tower.
+        """
+        if self.embedding_store is None or image_ids is None:
+            count(self.metrics, "images_encoded", len(images))
+            return self.retriever.encode_images(images, image_ids)
+
+        missing = [i for i, d in enumerate(image_ids) if d not in self.embedding_store]
+        count(self.metrics, "images_encoded", len(missing))
+        count(self.metrics, "embedding_store_hits", len(image_ids) - len(missing))
+
+        if not missing:
+            return self.embedding_store.gather(image_ids, device=self.retriever.device)
+
+        missing_embs = self.retriever.encode_images(
+            [images[i] for i in missing],
+            [image_ids[i] for i in missing]
+        )
+        found = [i for i, d in enumerate(image_ids) if d in self.embedding_store]
+
+        image_embs = missing_embs.new_empty((len(image_ids), missing_embs.shape[1]))
+        image_embs[missing] = missing_embs
+        if found:
+            image_embs[found] = self.embedding_store.gather(
+                [image_ids[i] for i in found],
+                device=image_embs.device,
+                dtype=image_embs.dtype
+            )
+        return image_embs
+
+    def encode_texts(self, texts: list, text_ids: list = None):
+        """
+        Text embeddings for a caption pool. Captions in the caption store
+        are gathered from disk; only the rest (e.g. poisoned captions) go
+        through the text encoder. `text_ids` (doc id of the image each
+        caption describes, None for poisoned captions) lets the store find
+        rows by id instead of by text.
+        """
+        if self.caption_store is None:
+            count(self.metrics, "texts_encoded", len(texts))
+            return self.retriever.encode_text(texts)
+
+        rows = self.caption_store.rows_of(texts, text_ids)
+        missing = [i for i, r in enumerate(rows) if r < 0]
+        found = [i for i, r in enumerate(rows) if r >= 0]
+        count(self.metrics, "texts_encoded", len(missing))
+        count(self.metrics, "caption_store_hits", len(found))
+
+        if not missing:
+            return self.caption_store.gather_rows(rows, device=self.retriever.device)
+
+        missing_embs = self.retriever.encode_text([texts[i] for i in missing])
+
+        text_embs = missing_embs.new_empty((len(texts), missing_embs.shape[1]))
+        text_embs[missing] = missing_embs
+        if found:
+            text_embs[found] = self.caption_store.gather_rows(
+                rows[found],
+                device=text_embs.device,
+                dtype=text_embs.dtype
+            )
+        return text_embs
 
     def retrieve(
         self,
         question: str,
         images: list,
-        texts: list
+        texts: list,
+        image_ids: list = None,
+        text_ids: list = None
     ):
         """
         Retrieve top-k image and text indices given a question.
         """
-        query_emb = self.retriever.encode_text([question])
+        with span(self.metrics, "text_encode"):
+            query_emb = self.retriever.encode_text([question])
 
-        image_embs = self.retriever.encode_images(images)
-        text_embs  = self.retriever.encode_text(texts)
+        with span(self.metrics, "image_encode"):
+            image_embs = self.encode_images(images, image_ids)
+        with span(self.metrics, "text_encode"):
+            text_embs  = self.encode_texts(texts, text_ids)
 
-        image_scores = self.retriever.score_images(query_emb, image_embs)[0]
-        text_scores  = self.retriever.score_texts(query_emb, text_embs)[0]
+        with span(self.metrics, "scoring"):
+            image_scores = self.retriever.score_images(query_emb, image_embs)[0]
+            text_scores  = self.retriever.score_texts(query_emb, text_embs)[0]
 
-        top_image_idx = image_scores.topk(self.top_k_images).indices.tolist()
-        top_text_idx  = text_scores.topk(self.top_k_texts).indices.tolist()
+            # Pools smaller than k return all of their candidates
+            top_image_idx = image_scores.topk(
+                min(self.top_k_images, len(image_scores))
+            ).indices.tolist()
+            top_text_idx  = text_scores.topk(
+                min(self.top_k_texts, len(text_scores))
+            ).indices.tolist()
 
         return top_image_idx, top_text_idx, image_scores, text_scores
 
+    @staticmethod
+    def _shared_rows(pools, keys):
+        """
+        Lay the candidates of several pools out as rows of one shared list.
+        Candidates with the same key share a row; pools without keys share
+        nothing. Returns (unique items, their keys, row indices per pool).
+        """
+        row_of = {}
+        items, item_keys, rows = [], [], []
+
+        for pool, pool_keys in zip(pools, keys):
+            pool_rows = []
+            for j, item in enumerate(pool):
+                key = pool_keys[j] if pool_keys is not None else None
+                if key is not None and key in row_of:
+                    pool_rows.append(row_of[key])
+                    continue
+                if key is not None:
+                    row_of[key] = len(items)
+                pool_rows.append(len(items))
+                items.append(item)
+                item_keys.append(key)
+            rows.append(pool_rows)
+
+        return items, item_keys, rows
+
+    @staticmethod
+    def _masked_topk(scores, rows, k):
+        """
+        Gather each query's candidate scores from a (queries x shared rows)
+        score matrix into a padded, masked (queries x pool) matrix and take
+        the top-k of every row at once. Returns per-query (top indices,
+        scores in pool order).
+        """
+        import torch
+
+        width = max((len(r) for r in rows), default=0)
+        index = torch.zeros((len(rows), width), dtype=torch.long)
+        mask = torch.zeros((len(rows), width), dtype=torch.bool)
+        for i, r in enumerate(rows):
+            index[i, :len(r)] = torch.tensor(r, dtype=torch.long)
+            mask[i, :len(r)] = True
+
+        index, mask = index.to(scores.device), mask.to(scores.device)
+        pool_scores = scores.gather(1, index).masked_fill(~mask, float("-inf"))
+        top = pool_scores.topk(min(k, width), dim=1).indices.tolist()
+
+        return [
+            (top[i][:min(k, len(r))], pool_scores[i, :len(r)])
+            for i, r in enumerate(rows)
+        ]
+
+    def retrieve_batch(self, examples: list):
+        """
+        Retrieval for many questions at once.
+
+        `examples` are dicts with question, images, texts and optionally
+        image_ids and text_ids. All questions are encoded together, candidates shared
+        between pools (same image doc id or caption text) are encoded once
+        into one embedding matrix per modality, and each modality is scored
+        with a single matmul followed by a masked, batched top-k. Returns
+        one (top_image_idx, top_text_idx, image_scores, text_scores) tuple
+        per example, as `retrieve` does.
+        """
+        if not examples:
+            return []
+
+        with span(self.metrics, "text_encode"):
+            query_embs = self.retriever.encode_text([ex["question"] for ex in examples])
+
+        images, image_keys, image_rows = self._shared_rows(
+            [ex["images"] for ex in examples],
+            [ex.get("image_ids") for ex in examples]
+        )
+        # Captions are shared by text; each keeps the doc id it came with
+        captions, _, text_rows = self._shared_rows(
+            [
+                list(zip(ex["texts"], ex.get("text_ids") or [None] * len(ex["texts"])))
+                for ex in examples
+            ],
+            [ex["texts"] for ex in examples]
+        )
+        texts = [text for text, _ in captions]
+        text_ids = [doc_id for _, doc_id in captions]
+
+        with span(self.metrics, "image_encode"):
+            image_embs = self.encode_images(
+                images, None if None in image_keys else image_keys
+            )
+        with span(self.metrics, "text_encode"):
+            text_embs = self.encode_texts(texts, text_ids)
+
+        with span(self.metrics, "scoring"):
+            image_results = self._masked_topk(
+                self.retriever.score_images(query_embs, image_embs),
+                image_rows,
+                self.top_k_images
+            )
+            text_results = self._masked_topk(
+                self.retriever.score_texts(query_embs, text_embs),
+                text_rows,
+                self.top_k_texts
+            )
+
+        return [
+            (top_image_idx, top_text_idx, image_scores, text_scores)
+            for (top_image_idx, image_scores), (top_text_idx, text_scores)
+            in zip(image_results, text_results)
+        ]
+
+    def retrieve_corpus(self, question: str):
+        """
+        Retrieve top-k image and caption doc ids for a question from the
+        open-corpus ANN index instead of a per-question candidate pool.
+        """
+        if self.corpus_index is None:
+            raise ValueError("RAGModel was created without a corpus_index")
+
+        with span(self.metrics, "text_encode"):
+            query_emb = self.retriever.encode_text([question])
+
+        with span(self.metrics, "scoring"):
+            image_ids, image_scores = self.corpus_index.search_images(
+                query_emb, self.top_k_images
+            )
+            text_ids, text_scores = self.corpus_index.search_texts(
+                query_emb, self.top_k_texts
+            )
+
+        return image_ids, text_ids, image_scores, text_scores
+
+    def build_prompt_prefix(self, num_images: int) -> str:
+        """
+        The part of the prompt that only depends on the images; the
+        generator can cache its KV across questions.
+        """
+        image_tokens = "<image>" * num_images
+
+        return (
+            f"USER: {image_tokens}\n"
+            "Use the following information to answer the question.\n\n"
+        )
+
     def build_prompt(
         self,
         question: str,
@@ -44,53 +301,252 @@ class RAGModel:
         num_images: int
     ) -> str:
 
-        image_tokens = "<image>" * num_images
+        with span(self.metrics, "prompt_build"):
+            context = "\n".join(f"- {t.strip()}" for t in retrieved_texts)
 
-        context = "\n".join(f"- {t.strip()}" for t in retrieved_texts)
+            return (
+                self.build_prompt_prefix(num_images) +
+                f"{context}\n\n"
+                f"Question: {question}\n\n"
+                "Answer with ONLY the final answer. "
+                "Do NOT include explanations, descriptions, or extra text.\n"
+                "ASSISTANT:"
+            )
 
-        return (
-            f"USER: {image_tokens}\n"
-            "Use the following information to answer the question.\n\n"
-            f"{context}\n\n"
-            f"Question: {question}\n\n"
-            "Answer with ONLY the final answer. "
-            "Do NOT include explanations, descriptions, or extra text.\n"
-            "ASSISTANT:"
+    def _cache_key(self, prompt: str, image_ids, params: dict):
+        """
+        Generation cache key, or None when caching isn't possible
+        (no cache, or images without doc ids).
+        """
+        if self.generation_cache is None or image_ids is None:
+            return None
+
+        return self.generation_cache.key(
+            self.generator.model_id, prompt, image_ids, params
         )
 
+    def _generation_params(self, max_new_tokens):
+        """
+        Decoding parameters that determine an answer, for cache keys.
+        """
+        short_answer = getattr(self.generator, "short_answer", False)
+        return {
+            "max_new_tokens": max_new_tokens,
+            "do_sample": False,
+            "output": "short_answer" if short_answer else "new_tokens",
+        }
+
+    def _generate_one(self, prompt, images, image_ids, max_new_tokens):
+        """
+        Single generator call, served from the generation cache if the
+        same input has been generated before.
+        """
+        key = self._cache_key(prompt, image_ids, self._generation_params(max_new_tokens))
+
+        if key is not None:
+            answer = self.generation_cache.get(key)
+            if answer is not None:
+                count(self.metrics, "generation_cache_hits")
+                return answer
+            count(self.metrics, "generation_cache_misses")
+
+        answer = self.generator.generate(
+            prompt=prompt,
+            images=images,
+            max_new_tokens=max_new_tokens,
+            image_ids=image_ids,
+            prefix=self.build_prompt_prefix(len(images))
+        )
+
+        if key is not None:
+            self.generation_cache.put(key, answer)
+
+        return answer
+
     def generate(
         self,
         question: str,
         images: list,
         texts: list,
-        max_new_tokens: int = 128
+        max_new_tokens: int = 128,
+        image_ids: list = None,
+        text_ids: list = None
     ):
         """
         Full RAG forward pass.
         """
-        top_image_idx, top_text_idx, image_scores, text_scores = self.retrieve(
-            question, images, texts
-        )
+        with self._question() as record:
+            top_image_idx, top_text_idx, image_scores, text_scores = self.retrieve(
+                question, images, texts, image_ids=image_ids, text_ids=text_ids
+            )
 
-        top_images = [images[i] for i in top_image_idx]
-        top_texts  = [texts[i] for i in top_text_idx]
+            top_images = [images[i] for i in top_image_idx]
+            top_texts  = [texts[i] for i in top_text_idx]
+            top_image_ids = [image_ids[i] for i in top_image_idx] if image_ids else None
 
-        prompt = self.build_prompt(
-            question=question,
-            retrieved_texts=top_texts,
-            num_images=len(top_images)
-        )
+            prompt = self.build_prompt(
+                question=question,
+                retrieved_texts=top_texts,
+                num_images=len(top_images)
+            )
 
-        answer = self.generator.generate(
-            prompt=prompt,
-            images=top_images,
-            max_new_tokens=max_new_tokens
-        )
+            answer = self._generate_one(prompt, top_images, top_image_ids, max_new_tokens)
 
-        return {
+        return self._attach_metrics({
             "answer": answer,
             "retrieved_image_indices": top_image_idx,
             "retrieved_text_indices": top_text_idx,
             "image_scores": image_scores[top_image_idx].tolist(),
             "text_scores": text_scores[top_text_idx].tolist(),
-        }
+        }, record)
+
+    def generate_batch(
+        self,
+        examples: list,
+        max_new_tokens: int = 128,
+        batch_size: int = 8
+    ):
+        """
+        Batched RAG forward pass.
+
+        `examples` is a list of dicts with keys question, images, texts and
+        optionally image_ids and text_ids. Retrieval runs for all questions at once
+        (`retrieve_batch`) and the prompts go through `generate_prompts`,
+        which skips cached ones and generates the rest in length-sorted
+        batches of `batch_size` to limit padding. Outputs are returned in
+        input order, in the same format as `generate`.
+        """
+        with self._batch() as retrieval_record:
+            retrieved = self.retrieve_batch(examples)
+
+        prepared = []
+        for ex, (top_image_idx, top_text_idx, image_scores, text_scores) in zip(
+            examples, retrieved
+        ):
+            with self._question() as record:
+                top_images = [ex["images"][i] for i in top_image_idx]
+                top_image_ids = (
+                    [ex["image_ids"][i] for i in top_image_idx]
+                    if ex.get("image_ids") else None
+                )
+                prompt = self.build_prompt(
+                    question=ex["question"],
+                    retrieved_texts=[ex["texts"][i] for i in top_text_idx],
+                    num_images=len(top_images)
+                )
+
+            prepared.append({
+                "prompt": prompt,
+                "images": top_images,
+                "image_ids": top_image_ids,
+                "record": record,
+                "output": {
+                    "retrieved_image_indices": top_image_idx,
+                    "retrieved_text_indices": top_text_idx,
+                    "image_scores": image_scores[top_image_idx].tolist(),
+                    "text_scores": text_scores[top_text_idx].tolist(),
+                }
+            })
+
+        if retrieval_record is not None:
+            self.metrics.share(retrieval_record, [p["record"] for p in prepared])
+
+        answers = self.generate_prompts(prepared, max_new_tokens, batch_size)
+        for p, answer in zip(prepared, answers):
+            p["output"]["answer"] = answer
+
+        return [self._attach_metrics(p["output"], p["record"]) for p in prepared]
+
+    def generate_prompts(
+        self,
+        items: list,
+        max_new_tokens: int = 128,
+        batch_size: int = 8
+    ):
+        """
+        Answers for already built prompts, in input order.
+
+        `items` are dicts with prompt, images, image_ids and, when metrics
+        are collected, the question record to charge. Cached answers are
+        reused; the rest are sorted by sequence length and generated
+        `batch_size` at a time.
+        """
+        answers = [None] * len(items)
+        keys = [None] * len(items)
+        params = self._generation_params(max_new_tokens)
+
+        todo = []
+        for i, item in enumerate(items):
+            keys[i] = self._cache_key(item["prompt"], item["image_ids"], params)
+            if keys[i] is not None:
+                answers[i] = self.generation_cache.get(keys[i])
+                with self._question(item.get("record")):
+                    count(
+                        self.metrics,
+                        "generation_cache_misses" if answers[i] is None
+                        else "generation_cache_hits"
+                    )
+
+            if answers[i] is None:
+                todo.append(i)
+
+        order = sorted(
+            todo,
+            key=lambda i: self.generator.sequence_length(
+                items[i]["prompt"], len(items[i]["images"])
+            )
+        )
+
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            with self._batch() as batch_record:
+                batch_answers = self.generator.generate_batch(
+                    [
+                        (items[i]["prompt"], items[i]["images"], items[i]["image_ids"])
+                        for i in batch
+                    ],
+                    max_new_tokens=max_new_tokens
+                )
+            if batch_record is not None:
+                # Batched stages are attributed evenly to the batch's questions
+                self.metrics.share(batch_record, [items[i]["record"] for i in batch])
+            for i, answer in zip(batch, batch_answers):
+                answers[i] = answer
+                if keys[i] is not None:
+                    self.generation_cache.put(keys[i], answer)
+
+        return answers
+
+    def generate_corpus(
+        self,
+        question: str,
+        load_images,
+        max_new_tokens: int = 128
+    ):
+        """
+        Full RAG forward pass over the open corpus.
+        `load_images(doc_ids)` must return (images, valid_doc_ids).
+        """
+        with self._question() as record:
+            image_ids, text_ids, image_scores, text_scores = self.retrieve_corpus(question)
+
+            with span(self.metrics, "image_load"):
+                top_images, top_image_ids = load_images(image_ids)
+            top_texts = [self.corpus_index.captions[i] for i in text_ids]
+
+            prompt = self.build_prompt(
+                question=question,
+                retrieved_texts=top_texts,
+                num_images=len(top_images)
+            )
+
+            answer = self._generate_one(prompt, top_images, top_image_ids, max_new_tokens)
+
+        return self._attach_metrics({
+            "answer": answer,
+            "retrieved_image_ids": top_image_ids,
+            "retrieved_text_ids": text_ids,
+            "retrieved_captions": top_texts,
+            "image_scores": [image_scores[image_ids.index(i)] for i in top_image_ids],
+            "text_scores": text_scores,
+        }, record)
@@ -0,0 +1,249 @@
+import os
+import json
+import argparse
+import numpy as np
+from src.utils import latest_per_qid, read_jsonl
+
+
+# Column kinds, inferred from the values written
+STR = "str"              # interned string, -1 = missing
+BOOL = "bool"            # int8, -1 = missing
+STR_LIST = "str_list"    # interned strings + row offsets
+SCORES = "scores"        # float16 values + row offsets
+JSON = "json"            # anything else, JSON-encoded and interned
+
+SCHEMA_KEY = "__schema__"
+STRINGS_KEY = "__strings__"
+
+
+def _kind(values) -> str:
+    present = [v for v in values if v is not None]
+
+    if all(isinstance(v, str) for v in present):
+        return STR
+    if all(isinstance(v, bool) for v in present):
+        return BOOL
+    if all(isinstance(v, list) for v in present):
+        items = [x for v in present for x in v]
+        if all(isinstance(x, str) for x in items):
+            return STR_LIST
+        if all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in items):
+            return SCORES
+    return JSON
+
+
+class _StringTable:
+    """
+    Interns strings into ids; stored as one UTF-8 blob plus offsets.
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def intern(self, s) -> int:
+        if s is None:
+            return -1
+        if s not in self.ids:
+            self.ids[s] = len(self.ids)
+        return self.ids[s]
+
+    def arrays(self):
+        encoded = [s.encode("utf-8") for s in self.ids]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return data, offsets
+
+
+def _offsets(lengths):
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def write_results(path: str, records, compress: bool = False) -> int:
+    """
+    Write result records (dicts as produced by run_rag.py) to a columnar
+    .npz file and return the number of rows.
+
+    Strings (qids, captions, doc ids, answers) are interned into one shared
+    table, so a caption repeated across questions is stored once; score
+    lists are stored as float16. Keys missing from a record stay missing
+    when it is read back.
+    """
+    columns = {}
+    n = 0
+    for record in records:
+        for name, value in record.items():
+            if name not in columns:
+                columns[name] = [None] * n
+            columns[name].append(value)
+        n += 1
+        for values in columns.values():
+            if len(values) < n:
+                values.append(None)
+
+    table = _StringTable()
+    arrays = {}
+    schema = {"rows": n, "columns": {}}
+
+    for name, values in columns.items():
+        kind = _kind(values)
+        schema["columns"][name] = kind
+
+        if kind == STR:
+            arrays[f"{name}.idx"] = np.array([table.intern(v) for v in values], dtype=np.int32)
+        elif kind == BOOL:
+            arrays[f"{name}.val"] = np.array(
+                [-1 if v is None else int(v) for v in values], dtype=np.int8
+            )
+        elif kind == JSON:
+            arrays[f"{name}.idx"] = np.array(
+                [-1 if v is None else table.intern(json.dumps(v)) for v in values],
+                dtype=np.int32
+            )
+        else:
+            rows = [v or [] for v in values]
+            arrays[f"{name}.offsets"] = _offsets([len(v) for v in rows])
+            arrays[f"{name}.present"] = np.array([v is not None for v in values])
+            flat = [x for v in rows for x in v]
+            if kind == STR_LIST:
+                arrays[f"{name}.idx"] = np.array(
+                    [table.intern(x) for x in flat], dtype=np.int32
+                )
+            else:
+                arrays[f"{name}.val"] = np.array(flat, dtype=np.float16)
+
+    arrays[f"{STRINGS_KEY}.data"], arrays[f"{STRINGS_KEY}.offsets"] = table.arrays()
+    arrays[SCHEMA_KEY] = np.frombuffer(json.dumps(schema).encode("utf-8"), dtype=np.uint8)
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # np.savez appends .npz to names without it
+    tmp_path = path + ".tmp.npz"
+    (np.savez_compressed if compress else np.savez)(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+    return n
+
+
+class ResultsTable:
+    """
+    Reader for files written by `write_results`.
+
+    Arrays are loaded from the .npz only when a column that needs them is
+    read, and only the strings a column refers to are decoded, so pulling
+    a few columns out of a large run is cheap.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.npz = np.load(path)
+        schema = json.loads(self.npz[SCHEMA_KEY].tobytes().decode("utf-8"))
+        self.schema = schema["columns"]
+        self.rows = schema["rows"]
+
+        self._string_data = None
+        self._string_offsets = None
+        self._strings = {}
+
+    @property
+    def columns(self):
+        return list(self.schema)
+
+    def __len__(self):
+        return self.rows
+
+    def _decode(self, ids):
+        """
+        Strings for an array of interned ids (-1 -> None).
+        """
+        if self._string_data is None:
+            self._string_data = self.npz[f"{STRINGS_KEY}.data"]
+            self._string_offsets = self.npz[f"{STRINGS_KEY}.offsets"]
+
+        data, offsets = self._string_data, self._string_offsets
+        for i in np.unique(ids):
+            if i >= 0 and i not in self._strings:
+                self._strings[i] = data[offsets[i]:offsets[i + 1]].tobytes().decode("utf-8")
+
+        return [self._strings[i] if i >= 0 else None for i in ids.tolist()]
+
+    def column(self, name: str) -> list:
+        """
+        One value per row; None where a record had no such key. Score
+        columns come back as float32 arrays.
+        """
+        kind = self.schema[name]
+
+        if kind == STR:
+            return self._decode(self.npz[f"{name}.idx"])
+        if kind == BOOL:
+            return [None if v < 0 else bool(v) for v in self.npz[f"{name}.val"].tolist()]
+        if kind == JSON:
+            return [None if s is None else json.loads(s)
+                    for s in self._decode(self.npz[f"{name}.idx"])]
+
+        offsets = self.npz[f"{name}.offsets"]
+        present = self.npz[f"{name}.present"]
+        if kind == STR_LIST:
+            flat = self._decode(self.npz[f"{name}.idx"])
+        else:
+            flat = self.npz[f"{name}.val"].astype(np.float32)
+
+        return [
+            flat[offsets[i]:offsets[i + 1]] if present[i] else None
+            for i in range(self.rows)
+        ]
+
+    def scores(self, name: str):
+        """
+        A score column as (float16 values, int64 row offsets), for
+        vectorized analysis without building per-row arrays.
+        """
+        if self.schema[name] != SCORES:
+            raise ValueError(f"{name} is a {self.schema[name]} column, not scores")
+        return self.npz[f"{name}.val"], self.npz[f"{name}.offsets"]
+
+    def records(self, columns=None):
+        """
+        Iterate over rows as dicts holding only `columns` (default: all),
+        without the keys a record did not have.
+        """
+        names = [c for c in (columns or self.columns) if c in self.schema]
+        data = {name: self.column(name) for name in names}
+
+        for i in range(self.rows):
+            record = {}
+            for name in names:
+                value = data[name][i]
+                if value is not None:
+                    record[name] = value.tolist() if isinstance(value, np.ndarray) else value
+            yield record
+
+    def close(self):
+        self.npz.close()
+
+
+def columnar_path(jsonl_path: str) -> str:
+    base = jsonl_path[:-len(".jsonl")] if jsonl_path.endswith(".jsonl") else jsonl_path
+    return base + ".npz"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert JSONL results from run_rag.py to the columnar .npz format."
+    )
+    parser.add_argument("inputs", nargs="+", help="JSONL results files")
+    parser.add_argument("--compress", action="store_true", help="zlib-compress the arrays")
+    args = parser.parse_args()
+
+    for path in args.inputs:
+        output = columnar_path(path)
+        n = write_results(output, latest_per_qid(read_jsonl(path)), compress=args.compress)
+        print(f"{path}: {n} records, {os.path.getsize(path) / 2**20:.1f} MB "
+              f"-> {output}: {os.path.getsize(output) / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,34 @@
 import torch
-from transformers import AutoModel, AutoProcessor
+
+
+class _TextEncoder(torch.nn.Module):
+    """
+    get_text_features as a forward() with positional args, for tracing.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model.get_text_features(
+            input_ids=input_ids,
+            attention_mask=attention_mask
+        )
+
+
+class _ImageEncoder(torch.nn.Module):
+    """
+    get_image_features as a forward() with positional args, for tracing.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return self.model.get_image_features(pixel_values=pixel_values)
+
 
 class Retriever:
     """
@@ -7,21 +36,80 @@ class Retriever:
     Supports CLIP-style models with text/image encoders.
     """
 
+    BACKENDS = ("torch", "int8", "torchscript")
+
     def __init__(
         self,
         model_id: str,
         device: str = None,
         cache_dir: str = None,
-        normalize: bool = True
+        normalize: bool = True,
+        batch_size: int = 64,
+        max_batch_tokens: int = None,
+        max_batch_pixels: int = None,
+        autocast_dtype=None,
+        pixel_cache=None,
+        backend: str = "torch",
+        num_threads: int = None
     ):
+        """
+        batch_size:       maximum number of texts/images per forward pass
+        max_batch_tokens: optional budget on padded tokens per text batch
+        max_batch_pixels: optional budget on raw image pixels per image batch
+        autocast_dtype:   e.g. torch.float16 / torch.bfloat16 to run the
+                          encoders under autocast (embeddings are returned
+                          in float32 either way)
+        pixel_cache:      optional PixelValueCache for this model's processor;
+                          used by encode_images when image_ids are given
+        backend:          "torch" (fp32 eager), or one of the CPU backends:
+                          "int8" (dynamic int8 quantization of the Linear
+                          layers) and "torchscript" (int8, traced to
+                          TorchScript on first use). CPU backends always run
+                          on device="cpu".
+        num_threads:      intra-op threads for torch on CPU (default: torch's
+                          own choice, usually one per physical core)
+        """
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {self.BACKENDS}")
+
         self.model_id = model_id
+        self.backend = backend
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if backend != "torch":
+            self.device = "cpu"
         self.cache_dir = cache_dir
         self.normalize = normalize
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_pixels = max_batch_pixels
+        self.autocast_dtype = autocast_dtype
+        self.pixel_cache = pixel_cache
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
 
-        self._load_model()
+        self._traced_text = None
+        self._traced_image = None
+
+    def __getattr__(self, name):
+        # The processor and model are loaded on first use
+        if name in ("model", "processor"):
+            self.load()
+            return self.__dict__[name]
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    def load(self):
+        """
+        Load the processor and model now rather than on first use.
+        """
+        if "model" not in self.__dict__:
+            self._load_model()
+            self._prepare_backend()
+        return self
 
     def _load_model(self):
+        from transformers import AutoModel, AutoProcessor
+
         self.processor = AutoProcessor.from_pretrained(
             self.model_id,
             cache_dir=self.cache_dir
@@ -34,41 +122,208 @@ class Retriever:
 
         self.model.eval()
 
-    @torch.no_grad()
-    def encode_text(self, texts):
+    def _prepare_backend(self):
+        if self.backend != "torch":
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model,
+                {torch.nn.Linear},
+                dtype=torch.qint8
+            )
+
+    def _text_features(self, inputs):
+        if self.backend != "torchscript":
+            return self.model.get_text_features(**inputs)
+
+        args = (inputs["input_ids"], inputs["attention_mask"])
+        if self._traced_text is None:
+            # Traced with the first batch; sequence length and batch size
+            # stay dynamic
+            self._traced_text = torch.jit.trace(
+                _TextEncoder(self.model), args, check_trace=False
+            )
+        return self._traced_text(*args)
+
+    def _image_features(self, pixel_values):
+        if self.backend != "torchscript":
+            return self.model.get_image_features(pixel_values=pixel_values)
+
+        if self._traced_image is None:
+            self._traced_image = torch.jit.trace(
+                _ImageEncoder(self.model), (pixel_values,), check_trace=False
+            )
+        return self._traced_image(pixel_values)
+
+    def _micro_batches(self, costs, budget, padded):
         """
-        Encode a list of texts into embeddings.
+        Split item indices into micro-batches of at most `batch_size` items.
+        If `budget` is set, a batch is also closed once its cost would exceed
+        it: len(batch) * max(cost) when `padded`, sum(cost) otherwise.
+        A single item larger than the budget still gets its own batch.
         """
-        inputs = self.processor(
-            text=texts,
-            return_tensors="pt",
-            padding=True,
-            truncation=True
-        ).to(self.device)
+        batches = []
+        batch = []
+        batch_cost = 0
+
+        for i in range(len(costs)):
+            if padded:
+                new_cost = (len(batch) + 1) * max(batch_cost, costs[i])
+            else:
+                new_cost = batch_cost + costs[i]
+
+            if batch and (
+                len(batch) >= self.batch_size
+                or (budget is not None and new_cost > budget)
+            ):
+                batches.append(batch)
+                batch = []
+                batch_cost = 0
+
+            batch.append(i)
+            batch_cost = max(batch_cost, costs[i]) if padded else batch_cost + costs[i]
+
+        if batch:
+            batches.append(batch)
+
+        return batches
 
-        emb = self.model.get_text_features(**inputs)
+    def _autocast(self):
+        return torch.autocast(
+            device_type=torch.device(self.device).type,
+            dtype=self.autocast_dtype,
+            enabled=self.autocast_dtype is not None
+        )
+
+    def _stitch(self, parts, order):
+        """
+        Concatenate per-batch embeddings and restore input order.
+        """
+        emb = torch.cat(parts)
+        out = torch.empty_like(emb)
+        out[torch.tensor(order, device=emb.device)] = emb
+        return out
+
+    def _finalize(self, emb):
+        emb = emb.float()
 
         if self.normalize:
             emb = emb / emb.norm(dim=-1, keepdim=True)
 
         return emb
 
+    def _empty(self):
+        return torch.empty(
+            (0, self.model.config.projection_dim),
+            device=self.device
+        )
+
     @torch.no_grad()
-    def encode_images(self, images):
+    def encode_text(self, texts):
         """
-        Encode a list of PIL images into embeddings.
+        Encode a list of texts into embeddings.
+        Texts are sorted by length and encoded in micro-batches to limit
+        padding; results are returned in input order.
         """
-        inputs = self.processor(
-            images=images,
-            return_tensors="pt"
-        ).to(self.device)
+        if not texts:
+            return self._empty()
 
-        emb = self.model.get_image_features(**inputs)
+        lengths = [
+            len(ids) for ids in self.processor.tokenizer(
+                list(texts),
+                truncation=True
+            )["input_ids"]
+        ]
+        order = sorted(range(len(texts)), key=lambda i: lengths[i], reverse=True)
 
-        if self.normalize:
-            emb = emb / emb.norm(dim=-1, keepdim=True)
+        parts = []
+        for batch in self._micro_batches(
+            [lengths[i] for i in order], self.max_batch_tokens, padded=True
+        ):
+            inputs = self.processor(
+                text=[texts[order[i]] for i in batch],
+                return_tensors="pt",
+                padding=True,
+                truncation=True
+            ).to(self.device)
 
-        return emb
+            with self._autocast():
+                emb = self._text_features(inputs)
+
+            parts.append(self._finalize(emb))
+
+        return self._stitch(parts, order)
+
+    def preprocess_images(self, images, image_ids=None):
+        """
+        Run the image processor, reading and filling the pixel cache when
+        one is configured and doc ids are known.
+        """
+        def process(batch):
+            return self.processor(images=batch, return_tensors="pt")["pixel_values"]
+
+        if self.pixel_cache is None or image_ids is None:
+            return process(images)
+
+        return self.pixel_cache.get_or_compute(image_ids, images, process)
+
+    @torch.no_grad()
+    def encode_pixel_values(self, pixel_values):
+        """
+        Encode preprocessed pixel_values into embeddings, in micro-batches.
+        """
+        if len(pixel_values) == 0:
+            return self._empty()
+
+        height, width = pixel_values.shape[-2:]
+        costs = [height * width] * len(pixel_values)
+
+        parts = []
+        for batch in self._micro_batches(costs, self.max_batch_pixels, padded=False):
+            with self._autocast():
+                emb = self._image_features(
+                    pixel_values[batch[0]:batch[-1] + 1].to(self.device)
+                )
+
+            parts.append(self._finalize(emb))
+
+        return torch.cat(parts)
+
+    @torch.no_grad()
+    def encode_images(self, images, image_ids=None):
+        """
+        Encode a list of PIL images into embeddings, in micro-batches.
+        If `image_ids` are given and a pixel cache is configured, cached
+        pixel_values are used instead of re-running the processor.
+        """
+        if not images:
+            return self._empty()
+
+        if self.pixel_cache is not None and image_ids is not None:
+            pixel_values = torch.cat([
+                self.preprocess_images(
+                    images[start:start + self.batch_size],
+                    image_ids[start:start + self.batch_size]
+                )
+                for start in range(0, len(images), self.batch_size)
+            ])
+            return self.encode_pixel_values(pixel_values)
+
+        costs = [img.width * img.height for img in images]
+
+        parts = []
+        order = []
+        for batch in self._micro_batches(costs, self.max_batch_pixels, padded=False):
+            inputs = self.processor(
+                images=[images[i] for i in batch],
+                return_tensors="pt"
+            ).to(self.device)
+
+            with self._autocast():
+                emb = self._image_features(inputs["pixel_values"])
+
+            parts.append(self._finalize(emb))
+            order.extend(batch)
+
+        return self._stitch(parts, order)
 
     def score_texts(self, query_emb, doc_embs):
         """
@@ -1,158 +1,662 @@
 import os
-import json
+import argparse
 from tqdm import tqdm
-from src.retriever import Retriever
-from src.generator import Generator
 from src.rag_model import RAGModel
-from src.utils import load_mmqa_json, load_images_from_metadata
+from src.generation_cache import GenerationCache
+from src.metrics import RunMetrics
+from src.server import RAGClient
+from src.datasets import (
+    DATASETS,
+    dataset_path,
+    load_examples,
+    load_image_metadata,
+    load_poisoned_metadata,
+)
+from src.utils import (
+    existing_image_ids,
+    load_images_from_metadata,
+    load_done_qids,
+    latest_per_qid,
+    read_jsonl,
+    shard_of,
+    shard_path,
+    ImagePrefetcher,
+    JSONLWriter,
+)
 
 
 CACHE_DIR = "/scratch/shayan/hf_cache"
 
-DATASET_NAME = "mmqa-mmpoisonrag"
-DATASET_ROOT = f"datasets/{DATASET_NAME}"
+# "mmqa" or "webqa"; file layouts live in src/datasets.py. Set with
+# --dataset or `use_dataset(name)`.
+DATASET = "mmqa"
+
+# MMQA files, also read directly by the sweep and checking scripts
+IMAGE_METADATA_PATH = dataset_path("mmqa", "image_metadata")
+POISONED_METADATA_PATH = dataset_path("mmqa", "poisoned_metadata")
+DATA_PATH = dataset_path("mmqa", "data")
+
+IMAGE_DIR = DATASETS[DATASET]["image_dir"]
 
-IMAGE_METADATA_PATH = f"{DATASET_ROOT}/MMQA_image_metadata.json"
-POISONED_METADATA_PATH = f"{DATASET_ROOT}/MMQA_image_metadata_poisoned.json"
-DATA_PATH = f"{DATASET_ROOT}/MMQA_test_image.json"
+# Precomputed image embeddings (build with `python -m src.embedding_store`)
+EMBEDDING_STORE_DIR = "cache/embeddings"
 
-IMAGE_DIR = "datasets/mmqa/final_dataset_images" 
+# Precomputed clean-caption embeddings per dataset
+# (build with `python -m src.caption_store --dataset <name>`)
+CAPTION_STORE_DIR = "cache/caption_embeddings"
+
+# "pool"   = rank each question's own image_doc_ids candidates
+# "corpus" = rank the whole MMQA corpus through the ANN index
+#            (build with `python -m src.index`)
+RETRIEVAL_MODE = "pool"
+CORPUS_INDEX_DIR = "cache/corpus_index"
+
+# Cached processor outputs per (processor, image); None disables the cache
+PIXEL_CACHE_DIR = "cache/pixel_values"
 
 RETRIEVER_ID = "openai/clip-vit-base-patch32"
 GENERATOR_ID = "llava-hf/llava-1.5-7b-hf"
 
 USE_POISONED_CAPTIONS = True  # False = baseline, True = attack
 
-OUTPUT_FILE = (
-    "results/rag_clip_llava_mmqa_poisoned.json"
-    if USE_POISONED_CAPTIONS
-    else "results/rag_clip_llava_mmqa_clean_caption_baseline.json"
-)
+MAX_NEW_TOKENS = 150
 
+# Stop each answer at its first newline / sentence end / EOS instead of
+# running to MAX_NEW_TOKENS; the prompt asks for only the final answer
+SHORT_ANSWER = True
 
-def main():
+# Questions generated together per LLaVA call (1 = unbatched), and how many
+# questions are collected before sorting them into length-bucketed batches
+GENERATION_BATCH_SIZE = 8
+GENERATION_WINDOW = GENERATION_BATCH_SIZE * 4
 
-    print("Loading image metadata...")
-    with open(IMAGE_METADATA_PATH, "r") as f:
-        image_metadata = json.load(f)
-    
-    poisoned_metadata = None
-    if USE_POISONED_CAPTIONS:
-        print("Loading poisoned image metadata...")
-        with open(POISONED_METADATA_PATH, "r") as f:
-            poisoned_metadata = json.load(f)
+# Prompt-prefix KV caches kept by the generator (0 = off). Applies to
+# unbatched generation (GENERATION_BATCH_SIZE = 1) and corpus mode, where
+# the same retrieved images recur across questions.
+PREFIX_CACHE_SIZE = 0
 
-    data = load_mmqa_json(DATA_PATH)
-    print(f"Loaded {len(data)} MMQA test examples")
+# Persistent cache of generator outputs keyed by (model, prompt, retrieved
+# image ids, decoding params), shared by clean and poisoned runs; None disables it
+GENERATION_CACHE_PATH = "cache/generations.sqlite"
+GENERATION_CACHE_MAX_ENTRIES = 200000
 
-    print("Initializing models...")
-    retriever = Retriever(
-        model_id=RETRIEVER_ID,
-        cache_dir=CACHE_DIR
-    )
+# Image decoding threads, and how many questions ahead to decode
+PREFETCH_WORKERS = 4
+PREFETCH_QUESTIONS = 8
 
-    generator = Generator(
-        model_id=GENERATOR_ID,
-        cache_dir=CACHE_DIR
-    )
 
-    rag = RAGModel(
-        retriever=retriever,
-        generator=generator,
-        top_k_images=3,
-        top_k_texts=3
+# Results are appended as JSONL; rerunning skips qids already in the file.
+# Derived from the settings above when called, so they can be changed
+# after import.
+def output_file_path():
+    path = (
+        f"results/rag_clip_llava_{DATASET}_poisoned.jsonl"
+        if USE_POISONED_CAPTIONS
+        else f"results/rag_clip_llava_{DATASET}_clean_caption_baseline.jsonl"
     )
+    if RETRIEVAL_MODE == "corpus":
+        path = path.replace(".jsonl", "_corpus.jsonl")
+    return path
 
-    results = []
 
-    print("Running RAG...")
-    for ex in tqdm(data):
+# fsync the output file every N results
+FSYNC_EVERY = 20
 
-        question = ex["question"]
-        gold_answers = ex.get("answers", [])
+# Per-stage timings and counters: every result record gets a "metrics"
+# field, and a run summary is written next to the output as
+# <output>.metrics.json and <output>.prom (Prometheus textfile) every
+# METRICS_EVERY results and at the end
+COLLECT_METRICS = True
+METRICS_EVERY = 100
 
-        images, image_ids = load_images_from_metadata(
-            IMAGE_DIR,
-            ex["metadata"]["image_doc_ids"],
-            image_metadata
-        )
+# Also write the finished results as <output>.npz, the compact columnar
+# format read by `src.results_table.ResultsTable` and eval_rag.py
+WRITE_COLUMNAR = True
 
-        if not images:
-            continue
 
-        # =========================
-        # Build TEXT pool
-        # =========================
+def use_dataset(name):
+    """
+    Switch the run to another dataset in DATASETS.
+    """
+    global DATASET, IMAGE_DIR
+    DATASET = name
+    IMAGE_DIR = DATASETS[name]["image_dir"]
+
 
-        texts = []
+def load_dataset():
+    """
+    (examples, image metadata, poisoned metadata or None) of the current
+    dataset, honouring USE_POISONED_CAPTIONS.
+    """
+    print(f"Loading {DATASET} image metadata...")
+    image_metadata = load_image_metadata(DATASET)
 
-        # include ALL clean captions
+    poisoned_metadata = None
+    if USE_POISONED_CAPTIONS:
+        print("Loading poisoned image metadata...")
+        poisoned_metadata = load_poisoned_metadata(DATASET)
+        if poisoned_metadata is None:
+            raise FileNotFoundError(
+                f"No poisoned metadata at {dataset_path(DATASET, 'poisoned_metadata')}; "
+                "set USE_POISONED_CAPTIONS = False for a clean run"
+            )
+
+    data = load_examples(DATASET)
+    print(f"Loaded {len(data)} {DATASET} test examples")
+    return data, image_metadata, poisoned_metadata
+
+
+def fall_back_to_clean_captions():
+    """
+    Switch to the clean caption baseline, with a warning, when the poisoned
+    run was asked for but the dataset has no poisoned metadata yet (e.g.
+    WebQA before candidates have been generated for it).
+    """
+    global USE_POISONED_CAPTIONS
+    path = dataset_path(DATASET, "poisoned_metadata")
+    if USE_POISONED_CAPTIONS and not os.path.exists(path):
+        print(f"[WARN] No poisoned metadata at {path}; running the clean caption baseline")
+        USE_POISONED_CAPTIONS = False
+
+
+def poison_caption(meta):
+    """
+    The candidate chosen by `python -m src.select_poison` if it has been
+    run on the poisoned metadata, otherwise the first candidate.
+    """
+    return meta.get("selected_candidate") or meta["poisoned_candidates"][0]
+
+
+def build_pool_example(ex, images, image_ids, image_metadata, poisoned_metadata):
+    """
+    Build an example's text pool around its loaded candidate images.
+    Returns None if the example has no usable images or captions.
+    """
+    if not image_ids:
+        return None
+
+    # =========================
+    # Build TEXT pool
+    # =========================
+
+    texts = []
+    # Doc id of the image each caption belongs to (None for the poison),
+    # used to find stored caption embeddings
+    text_ids = []
+
+    # include ALL clean captions
+    for img_id in image_ids:
+        if img_id in image_metadata and image_metadata[img_id].get("caption"):
+            texts.append(image_metadata[img_id]["caption"])
+            text_ids.append(img_id)
+
+    # Inject exactly ONE poisoned caption (if enabled)
+    injected_poison = None
+    if poisoned_metadata is not None:
         for img_id in image_ids:
-            if img_id in image_metadata and image_metadata[img_id].get("caption"):
-                texts.append(image_metadata[img_id]["caption"])
-
-        # Inject exactly ONE poisoned caption (if enabled)
-        injected_poison = None
-        if USE_POISONED_CAPTIONS and poisoned_metadata is not None:
-            for img_id in image_ids:
-                if (
-                    img_id in poisoned_metadata
-                    and poisoned_metadata[img_id]["poisoned_candidates"]
-                ):
-                    injected_poison = poisoned_metadata[img_id]["poisoned_candidates"][0]
-                    texts.append(injected_poison)
-                    break 
-
-        if not texts:
+            if (
+                img_id in poisoned_metadata
+                and poisoned_metadata[img_id]["poisoned_candidates"]
+            ):
+                injected_poison = poison_caption(poisoned_metadata[img_id])
+                texts.append(injected_poison)
+                text_ids.append(None)
+                break 
+
+    if not texts:
+        return None
+
+    return {
+        "ex": ex,
+        "question": ex["question"],
+        "images": images,
+        "image_ids": image_ids,
+        "texts": texts,
+        "text_ids": text_ids,
+        "injected_poison": injected_poison,
+    }
+
+
+def pool_result(item, output):
+    image_ids = item["image_ids"]
+    texts = item["texts"]
+    injected_poison = item["injected_poison"]
+
+    retrieved_image_ids = [
+        image_ids[i] for i in output["retrieved_image_indices"]
+    ]
+
+    retrieved_captions = [
+        texts[i] for i in output["retrieved_text_indices"]
+    ]
+
+    result = {
+        "qid": item["ex"].get("qid"),
+        "question": item["question"],
+        "model_answer": output["answer"],
+        "gold_answers": item["ex"].get("answers", []),
+
+        # Candidate pool
+        "associated_images": image_ids,
+        "associated_captions": texts,
+
+        "retrieved_image_ids": retrieved_image_ids,
+        "retrieved_captions": retrieved_captions,
+        "image_scores": output["image_scores"],
+        "text_scores": output["text_scores"],
+
+        # Attack bookkeeping
+        "poison_injected": injected_poison is not None,
+        "poison_caption": injected_poison,
+    }
+
+    if "metrics" in output:
+        result["metrics"] = output["metrics"]
+        result["metrics"]["stages"]["image_load"] = item.get("image_load_seconds", 0.0)
+
+    return result
+
+
+def run_pool_item(rag, item):
+    try:
+        output = rag.generate(
+            question=item["question"],
+            images=item["images"],
+            texts=item["texts"],
+            max_new_tokens=MAX_NEW_TOKENS,
+            image_ids=item["image_ids"],
+            text_ids=item["text_ids"]
+        )
+    except Exception as e:
+        # Fail gracefully
+        return {
+            "qid": item["ex"].get("qid"),
+            "question": item["question"],
+            "error": str(e)
+        }
+
+    return pool_result(item, output)
+
+
+def run_pool_window(rag, window):
+    """
+    Generate a window of prepared examples in length-bucketed batches.
+    If a batch fails, fall back to one question at a time so a single bad
+    example only costs its own result.
+    """
+    if GENERATION_BATCH_SIZE <= 1:
+        return [run_pool_item(rag, item) for item in window]
+
+    try:
+        outputs = rag.generate_batch(
+            window,
+            max_new_tokens=MAX_NEW_TOKENS,
+            batch_size=GENERATION_BATCH_SIZE
+        )
+    except Exception as e:
+        print(f"[WARN] Batched generation failed ({e}), retrying per question")
+        return [run_pool_item(rag, item) for item in window]
+
+    return [pool_result(item, output) for item, output in zip(window, outputs)]
+
+
+def run_pool(rag, data, image_metadata, poisoned_metadata, load_images=True):
+    """
+    Per-question RAG over each example's own candidate image pool.
+    Questions are collected into windows of GENERATION_WINDOW examples,
+    which are then generated in batches grouped by prompt length.
+    Yields one result record per question.
+
+    With `load_images=False` (client mode) images are not decoded here;
+    examples carry only their doc ids and the server loads the images.
+    """
+    window = []
+
+    prefetcher = ImagePrefetcher(
+        IMAGE_DIR,
+        image_metadata,
+        num_workers=PREFETCH_WORKERS,
+        prefetch=PREFETCH_QUESTIONS
+    )
+    if load_images:
+        image_sets = prefetcher.iterate(ex["metadata"]["image_doc_ids"] for ex in data)
+    else:
+        # Only ids with an image on disk, so the pool (and its clean captions)
+        # matches what local mode would build
+        image_sets = (
+            (None, existing_image_ids(IMAGE_DIR, ex["metadata"]["image_doc_ids"], image_metadata))
+            for ex in data
+        )
+
+    waited = 0.0
+    for ex, (images, image_ids) in tqdm(zip(data, image_sets), total=len(data)):
+
+        # Time blocked on the prefetcher for this question's images
+        image_load_seconds = prefetcher.wait_time - waited
+        waited = prefetcher.wait_time
+        if rag.metrics is not None:
+            rag.metrics.add_time("image_load", image_load_seconds)
+
+        item = build_pool_example(ex, images, image_ids, image_metadata, poisoned_metadata)
+        if item is None:
             continue
+        item["image_load_seconds"] = image_load_seconds
+
+        window.append(item)
+
+        if len(window) >= GENERATION_WINDOW:
+            yield from run_pool_window(rag, window)
+            window = []
+
+    if window:
+        yield from run_pool_window(rag, window)
+
+    print(f"Waited {prefetcher.wait_time:.1f}s on image loading")
+
+
+def run_corpus(rag, data, poisoned_metadata):
+    """
+    Open-corpus RAG: every question searches the full corpus index.
+    Poisoned captions are inserted into the index once, up front, so
+    they compete against every clean caption. Yields one result record
+    per question.
+    """
+    corpus_index = rag.corpus_index
+
+    if poisoned_metadata is not None:
+        poison_ids, poison_texts = [], []
+        for img_id, meta in poisoned_metadata.items():
+            if meta["poisoned_candidates"]:
+                poison_ids.append(f"poison:{img_id}")
+                poison_texts.append(poison_caption(meta))
+
+        corpus_index.add_texts(rag.retriever, poison_ids, poison_texts)
+        print(f"Inserted {len(poison_ids)} poisoned captions into the corpus index")
+
+    def load_images(doc_ids):
+        return load_images_from_metadata(IMAGE_DIR, doc_ids, corpus_index.image_paths)
+
+    for ex in tqdm(data):
+
+        question = ex["question"]
 
         try:
-            output = rag.generate(
+            output = rag.generate_corpus(
                 question=question,
-                images=images,
-                texts=texts,
-                max_new_tokens=150
+                load_images=load_images,
+                max_new_tokens=MAX_NEW_TOKENS
             )
         except Exception as e:
-            # Fail gracefully
-            results.append({
+            yield {
                 "qid": ex.get("qid"),
                 "question": question,
                 "error": str(e)
-            })
+            }
             continue
 
-        retrieved_image_ids = [
-            image_ids[i] for i in output["retrieved_image_indices"]
-        ]
-
-        retrieved_captions = [
-            texts[i] for i in output["retrieved_text_indices"]
+        retrieved_poison = [
+            i for i in output["retrieved_text_ids"] if i.startswith("poison:")
         ]
 
-        results.append({
+        record = {
             "qid": ex.get("qid"),
             "question": question,
             "model_answer": output["answer"],
-            "gold_answers": gold_answers,
-
-            # Candidate pool
-            "associated_images": image_ids,
-            "associated_captions": texts,
+            "gold_answers": ex.get("answers", []),
 
-            "retrieved_image_ids": retrieved_image_ids,
-            "retrieved_captions": retrieved_captions,
+            "retrieved_image_ids": output["retrieved_image_ids"],
+            "retrieved_text_ids": output["retrieved_text_ids"],
+            "retrieved_captions": output["retrieved_captions"],
             "image_scores": output["image_scores"],
             "text_scores": output["text_scores"],
 
             # Attack bookkeeping
-            "poison_injected": injected_poison is not None,
-            "poison_caption": injected_poison,
-        })
+            "poison_injected": poisoned_metadata is not None,
+            "poison_retrieved": retrieved_poison,
+        }
+
+        if "metrics" in output:
+            record["metrics"] = output["metrics"]
+
+        yield record
+
+
+def merge_shards(num_shards):
+    """
+    Merge per-shard outputs into the output file.
+    Records are deduplicated by qid (a successful record wins over an
+    error record) and coverage is checked against the dataset.
+    """
+    output_file = output_file_path()
+
+    merged = {}
+    for shard_id in range(num_shards):
+        path = shard_path(output_file, shard_id, num_shards)
+        if not os.path.exists(path):
+            print(f"[WARN] Missing shard output {path}")
+            continue
+
+        for record in read_jsonl(path):
+            qid = record.get("qid")
+            if qid not in merged or ("error" in merged[qid] and "error" not in record):
+                merged[qid] = record
+
+    data = load_examples(DATASET)
+    dataset_qids = [ex.get("qid") for ex in data]
+    missing = [qid for qid in dataset_qids if qid not in merged]
+    errors = sum(1 for r in merged.values() if "error" in r)
+
+    tmp_path = output_file + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    with JSONLWriter(tmp_path, fsync_every=len(merged) + 1) as writer:
+        for qid in dataset_qids:
+            if qid in merged:
+                writer.write(merged[qid])
+    os.replace(tmp_path, output_file)
+
+    print(f"Merged {len(merged)} results from {num_shards} shards into {output_file}")
+    if WRITE_COLUMNAR:
+        write_columnar(output_file)
+    print(f"Errors:  {errors}")
+    print(f"Missing: {len(missing)} of {len(dataset_qids)} dataset questions")
+    if missing:
+        print("(questions without usable images or captions are never written)")
+        for qid in missing[:10]:
+            print(f"  {qid}")
+
+
+def write_columnar(output_file):
+    from src.results_table import write_results, columnar_path
+
+    # A resumed run appends retried questions after their error records
+    path = columnar_path(output_file)
+    n = write_results(path, latest_per_qid(read_jsonl(output_file)))
+    print(f"Wrote {n} results in columnar form to {path}")
+
+
+def build_rag(metrics=None):
+    """
+    Build the retriever, generator and RAGModel (with all configured caches)
+    from the settings above. Models load on first use.
+    """
+    from src.retriever import Retriever
+    from src.generator import Generator
+    from src.embedding_store import ImageEmbeddingStore
+    from src.index import CorpusIndex
+    from src.pixel_cache import PixelValueCache
+    from src.caption_store import CaptionEmbeddingStore
+
+    retriever_pixel_cache = generator_pixel_cache = None
+    if PIXEL_CACHE_DIR is not None:
+        retriever_pixel_cache = PixelValueCache(PIXEL_CACHE_DIR, RETRIEVER_ID)
+        generator_pixel_cache = PixelValueCache(PIXEL_CACHE_DIR, GENERATOR_ID)
+
+    retriever = Retriever(
+        model_id=RETRIEVER_ID,
+        cache_dir=CACHE_DIR,
+        pixel_cache=retriever_pixel_cache
+    )
+
+    generator = Generator(
+        model_id=GENERATOR_ID,
+        cache_dir=CACHE_DIR,
+        pixel_cache=generator_pixel_cache,
+        prefix_cache_size=PREFIX_CACHE_SIZE,
+        short_answer=SHORT_ANSWER,
+        metrics=metrics
+    )
+
+    embedding_store = ImageEmbeddingStore(EMBEDDING_STORE_DIR, RETRIEVER_ID)
+    if embedding_store.exists():
+        embedding_store.load()
+        print(f"Loaded {len(embedding_store)} stored image embeddings")
+    else:
+        print(f"No embedding store at {embedding_store.store_dir}, encoding images on the fly")
+        embedding_store = None
+
+    caption_store = CaptionEmbeddingStore(CAPTION_STORE_DIR, RETRIEVER_ID, DATASET)
+    if caption_store.exists():
+        caption_store.load()
+        print(f"Loaded {len(caption_store)} stored caption embeddings")
+    else:
+        caption_store = None
+
+    generation_cache = None
+    if GENERATION_CACHE_PATH is not None:
+        generation_cache = GenerationCache(
+            GENERATION_CACHE_PATH, max_entries=GENERATION_CACHE_MAX_ENTRIES
+        )
+
+    corpus_index = None
+    if RETRIEVAL_MODE == "corpus":
+        print("Loading corpus index...")
+        corpus_index = CorpusIndex.load(CORPUS_INDEX_DIR)
+
+    return RAGModel(
+        retriever=retriever,
+        generator=generator,
+        top_k_images=3,
+        top_k_texts=3,
+        embedding_store=embedding_store,
+        corpus_index=corpus_index,
+        generation_cache=generation_cache,
+        caption_store=caption_store,
+        metrics=metrics
+    )
+
+
+def close_rag(rag):
+    """
+    Flush the pixel caches and close the generation cache of a RAGModel
+    built by `build_rag`.
+    """
+    for cache in (rag.retriever.pixel_cache, rag.generator.pixel_cache):
+        if cache is not None:
+            cache.flush()
+
+    if rag.generation_cache is not None:
+        print(f"Generation cache: {rag.generation_cache.stats()}")
+        rag.generation_cache.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run multimodal RAG on MMQA or WebQA.")
+    parser.add_argument("--dataset", default=DATASET, choices=list(DATASETS))
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--shard-id", type=int, default=0)
+    parser.add_argument(
+        "--merge",
+        action="store_true",
+        help="merge the outputs of --num-shards shards instead of running"
+    )
+    parser.add_argument(
+        "--server",
+        default=None,
+        help="URL of a running `python -m src.server` to send questions to "
+             "instead of loading the models in this process"
+    )
+    args = parser.parse_args()
+
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error("--shard-id must be in [0, --num-shards)")
+
+    use_dataset(args.dataset)
+    if DATASET != "mmqa" and RETRIEVAL_MODE == "corpus":
+        parser.error("RETRIEVAL_MODE = \"corpus\" is only available for mmqa")
+
+    # Decide before the output path is derived from it
+    fall_back_to_clean_captions()
+
+    if args.merge:
+        merge_shards(args.num_shards)
+        return
+
+    output_file = shard_path(output_file_path(), args.shard_id, args.num_shards)
+
+    data, image_metadata, poisoned_metadata = load_dataset()
+
+    if args.num_shards > 1:
+        data = [
+            ex for ex in data
+            if shard_of(ex.get("qid"), args.num_shards) == args.shard_id
+        ]
+        print(f"Shard {args.shard_id}/{args.num_shards}: {len(data)} examples")
+
+    done_qids = load_done_qids(output_file)
+    if done_qids:
+        data = [ex for ex in data if ex.get("qid") not in done_qids]
+        print(f"Resuming: {len(done_qids)} already in {output_file}, {len(data)} to go")
+
+    metrics = RunMetrics() if COLLECT_METRICS else None
+    metrics_base = output_file[:-len(".jsonl")] if output_file.endswith(".jsonl") else output_file
+
+    def write_metrics():
+        metrics.write_json(metrics_base + ".metrics.json")
+        metrics.write_prometheus(
+            metrics_base + ".prom",
+            labels={"run": os.path.basename(metrics_base)}
+        )
+
+    if args.server:
+        if RETRIEVAL_MODE != "pool":
+            parser.error("--server only supports RETRIEVAL_MODE = \"pool\"")
+        print(f"Using model server at {args.server}")
+        rag = RAGClient(args.server)
+        metrics = None
+    else:
+        print("Initializing models...")
+        rag = build_rag(metrics)
+
+    print(f"Running RAG, writing results to {output_file}...")
+    if RETRIEVAL_MODE == "corpus":
+        results = run_corpus(rag, data, poisoned_metadata)
+    else:
+        results = run_pool(
+            rag, data, image_metadata, poisoned_metadata, load_images=not args.server
+        )
 
-    print(f"Saving results to {OUTPUT_FILE}")
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(results, f, indent=2)
+    with JSONLWriter(output_file, fsync_every=FSYNC_EVERY) as writer:
+        for n, record in enumerate(results, 1):
+            writer.write(record)
+            if metrics is not None and n % METRICS_EVERY == 0:
+                write_metrics()
+
+    if not args.server:
+        close_rag(rag)
+
+    # Shards are converted once they are merged
+    if WRITE_COLUMNAR and args.num_shards == 1:
+        write_columnar(output_file)
+
+    if metrics is not None:
+        write_metrics()
+        summary = metrics.summary()
+        print(f"Metrics written to {metrics_base}.metrics.json and {metrics_base}.prom")
+        for stage, stats in summary["stages"].items():
+            print(f"  {stage:<14} {stats['seconds']:>9.1f}s  {stats['share_of_wall']:>6.1%}")
+        print(f"  tokens/sec     {summary['tokens_per_sec']:>9.1f}")
 
     print("Done.")
 
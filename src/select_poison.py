@@ -0,0 +1,205 @@
+import json
+import argparse
+import torch
+from tqdm import tqdm
+from src.utils import load_images_from_metadata
+
+
+def candidate_matrix(poisoned_metadata: dict):
+    """
+    Flatten every image's poisoned candidates into one list.
+    Returns (image_ids, texts, segment) where segment[j] is the position in
+    image_ids of the image that candidate j belongs to.
+    """
+    image_ids, texts, segment = [], [], []
+    for img_id, meta in poisoned_metadata.items():
+        if not meta["poisoned_candidates"]:
+            continue
+        image_ids.append(img_id)
+        texts.extend(meta["poisoned_candidates"])
+        segment.extend([len(image_ids) - 1] * len(meta["poisoned_candidates"]))
+    return image_ids, texts, torch.tensor(segment, dtype=torch.long)
+
+
+def image_embeddings(retriever, image_ids, poisoned_metadata, image_dir,
+                     embedding_store=None, batch_size=256):
+    """
+    Embeddings of `image_ids` plus a mask of which ones are available.
+    Rows come from the embedding store when possible; the rest are loaded
+    and encoded in large batches.
+    """
+    embs = None
+    available = torch.zeros(len(image_ids), dtype=torch.bool)
+
+    todo = list(range(len(image_ids)))
+    if embedding_store is not None:
+        stored = [i for i in todo if image_ids[i] in embedding_store]
+        if stored:
+            rows = embedding_store.gather([image_ids[i] for i in stored])
+            embs = rows.new_zeros((len(image_ids), rows.shape[1]))
+            embs[stored] = rows
+            available[stored] = True
+        todo = [i for i in todo if image_ids[i] not in embedding_store]
+
+    position = {img_id: i for i, img_id in enumerate(image_ids)}
+    for start in tqdm(range(0, len(todo), batch_size)):
+        images, valid_ids = load_images_from_metadata(
+            image_dir,
+            [image_ids[i] for i in todo[start:start + batch_size]],
+            poisoned_metadata
+        )
+        if not images:
+            continue
+
+        batch_embs = retriever.encode_images(images, valid_ids).cpu()
+        if embs is None:
+            embs = batch_embs.new_zeros((len(image_ids), batch_embs.shape[1]))
+
+        rows = [position[i] for i in valid_ids]
+        embs[rows] = batch_embs
+        available[rows] = True
+
+    return embs, available
+
+
+@torch.no_grad()
+def score_candidates(retriever, target_query, image_ids, texts, segment,
+                     image_embs, image_available, query_weight=0.5):
+    """
+    Score all candidates of all images at once.
+
+    Each candidate gets its cosine similarity to the target query and to
+    the image it was written for; the combined score is a weighted mean
+    (query_weight on the query). Images without an embedding are ranked on
+    the query score alone.
+    """
+    cand_embs = retriever.encode_text(texts).cpu()
+    query_emb = retriever.encode_text([target_query]).cpu()[0]
+
+    query_scores = cand_embs @ query_emb
+    image_scores = (cand_embs * image_embs[segment]).sum(dim=-1)
+
+    has_image = image_available[segment]
+    combined = torch.where(
+        has_image,
+        query_weight * query_scores + (1 - query_weight) * image_scores,
+        query_scores
+    )
+
+    # Per-image argmax via a padded [num_images, max_candidates] matrix
+    counts = torch.bincount(segment, minlength=len(image_ids))
+    offsets = torch.cumsum(counts, 0) - counts
+    col = torch.arange(len(segment)) - offsets[segment]
+
+    padded = torch.full((len(image_ids), int(counts.max())), float("-inf"))
+    padded[segment, col] = combined
+    best = padded.argmax(dim=1)
+
+    return {
+        "query": query_scores,
+        "image": torch.where(has_image, image_scores, torch.full_like(image_scores, float("nan"))),
+        "combined": combined,
+        "best": best,
+        "offsets": offsets,
+        "counts": counts,
+    }
+
+
+def select_poison_captions(retriever, poisoned_metadata, target_query, image_dir,
+                           embedding_store=None, query_weight=0.5):
+    """
+    Choose one candidate per image and write it back into
+    `poisoned_metadata` as `selected_candidate`, with its index and the
+    scores of every candidate.
+    """
+    image_ids, texts, segment = candidate_matrix(poisoned_metadata)
+
+    image_embs, available = image_embeddings(
+        retriever, image_ids, poisoned_metadata, image_dir,
+        embedding_store=embedding_store
+    )
+    if image_embs is None:
+        image_embs = torch.zeros((len(image_ids), 1))
+
+    scores = score_candidates(
+        retriever, target_query, image_ids, texts, segment,
+        image_embs, available, query_weight=query_weight
+    )
+
+    for i, img_id in enumerate(image_ids):
+        start = int(scores["offsets"][i])
+        end = start + int(scores["counts"][i])
+        best = int(scores["best"][i])
+
+        meta = poisoned_metadata[img_id]
+        meta["selected_index"] = best
+        meta["selected_candidate"] = meta["poisoned_candidates"][best]
+        meta["candidate_scores"] = {
+            "query": scores["query"][start:end].tolist(),
+            "image": [
+                None if s != s else s
+                for s in scores["image"][start:end].tolist()
+            ],
+            "combined": scores["combined"][start:end].tolist(),
+        }
+
+    return poisoned_metadata
+
+
+def main():
+    from src.retriever import Retriever
+    from src.embedding_store import ImageEmbeddingStore
+    from src.generate_attack import (
+        TARGET_QUERY,
+        OUTPUT_POISONED_METADATA,
+        save_poisoned_metadata,
+    )
+
+    parser = argparse.ArgumentParser(
+        description="Pick the best poisoned caption per image by CLIP similarity."
+    )
+    parser.add_argument("--poisoned", default=OUTPUT_POISONED_METADATA)
+    parser.add_argument(
+        "--output", default=None,
+        help="defaults to replacing --poisoned (atomically, via a temp file)"
+    )
+    parser.add_argument("--target-query", default=TARGET_QUERY)
+    parser.add_argument("--query-weight", type=float, default=0.5)
+    parser.add_argument("--image-dir", default="datasets/mmqa/final_dataset_images")
+    parser.add_argument("--store-dir", default="cache/embeddings")
+    parser.add_argument("--retriever", default="openai/clip-vit-base-patch32")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    with open(args.poisoned, "r", encoding="utf-8") as f:
+        poisoned_metadata = json.load(f)
+
+    retriever = Retriever(
+        model_id=args.retriever,
+        cache_dir=args.cache_dir,
+        batch_size=args.batch_size
+    )
+
+    embedding_store = ImageEmbeddingStore(args.store_dir, args.retriever)
+    embedding_store = embedding_store.load() if embedding_store.exists() else None
+
+    select_poison_captions(
+        retriever,
+        poisoned_metadata,
+        args.target_query,
+        args.image_dir,
+        embedding_store=embedding_store,
+        query_weight=args.query_weight
+    )
+
+    # Write to a temp file and rename it, so an interrupted run can't leave
+    # the poisoned dataset half-written
+    output = args.output or args.poisoned
+    save_poisoned_metadata(poisoned_metadata, output)
+
+    print(f"Selected candidates for {len(poisoned_metadata)} images, saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
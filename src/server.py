@@ -0,0 +1,394 @@
+import json
+import time
+import queue
+import argparse
+import threading
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from src.utils import load_images_from_metadata
+
+
+class _Request:
+    def __init__(self, kind, example, max_new_tokens):
+        self.kind = kind
+        self.example = example
+        self.max_new_tokens = max_new_tokens
+        self.arrival = time.monotonic()
+        self.future = Future()
+
+
+class Batcher:
+    """
+    Runs all model calls on one thread and batches concurrent requests.
+
+    The worker takes the oldest queued request and keeps collecting until
+    `max_batch_size` requests are in hand or `max_wait` seconds have passed
+    since the oldest one arrived. Generate requests with the same
+    max_new_tokens then go through a single `RAGModel.generate_batch` call,
+    and retrieve requests through one `RAGModel.retrieve_batch` call.
+    """
+
+    def __init__(self, rag, max_batch_size: int = 8, max_wait: float = 0.05):
+        self.rag = rag
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = 0
+        self.batches = 0
+        self._queue = queue.Queue()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, kind: str, example: dict, max_new_tokens: int = None) -> Future:
+        request = _Request(kind, example, max_new_tokens)
+        self._queue.put(request)
+        return request.future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0].arrival + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            self.requests += len(batch)
+            self.batches += 1
+            self._process(batch)
+
+    @staticmethod
+    def _retrieval_output(retrieved):
+        top_image_idx, top_text_idx, image_scores, text_scores = retrieved
+        return {
+            "retrieved_image_indices": top_image_idx,
+            "retrieved_text_indices": top_text_idx,
+            "image_scores": image_scores[top_image_idx].tolist(),
+            "text_scores": text_scores[top_text_idx].tolist(),
+        }
+
+    def _generate_one(self, request):
+        try:
+            request.future.set_result(self.rag.generate(
+                max_new_tokens=request.max_new_tokens, **request.example
+            ))
+        except Exception as e:
+            request.future.set_exception(e)
+
+    def _retrieve_one(self, request):
+        ex = request.example
+        try:
+            request.future.set_result(self._retrieval_output(self.rag.retrieve(
+                ex["question"], ex["images"], ex["texts"],
+                image_ids=ex["image_ids"], text_ids=ex.get("text_ids")
+            )))
+        except Exception as e:
+            request.future.set_exception(e)
+
+    def _process(self, batch):
+        groups = defaultdict(list)
+        retrievals = []
+
+        for request in batch:
+            if request.kind == "retrieve":
+                retrievals.append(request)
+            else:
+                groups[request.max_new_tokens].append(request)
+
+        if len(retrievals) == 1:
+            self._retrieve_one(retrievals[0])
+        elif retrievals:
+            try:
+                results = self.rag.retrieve_batch([r.example for r in retrievals])
+            except Exception as e:
+                print(f"[WARN] Batched retrieval failed ({e}), retrying per request")
+                for request in retrievals:
+                    self._retrieve_one(request)
+            else:
+                for request, retrieved in zip(retrievals, results):
+                    request.future.set_result(self._retrieval_output(retrieved))
+
+        for max_new_tokens, group in groups.items():
+            if len(group) == 1:
+                self._generate_one(group[0])
+                continue
+
+            try:
+                outputs = self.rag.generate_batch(
+                    [r.example for r in group],
+                    max_new_tokens=max_new_tokens,
+                    batch_size=len(group)
+                )
+            except Exception as e:
+                # One bad example shouldn't fail the others
+                print(f"[WARN] Batched generation failed ({e}), retrying per request")
+                for request in group:
+                    self._generate_one(request)
+                continue
+
+            for request, output in zip(group, outputs):
+                request.future.set_result(output)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "queued": self._queue.qsize(),
+        }
+
+
+class RAGServer(ThreadingHTTPServer):
+    """
+    Localhost HTTP server around a resident RAGModel.
+
+    POST /retrieve and POST /generate take
+    {"question", "texts", "image_ids"[, "text_ids", "max_new_tokens"]}, or
+    {"examples": [...], "max_new_tokens"} for several questions at once.
+    Images are loaded here from their doc ids; indices in the responses
+    refer to the request's `image_ids` and `texts`. GET /health and
+    GET /stats report liveness and batching / stage metrics.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, rag, image_dir, image_metadata,
+                 max_batch_size=8, max_wait=0.05, default_max_new_tokens=128):
+        super().__init__(address, _Handler)
+        self.rag = rag
+        self.image_dir = image_dir
+        self.image_metadata = image_metadata
+        self.default_max_new_tokens = default_max_new_tokens
+        self.batcher = Batcher(rag, max_batch_size=max_batch_size, max_wait=max_wait)
+
+    def handle_example(self, kind, example, max_new_tokens):
+        """
+        Load an example's images, run it through the batcher and map image
+        indices back to the request's image_ids. Blocks until done.
+        """
+        request_ids = list(example.get("image_ids") or [])
+        images, image_ids = load_images_from_metadata(
+            self.image_dir, request_ids, self.image_metadata
+        )
+        if not images:
+            raise ValueError("none of the image_ids could be loaded")
+
+        future = self.batcher.submit(kind, {
+            "question": example["question"],
+            "images": images,
+            "texts": list(example["texts"]),
+            "image_ids": image_ids,
+            "text_ids": example.get("text_ids"),
+        }, max_new_tokens)
+        output = future.result()
+
+        position = {doc_id: i for i, doc_id in enumerate(request_ids)}
+        output["retrieved_image_indices"] = [
+            position[image_ids[i]] for i in output["retrieved_image_indices"]
+        ]
+        return output
+
+    def stats(self) -> dict:
+        stats = {"batcher": self.batcher.stats()}
+        if self.rag.metrics is not None:
+            stats["metrics"] = self.rag.metrics.summary()
+        return stats
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok"})
+        elif self.path == "/stats":
+            self._send(200, self.server.stats())
+        else:
+            self._send(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        kind = self.path.strip("/")
+        if kind not in ("retrieve", "generate"):
+            self._send(404, {"error": f"unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length))
+            examples = payload["examples"] if "examples" in payload else [payload]
+            max_new_tokens = int(
+                payload.get("max_new_tokens", self.server.default_max_new_tokens)
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            self._send(400, {"error": f"bad request: {e}"})
+            return
+
+        # Hand every example to the batcher at once so they can share a batch
+        outputs = [None] * len(examples)
+
+        def run(i, example):
+            try:
+                outputs[i] = self.server.handle_example(kind, example, max_new_tokens)
+            except Exception as e:
+                outputs[i] = {"error": str(e)}
+
+        threads = [
+            threading.Thread(target=run, args=(i, ex)) for i, ex in enumerate(examples)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if "examples" in payload:
+            self._send(200, {"outputs": outputs})
+        else:
+            self._send(200, outputs[0])
+
+
+class RAGClient:
+    """
+    Stand-in for RAGModel that sends questions to a running RAGServer.
+
+    `generate` and `generate_batch` return outputs in RAGModel's format;
+    `retrieve` returns a dict of the top-k indices and scores. Images are
+    loaded by the server from `image_ids`, so the `images` arguments are
+    ignored and may be None.
+    """
+
+    metrics = None
+
+    def __init__(self, url: str, timeout: float = 3600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        request = urllib.request.Request(
+            self.url + path,
+            data=data,
+            headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    @staticmethod
+    def _example(question, texts, image_ids, text_ids=None):
+        if image_ids is None:
+            raise ValueError("RAGClient needs image_ids; the server loads the images")
+        example = {"question": question, "texts": list(texts), "image_ids": list(image_ids)}
+        if text_ids is not None:
+            example["text_ids"] = list(text_ids)
+        return example
+
+    @staticmethod
+    def _check(output):
+        if "error" in output:
+            raise RuntimeError(f"server error: {output['error']}")
+        return output
+
+    def health(self) -> dict:
+        return self._request("/health")
+
+    def stats(self) -> dict:
+        return self._request("/stats")
+
+    def retrieve(self, question, images, texts, image_ids=None, text_ids=None):
+        return self._check(
+            self._request("/retrieve", self._example(question, texts, image_ids, text_ids))
+        )
+
+    def generate(self, question, images, texts, max_new_tokens=128, image_ids=None,
+                 text_ids=None):
+        payload = self._example(question, texts, image_ids, text_ids)
+        payload["max_new_tokens"] = max_new_tokens
+        return self._check(self._request("/generate", payload))
+
+    def generate_batch(self, examples, max_new_tokens=128, batch_size=8):
+        """
+        Send `examples` in one request; the server batches them with any
+        other clients' requests (`batch_size` is decided by the server).
+        """
+        response = self._request("/generate", {
+            "examples": [
+                self._example(
+                    ex["question"], ex["texts"], ex.get("image_ids"), ex.get("text_ids")
+                )
+                for ex in examples
+            ],
+            "max_new_tokens": max_new_tokens,
+        })
+        return [self._check(output) for output in response["outputs"]]
+
+
+def main():
+    from src import run_rag
+    from src.datasets import DATASETS, load_image_metadata
+    from src.metrics import RunMetrics
+
+    parser = argparse.ArgumentParser(
+        description="Serve a resident RAGModel over localhost HTTP with dynamic batching."
+    )
+    parser.add_argument("--dataset", default=run_rag.DATASET, choices=list(DATASETS))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--max-batch-size", type=int, default=run_rag.GENERATION_BATCH_SIZE)
+    parser.add_argument(
+        "--max-wait-ms", type=float, default=50,
+        help="how long the oldest request waits for others to batch with"
+    )
+    args = parser.parse_args()
+
+    run_rag.use_dataset(args.dataset)
+    image_metadata = load_image_metadata(args.dataset)
+
+    metrics = RunMetrics() if run_rag.COLLECT_METRICS else None
+    rag = run_rag.build_rag(metrics)
+
+    print("Loading models...")
+    rag.retriever.load()
+    rag.generator.load()
+
+    server = RAGServer(
+        (args.host, args.port),
+        rag,
+        run_rag.IMAGE_DIR,
+        image_metadata,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait_ms / 1000,
+        default_max_new_tokens=run_rag.MAX_NEW_TOKENS
+    )
+    print(f"Serving on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        run_rag.close_rag(rag)
+
+
+if __name__ == "__main__":
+    main()
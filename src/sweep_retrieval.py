@@ -0,0 +1,228 @@
+import json
+import argparse
+from collections import defaultdict
+import numpy as np
+from tqdm import tqdm
+from src.utils import ImagePrefetcher, JSONLWriter
+
+
+def gold_image_ids(ex):
+    return {
+        img["doc_id"]
+        for ans in ex.get("answers", [])
+        for img in ans.get("image_instances", [])
+    }
+
+
+def poison_variants(image_ids, poisoned_metadata):
+    """
+    Poison variants for a question, following run_rag.py's injection rule
+    (the first candidate image that has poisoned candidates):
+    "clean" (no poison), "candidate_<j>" for every candidate and
+    "selected" when select_poison has been run.
+    """
+    variants = {"clean": None}
+    if poisoned_metadata is None:
+        return variants, None
+
+    for img_id in image_ids:
+        meta = poisoned_metadata.get(img_id)
+        if meta and meta["poisoned_candidates"]:
+            for j, cand in enumerate(meta["poisoned_candidates"]):
+                variants[f"candidate_{j}"] = cand
+            if meta.get("selected_candidate"):
+                variants["selected"] = meta["selected_candidate"]
+            return variants, img_id
+
+    return variants, None
+
+
+def rank_against(pool_scores, scores):
+    """
+    1-based rank of each score in `scores` if it were added to a pool with
+    `pool_scores` (ties rank after the pool). The poison is appended last
+    to run_rag.py's pool; torch.topk in `retrieve` gives no guaranteed
+    order among exactly tied scores, so this takes the conservative one.
+    """
+    ordered = np.sort(pool_scores)
+    return 1 + len(ordered) - np.searchsorted(ordered, scores, side="left")
+
+
+def sweep_question(ex, image_ids, caption_owners, text_table, query_emb, image_embs,
+                   poisoned_metadata, top_k_texts, top_k_images):
+    """
+    Rank table rows for one question: one per (poison variant,
+    top_k_texts, top_k_images), computed from a single set of scores.
+
+    `caption_owners` is the clean caption pool as (caption, image_id)
+    pairs, as built by run_rag.py; `text_table` maps every caption and
+    poison text to its embedding.
+    """
+    variants, poisoned_image = poison_variants(image_ids, poisoned_metadata)
+    names = list(variants.keys())
+    injected = np.array([variants[n] is not None for n in names])
+
+    clean_scores = np.array(
+        [text_table[t] @ query_emb for t, _ in caption_owners], dtype=np.float32
+    )
+
+    # Poison score per variant (-inf for "clean", i.e. never retrieved)
+    poison_scores = np.array([
+        text_table[variants[n]] @ query_emb if variants[n] is not None else -np.inf
+        for n in names
+    ], dtype=np.float32)
+    poison_ranks = rank_against(clean_scores, poison_scores)
+
+    # Best-ranked clean caption of a gold image, with each variant's poison in the pool
+    golds = gold_image_ids(ex)
+    gold_scores = [s for s, (_, img_id) in zip(clean_scores, caption_owners) if img_id in golds]
+    gold_caption_rank = None
+    if gold_scores:
+        best_gold = max(gold_scores)
+        base_rank = 1 + int((clean_scores > best_gold).sum())
+        # A poison tied with the gold caption ranks after it, as in rank_against
+        gold_caption_rank = base_rank + (poison_scores > best_gold)
+
+    image_scores = image_embs @ query_emb
+    gold_image_scores = [s for s, img_id in zip(image_scores, image_ids) if img_id in golds]
+    gold_image_rank = (
+        1 + int((image_scores > max(gold_image_scores)).sum())
+        if gold_image_scores else None
+    )
+
+    # Vectorized top-k membership for every (variant, k) pair
+    ks_t = np.array(top_k_texts)
+    ks_i = np.array(top_k_images)
+    poison_in = injected[:, None] & (poison_ranks[:, None] <= ks_t[None, :])
+    gold_caption_in = (
+        gold_caption_rank[:, None] <= ks_t[None, :]
+        if gold_caption_rank is not None
+        else np.zeros((len(names), len(ks_t)), dtype=bool)
+    )
+    gold_image_in = (
+        gold_image_rank <= ks_i
+        if gold_image_rank is not None
+        else np.zeros(len(ks_i), dtype=bool)
+    )
+
+    rows = []
+    for v, name in enumerate(names):
+        for t, k_t in enumerate(top_k_texts):
+            for i, k_i in enumerate(top_k_images):
+                rows.append({
+                    "qid": ex.get("qid"),
+                    "variant": name,
+                    "top_k_texts": k_t,
+                    "top_k_images": k_i,
+                    "poisoned_image": poisoned_image if injected[v] else None,
+                    "poison_rank": int(poison_ranks[v]) if injected[v] else None,
+                    "poison_retrieved": bool(poison_in[v, t]),
+                    "gold_caption_rank": (
+                        int(gold_caption_rank[v]) if gold_caption_rank is not None else None
+                    ),
+                    "gold_caption_retrieved": bool(gold_caption_in[v, t]),
+                    "gold_image_rank": gold_image_rank,
+                    "gold_image_retrieved": bool(gold_image_in[i]),
+                })
+    return rows
+
+
+def main():
+    from src.retriever import Retriever
+    from src.rag_model import RAGModel
+    from src.embedding_store import ImageEmbeddingStore
+    from src.utils import load_mmqa_json
+    from src import run_rag
+
+    parser = argparse.ArgumentParser(
+        description="Retrieval-only sweep over top-k settings and poison variants."
+    )
+    parser.add_argument("--top-k-texts", type=int, nargs="+", default=[1, 2, 3, 5])
+    parser.add_argument("--top-k-images", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--no-poison", action="store_true", help="only the clean variant")
+    parser.add_argument("--output", default="results/retrieval_sweep.jsonl")
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args()
+
+    with open(run_rag.IMAGE_METADATA_PATH, "r") as f:
+        image_metadata = json.load(f)
+
+    poisoned_metadata = None
+    if not args.no_poison:
+        with open(run_rag.POISONED_METADATA_PATH, "r") as f:
+            poisoned_metadata = json.load(f)
+
+    data = load_mmqa_json(run_rag.DATA_PATH)
+    print(f"Loaded {len(data)} examples")
+
+    retriever = Retriever(
+        model_id=run_rag.RETRIEVER_ID,
+        cache_dir=run_rag.CACHE_DIR,
+        batch_size=args.batch_size
+    )
+
+    embedding_store = ImageEmbeddingStore(run_rag.EMBEDDING_STORE_DIR, run_rag.RETRIEVER_ID)
+    embedding_store = embedding_store.load() if embedding_store.exists() else None
+    rag = RAGModel(retriever, None, embedding_store=embedding_store)
+
+    # Encode every question and every distinct caption / poison text once
+    print("Encoding questions and captions...")
+    query_embs = retriever.encode_text([ex["question"] for ex in data]).cpu().numpy()
+
+    texts = {
+        meta["caption"] for meta in image_metadata.values() if meta.get("caption")
+    }
+    if poisoned_metadata is not None:
+        for meta in poisoned_metadata.values():
+            texts.update(meta["poisoned_candidates"])
+            if meta.get("selected_candidate"):
+                texts.add(meta["selected_candidate"])
+    texts = sorted(texts)
+    text_table = dict(zip(texts, retriever.encode_text(texts).cpu().numpy()))
+
+    if embedding_store is not None:
+        # Embeddings come from the store, so images never need decoding
+        image_sets = (
+            (None, [i for i in ex["metadata"]["image_doc_ids"] if i in embedding_store])
+            for ex in data
+        )
+    else:
+        prefetcher = ImagePrefetcher(run_rag.IMAGE_DIR, image_metadata)
+        image_sets = prefetcher.iterate(ex["metadata"]["image_doc_ids"] for ex in data)
+
+    summary = defaultdict(lambda: [0, 0, 0])
+
+    with JSONLWriter(args.output, fsync_every=1000) as writer:
+        for q, (ex, (images, image_ids)) in enumerate(
+            tqdm(zip(data, image_sets), total=len(data))
+        ):
+            if not image_ids:
+                continue
+
+            caption_owners = [
+                (image_metadata[i]["caption"], i)
+                for i in image_ids
+                if image_metadata.get(i, {}).get("caption")
+            ]
+            image_embs = rag.encode_images(images, image_ids).cpu().numpy()
+
+            for row in sweep_question(
+                ex, image_ids, caption_owners, text_table,
+                query_embs[q], image_embs, poisoned_metadata,
+                args.top_k_texts, args.top_k_images
+            ):
+                writer.write(row)
+
+                key = (row["variant"], row["top_k_texts"], row["top_k_images"])
+                summary[key][0] += 1
+                summary[key][1] += row["poison_retrieved"]
+                summary[key][2] += row["gold_image_retrieved"]
+
+    print(f"Wrote rank table to {args.output}")
+    print(f"{'variant':<14} {'k_txt':>5} {'k_img':>5} {'n':>6} {'poison@k':>9} {'gold_img@k':>10}")
+    for (variant, k_t, k_i), (n, poisoned, gold) in sorted(summary.items()):
+        print(f"{variant:<14} {k_t:>5} {k_i:>5} {n:>6} {poisoned / n:>9.3f} {gold / n:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
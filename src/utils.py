@@ -1,7 +1,10 @@
 import os
 import json
 import gzip
-from PIL import Image, UnidentifiedImageError
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 
 def load_mmqa_json(path):
@@ -10,6 +13,15 @@ def load_mmqa_json(path):
 
 
 def load_text_corpus(path):
+    """
+    id -> text for the MMQA text corpus. A store built by
+    `python -m src.corpus_store` (.sqlite) is opened lazily instead of
+    reading the whole .jsonl.gz into memory.
+    """
+    if path.endswith(".sqlite"):
+        from src.corpus_store import CorpusStore
+        return CorpusStore(path).field("text")
+
     corpus = {}
     with gzip.open(path, "rt", encoding="utf-8") as f:
         for line in f:
@@ -18,7 +30,131 @@ def load_text_corpus(path):
     return corpus
 
 
+def read_jsonl(path):
+    """
+    Iterate over the records of a JSONL file.
+    A truncated final line (e.g. from a crashed run) is ignored.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            if line.strip():
+                yield json.loads(line)
+
+
+class JSONLWriter:
+    """
+    Append-only JSONL writer for long runs.
+
+    Each record is flushed as soon as it is written and the file is fsynced
+    every `fsync_every` records. Opening an existing file drops a partially
+    written last line so new records can be appended after a crash.
+    """
+
+    def __init__(self, path, fsync_every=20):
+        self.path = path
+        self.fsync_every = fsync_every
+        self._since_sync = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._truncate_partial_line()
+        self.f = open(path, "a", encoding="utf-8")
+
+    def _truncate_partial_line(self):
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def write(self, record):
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+
+        self._since_sync += 1
+        if self._since_sync >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self._since_sync = 0
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_done_qids(path):
+    """
+    qids already written to a JSONL results file (empty if it doesn't exist).
+    Error records don't count, so failed questions are retried on resume.
+    """
+    if not os.path.exists(path):
+        return set()
+    return {r.get("qid") for r in read_jsonl(path) if "error" not in r}
+
+
+def latest_per_qid(records, qid=lambda r: r.get("qid")):
+    """
+    Keep only the last record of each qid (e.g. the retry that replaced an
+    error record on resume), in the order of those last records. Records
+    without a qid are all kept.
+    """
+    latest = {}
+    for n, record in enumerate(records):
+        key = qid(record)
+        if key is None:
+            key = (None, n)
+        latest.pop(key, None)
+        latest[key] = record
+    return list(latest.values())
+
+
+def shard_of(qid, num_shards):
+    """
+    Deterministic shard assignment for a question id.
+    """
+    digest = hashlib.md5(str(qid).encode("utf-8")).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def shard_path(path, shard_id, num_shards):
+    """
+    Per-shard output path, e.g. results.jsonl -> results.shard1of4.jsonl
+    """
+    if num_shards == 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard_id}of{num_shards}{ext}"
+
+
+def existing_image_ids(image_dir, image_doc_ids, image_metadata):
+    """
+    The doc ids whose image file exists, without decoding them. Files that
+    exist but fail to decode are still returned.
+    """
+    return [
+        img_id for img_id in image_doc_ids
+        if img_id in image_metadata
+        and os.path.exists(os.path.join(image_dir, image_metadata[img_id]["path"]))
+    ]
+
+
 def load_images_from_metadata(image_dir, image_doc_ids, image_metadata):
+    from PIL import Image, UnidentifiedImageError
+
     images = []
     valid_ids = []
 
@@ -41,3 +177,51 @@ def load_images_from_metadata(image_dir, image_doc_ids, image_metadata):
         valid_ids.append(img_id)
 
     return images, valid_ids
+
+
+class ImagePrefetcher:
+    """
+    Decode the image sets of upcoming questions on a thread pool.
+
+    `iterate(image_doc_id_lists)` yields `load_images_from_metadata` results
+    in order, while up to `prefetch` later sets are already being decoded.
+    At most `prefetch` decoded sets are held at once, which bounds memory.
+    `wait_time` accumulates how long the consumer was blocked waiting.
+    """
+
+    def __init__(self, image_dir, image_metadata, num_workers=4, prefetch=8):
+        self.image_dir = image_dir
+        self.image_metadata = image_metadata
+        self.num_workers = num_workers
+        self.prefetch = max(1, prefetch)
+        self.wait_time = 0.0
+
+    def _load(self, image_doc_ids):
+        return load_images_from_metadata(
+            self.image_dir, image_doc_ids, self.image_metadata
+        )
+
+    def iterate(self, image_doc_id_lists):
+        id_lists = iter(image_doc_id_lists)
+        pending = deque()
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+
+            def fill():
+                while len(pending) < self.prefetch:
+                    try:
+                        ids = next(id_lists)
+                    except StopIteration:
+                        return
+                    pending.append(pool.submit(self._load, ids))
+
+            fill()
+            while pending:
+                future = pending.popleft()
+
+                start = time.perf_counter()
+                result = future.result()
+                self.wait_time += time.perf_counter() - start
+
+                fill()
+                yield result
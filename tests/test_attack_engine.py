@@ -0,0 +1,101 @@
+import json
+import torch
+from test_rag_model import FakeRetriever
+from src.attack_engine import AttackEngine, complete_qids
+from src.rag_model import RAGModel
+from src.utils import read_jsonl
+
+
+IMAGE_IDS = ["i1", "i2", "i3", "i4"]
+TEXTS = ["c1", "c2", "c3", "c4", "c5"]
+
+
+def engine(top_k_texts=2):
+    rag = RAGModel(FakeRetriever(), None, top_k_images=2, top_k_texts=top_k_texts)
+    # Echo the prompt back as the answer
+    rag.generate_prompts = lambda items, max_new_tokens, batch_size: [
+        item["prompt"] for item in items
+    ]
+    return AttackEngine(rag)
+
+
+def candidate_that(rag, question, enters):
+    """
+    A caption that does (or doesn't) make it into the clean pool's top-k.
+    """
+    _, _, _, text_scores = rag.retrieve(question, IMAGE_IDS, TEXTS, image_ids=IMAGE_IDS)
+    kth = text_scores.topk(rag.top_k_texts).values[-1]
+    for n in range(1000):
+        text = f"poison {n}"
+        score = rag.retriever.score_texts(
+            rag.retriever.encode_text([question]), rag.retriever.encode_text([text])
+        )[0, 0]
+        if (score > kth) == enters:
+            return text
+
+
+def test_variant_topk_matches_retrieve_with_the_poison_appended():
+    attack = engine()
+    rag = attack.rag
+    question = "who built the tower?"
+    variants = {"clean": None}
+    for n in range(12):
+        variants[f"candidate_{n}"] = f"poison {n}"
+
+    rows, _ = attack.prepare(
+        {"qid": "q", "question": question}, IMAGE_IDS, IMAGE_IDS, TEXTS, variants, "i1"
+    )
+
+    assert {row["poison_retrieved"] for row in rows} == {True, False}
+    for row in rows:
+        poison = variants[row["variant"]]
+        pool = TEXTS + [poison] if poison is not None else TEXTS
+        top_images, top_texts, image_scores, text_scores = rag.retrieve(
+            question, IMAGE_IDS, pool, image_ids=IMAGE_IDS
+        )
+
+        assert row["retrieved_image_ids"] == [IMAGE_IDS[i] for i in top_images]
+        assert row["retrieved_captions"] == [pool[i] for i in top_texts]
+        torch.testing.assert_close(torch.tensor(row["text_scores"]), text_scores[top_texts])
+        assert row["poison_retrieved"] == (poison is not None and len(TEXTS) in top_texts)
+
+
+def test_only_candidates_in_the_topk_are_regenerated():
+    attack = engine()
+    question = "who built the tower?"
+    inside = candidate_that(attack.rag, question, enters=True)
+    outside = candidate_that(attack.rag, question, enters=False)
+    variants = {"clean": None, "candidate_0": inside, "candidate_1": outside}
+
+    questions = [attack.prepare(
+        {"qid": "q", "question": question}, IMAGE_IDS, IMAGE_IDS, TEXTS, variants, "i1"
+    )]
+    # Clean and candidate_1 share a prompt
+    assert len(questions[0][1]) == 2
+
+    rows = {row["variant"]: row for row in attack.run_window(questions)}
+    assert [rows[v]["regenerated"] for v in variants] == [False, True, False]
+    assert inside in rows["candidate_0"]["model_answer"]
+    assert rows["candidate_1"]["model_answer"] == rows["clean"]["model_answer"]
+    assert all(row["clean_answer"] == rows["clean"]["model_answer"] for row in rows.values())
+    assert all(row["num_variants"] == 3 for row in rows.values())
+
+
+def test_complete_qids_drops_cut_off_questions(tmp_path):
+    path = tmp_path / "attack.jsonl"
+    rows = [
+        {"qid": "a", "variant": "clean", "num_variants": 2},
+        {"qid": "a", "variant": "candidate_0", "num_variants": 2},
+        {"qid": "b", "variant": "clean", "num_variants": 3},
+        {"qid": "b", "variant": "candidate_0", "num_variants": 3},
+    ]
+    path.write_text("".join(json.dumps(r) + "\n" for r in rows))
+
+    assert complete_qids(str(path)) == {"a"}
+    # b's partial rows are gone, so its full set can be appended on resume
+    assert list(read_jsonl(str(path))) == rows[:2]
+    assert complete_qids(str(path)) == {"a"}
+
+
+def test_complete_qids_without_a_file(tmp_path):
+    assert complete_qids(str(tmp_path / "missing.jsonl")) == set()
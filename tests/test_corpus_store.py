@@ -0,0 +1,64 @@
+import gzip
+import json
+import pytest
+from src.corpus_store import CorpusStore, MMQA_SOURCES
+from src.utils import load_text_corpus
+
+
+def write_corpus(path, records):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for r in records:
+            f.write(json.dumps(r) + "\n")
+    return str(path)
+
+
+@pytest.fixture
+def texts(tmp_path):
+    records = [{"id": f"t{i}", "text": f"text {i}"} for i in range(25)]
+    # A later duplicate replaces the earlier record, as a dict would
+    records.append({"id": "t3", "text": "replaced"})
+    return write_corpus(tmp_path / "MMQA_texts.jsonl.gz", records)
+
+
+def test_store_behaves_like_the_loaded_dict(tmp_path, texts):
+    store = CorpusStore.build(texts, str(tmp_path / "texts.sqlite"))
+    expected = {r["id"]: r for r in map(json.loads, gzip.open(texts, "rt"))}
+
+    assert len(store) == len(expected) == 25
+    assert sorted(store) == sorted(expected)
+    assert store["t3"] == {"id": "t3", "text": "replaced"}
+    assert "t24" in store and "missing" not in store
+    with pytest.raises(KeyError):
+        store["missing"]
+    assert dict(store.items()) == expected
+    store.close()
+
+
+def test_get_many_and_field_view(tmp_path, texts):
+    path = str(tmp_path / "texts.sqlite")
+    CorpusStore.build(texts, path)
+
+    store = CorpusStore(path)
+    assert store.get_many(["t1", "missing", "t2", "t1"]) == {
+        "t1": {"id": "t1", "text": "text 1"},
+        "t2": {"id": "t2", "text": "text 2"},
+    }
+
+    text = load_text_corpus(path)
+    assert text["t5"] == "text 5"
+    assert text.get_many(["t5", "t6"]) == {"t5": "text 5", "t6": "text 6"}
+    assert dict(text.items()) == load_text_corpus(texts)
+
+
+def test_is_stale(tmp_path, texts):
+    store = CorpusStore.build(texts, str(tmp_path / "texts.sqlite"))
+    assert not store.is_stale(texts)
+
+    write_corpus(texts, [{"id": "new", "text": "a different corpus"}])
+    assert store.is_stale(texts)
+
+
+def test_build_uses_the_id_field(tmp_path):
+    source = write_corpus(tmp_path / "MMQA_dev.jsonl.gz", [{"qid": "q1", "question": "?"}])
+    store = CorpusStore.build(source, str(tmp_path / "dev.sqlite"), MMQA_SOURCES["dev"][1])
+    assert store["q1"]["question"] == "?"
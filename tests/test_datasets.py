@@ -0,0 +1,94 @@
+import json
+import numpy as np
+import torch
+from src.caption_store import CaptionEmbeddingStore
+from src.datasets import IndexMap, webqa_examples
+from src.rag_model import RAGModel
+
+
+def test_index_map_lookups():
+    index_map = IndexMap(["img9", "img2", "img5", "img1"])
+
+    assert index_map.index_of(["img5", "missing", "img9", "img1"]).tolist() == [2, -1, 0, 3]
+    assert index_map.index_of([]).tolist() == []
+    assert IndexMap([]).index_of(["img1"]).tolist() == [-1]
+    assert index_map.id_of([3, 1]) == ["img1", "img2"]
+    assert index_map.contains(["img2", "img3"]).tolist() == [True, False]
+
+
+def test_index_map_load(tmp_path):
+    path = tmp_path / "index_to_id.json"
+    path.write_text(json.dumps({"1": 20, "0": 10, "2": 30}))
+
+    index_map = IndexMap.load(str(path))
+    assert len(index_map) == 3
+    assert index_map.index_of(["30", "10"]).tolist() == [2, 0]
+
+
+def test_webqa_examples():
+    raw = {"g1": {
+        "Q": '"What color is the roof?"',
+        "A": ['"Red"'],
+        "img_posFacts": [{"image_id": 7}],
+        "img_negFacts": [{"image_id": 8}, {"image_id": 7}],
+    }}
+
+    assert webqa_examples(raw) == [{
+        "qid": "g1",
+        "question": "What color is the roof?",
+        "answers": [{"answer": "Red", "image_instances": [{"doc_id": "7"}]}],
+        "metadata": {"image_doc_ids": ["7", "8"]},
+    }]
+
+
+class TextRetriever:
+    model_id = "fake-clip"
+    device = "cpu"
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode_text(self, texts):
+        self.encoded.extend(texts)
+        return torch.tensor([[len(t) / 10, t.count("a") / 3, 1 / 3] for t in texts])
+
+
+def build_store(tmp_path, retriever):
+    metadata = {
+        "img1": {"caption": "a tower"},
+        "img2": {"caption": "a river at night"},
+        "img3": {"caption": ""},
+        "img4": {"caption": "a tower"},
+    }
+    return CaptionEmbeddingStore.build(
+        str(tmp_path), retriever, "mmqa", IndexMap(["img1", "img2", "img3", "img4"]), metadata
+    )
+
+
+def test_caption_store_rows_by_doc_id(tmp_path):
+    store = build_store(tmp_path, TextRetriever())
+
+    # img3 has no caption; a poison has no doc id; a wrong caption is not a hit
+    rows = store.rows_of(
+        ["a river at night", "poison", "a tower", "stale caption", "a tower"],
+        ["img2", None, "img4", "img1", "img3"]
+    )
+    assert rows.tolist() == [1, -1, 2, -1, -1]
+    assert store.rows_of(["a tower", "poison"]).tolist() == [0, -1]
+    assert store.embeddings.dtype == np.float32
+
+
+def test_rag_model_only_encodes_captions_missing_from_the_store(tmp_path):
+    retriever = TextRetriever()
+    store = build_store(tmp_path, retriever)
+    retriever.encoded = []
+
+    texts = ["a tower", "a river at night", "apply at the endowment office"]
+    text_ids = ["img1", "img2", None]
+    rag = RAGModel(retriever, None, caption_store=store)
+
+    embs = rag.encode_texts(texts, text_ids)
+
+    assert retriever.encoded == ["apply at the endowment office"]
+    # Stored rows score exactly like fresh encodings
+    torch.testing.assert_close(embs, TextRetriever().encode_text(texts), rtol=0, atol=0)
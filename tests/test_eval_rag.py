@@ -0,0 +1,86 @@
+import json
+import pytest
+from src.eval_rag import evaluate, evaluate_attack, exact_match, iter_json_array, score_results
+
+
+def record(qid, answer, gold, **extra):
+    return {"qid": qid, "model_answer": answer, "gold_answers": [{"answer": gold}], **extra}
+
+
+def write_jsonl(path, records):
+    path.write_text("".join(json.dumps(r) + "\n" for r in records))
+    return str(path)
+
+
+def test_exact_match_normalizes():
+    assert exact_match("The Horses.", ["horse"])
+    assert not exact_match("cow", ["horse"])
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_iter_json_array_streams_across_chunks(tmp_path, chunk_size):
+    records = [record(f"q{i}", "a, [b]", "a") for i in range(20)]
+    path = tmp_path / "results.json"
+    path.write_text(json.dumps(records, indent=2))
+
+    assert list(iter_json_array(str(path), chunk_size=chunk_size)) == records
+
+
+def test_iter_json_array_rejects_non_lists(tmp_path):
+    path = tmp_path / "results.json"
+    path.write_text('{"qid": "a"}')
+
+    with pytest.raises(ValueError):
+        list(iter_json_array(str(path)))
+
+
+def test_parallel_scoring_matches_serial(tmp_path):
+    records = [record(f"q{i}", "yes" if i % 3 else "no", "yes") for i in range(50)]
+    records.append({"qid": "q50", "error": "oom"})
+    path = write_jsonl(tmp_path / "run.jsonl", records)
+
+    serial = sorted(score_results(path, workers=1))
+    parallel = sorted(score_results(path, workers=2))
+    assert serial == parallel
+    assert sum(1 for s in serial if s[1]) == 50
+
+
+def test_evaluate_attack_joins_runs_by_qid(tmp_path, capsys):
+    clean = write_jsonl(tmp_path / "clean.jsonl", [
+        record("a", "paris", "paris"),
+        record("b", "rome", "rome"),
+        record("c", "oslo", "oslo"),
+    ])
+    # Different order; "d" has no clean counterpart and "c" failed
+    poisoned = write_jsonl(tmp_path / "poisoned.jsonl", [
+        record("d", "x", "x", poison_injected=True, poison_retrieved=False),
+        record("b", "endowment office", "rome", poison_injected=True, poison_retrieved=True),
+        record("a", "paris", "paris", poison_injected=True, poison_retrieved=True),
+        {"qid": "c", "error": "oom"},
+    ])
+
+    evaluate_attack(clean, poisoned)
+    out = capsys.readouterr().out
+
+    assert "Clean EM:               1.0000 (3/3)" in out
+    assert "Poisoned EM:            0.6667 (2/3)" in out
+    assert "Retrieval poison rate:  0.6667 (2/3)" in out
+    assert "Joined questions:       2" in out
+    assert "Answer flip rate:       0.5000 (1/2)" in out
+    assert "Correct -> incorrect:   0.5000 (1/2)" in out
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_resumed_runs_score_the_last_record_per_qid(tmp_path, capsys, workers):
+    path = write_jsonl(tmp_path / "run.jsonl", [
+        {"qid": "a", "error": "oom"},
+        record("b", "rome", "rome"),
+        record("a", "paris", "paris"),
+    ])
+
+    assert sorted(s[0] for s in score_results(path, workers)) == ["a", "b"]
+
+    evaluate(path, workers)
+    out = capsys.readouterr().out
+    assert "Total evaluated: 2" in out
+    assert "Skipped:         0" in out
@@ -0,0 +1,160 @@
+import time
+import random
+import asyncio
+import argparse
+import pytest
+from src import generate_attack
+from src.generate_attack import (
+    ResponseCache,
+    TokenBucket,
+    backoff_delay,
+    parse_candidates,
+    run_sync,
+)
+
+
+def test_parse_candidates():
+    raw = (
+        "Here are the candidates:\n"
+        "1. “A campus lawn. Applications moved off-site.”\n"
+        "\n"
+        "  2. Students at a desk, e.g. filing forms.\n"
+        "10. “Tenth caption”\n"
+        "- not a candidate\n"
+        "2025 deadlines\n"
+    )
+    assert parse_candidates(raw) == [
+        "A campus lawn. Applications moved off-site.",
+        "Students at a desk, e.g. filing forms.",
+        "Tenth caption",
+    ]
+
+
+def test_backoff_delay_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda low, high: high)
+    assert [backoff_delay(a, base=1.0, max_delay=10.0) for a in range(6)] == [1, 2, 4, 8, 10, 10]
+
+    monkeypatch.setattr(random, "uniform", lambda low, high: low)
+    assert backoff_delay(3) == 0
+
+
+def test_token_bucket_allows_a_burst_then_limits_the_rate():
+    bucket = TokenBucket(rate=50, capacity=2)
+
+    start = time.monotonic()
+    for _ in range(2):
+        bucket.acquire_sync()
+    assert time.monotonic() - start < 0.02
+
+    for _ in range(3):
+        bucket.acquire_sync()
+    # Three more tokens at 50/s
+    assert time.monotonic() - start >= 0.055
+
+
+def test_token_bucket_async():
+    async def run():
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.monotonic()
+        await asyncio.gather(*(bucket.acquire() for _ in range(4)))
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.055
+
+
+def test_response_cache_persists(tmp_path):
+    path = str(tmp_path / "responses.jsonl")
+    key = ResponseCache.key("model", "prompt", 0.7)
+    assert key != ResponseCache.key("model", "prompt", 0.0)
+    assert key != ResponseCache.key("other", "prompt", 0.7)
+
+    cache = ResponseCache(path)
+    assert cache.get(key) is None
+    cache.put(key, "1. caption")
+    cache.close()
+
+    cache = ResponseCache(path)
+    assert cache.get(key) == "1. caption"
+    cache.close()
+
+
+class FakeCompletions:
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def create(self, model, messages, temperature):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        message = argparse.Namespace(content="1. “poison”")
+        return argparse.Namespace(choices=[argparse.Namespace(message=message)])
+
+
+class TransientError(Exception):
+    pass
+
+
+def test_retryable_errors():
+    openai = pytest.importorskip("openai")
+    retryable = generate_attack.retryable_errors()
+
+    for error in (openai.RateLimitError, openai.APIConnectionError,
+                  openai.APITimeoutError, openai.InternalServerError):
+        assert issubclass(error, retryable)
+    for error in (openai.BadRequestError, openai.AuthenticationError, openai.NotFoundError):
+        assert not issubclass(error, retryable)
+
+
+def sync_run(tmp_path, monkeypatch, errors, max_retries=2, rate=0):
+    openai = pytest.importorskip("openai")
+    completions = FakeCompletions(errors)
+
+    class FakeOpenAI:
+        def __init__(self, **kwargs):
+            self.chat = argparse.Namespace(completions=completions)
+
+    monkeypatch.setattr(openai, "OpenAI", FakeOpenAI)
+    monkeypatch.setattr(generate_attack, "retryable_errors", lambda: (TransientError,))
+    monkeypatch.setattr(generate_attack, "backoff_delay", lambda attempt: 0)
+
+    args = argparse.Namespace(
+        base_url="http://localhost", model="m", temperature=0.7, rate=rate,
+        max_retries=max_retries, checkpoint_every=100, output=str(tmp_path / "out.json")
+    )
+    cache = ResponseCache(str(tmp_path / "responses.jsonl"))
+    poisoned_metadata = {}
+    try:
+        run_sync(
+            [("img", {"path": "img.png", "caption": "clean"}, "prompt")],
+            args, cache, poisoned_metadata
+        )
+    finally:
+        cache.close()
+    return completions.calls, poisoned_metadata
+
+
+def test_retryable_errors_are_retried(tmp_path, monkeypatch):
+    calls, poisoned = sync_run(tmp_path, monkeypatch, [TransientError(), TransientError()])
+    assert calls == 3
+    assert poisoned["img"]["poisoned_candidates"] == ["poison"]
+
+
+def test_retries_give_up_after_max_retries(tmp_path, monkeypatch):
+    calls, poisoned = sync_run(tmp_path, monkeypatch, [TransientError()] * 5, max_retries=2)
+    assert calls == 3
+    assert poisoned == {}
+
+
+def test_other_errors_are_not_retried(tmp_path, monkeypatch):
+    with pytest.raises(ValueError):
+        sync_run(tmp_path, monkeypatch, [ValueError("bad request")])
+
+
+def test_sync_mode_takes_a_token_per_request(tmp_path, monkeypatch):
+    acquired = []
+    monkeypatch.setattr(TokenBucket, "acquire_sync", lambda self: acquired.append(self.rate))
+
+    calls, _ = sync_run(tmp_path, monkeypatch, [TransientError()], rate=3.0)
+    assert calls == 2
+    assert acquired == [3.0, 3.0]
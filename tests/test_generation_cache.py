@@ -0,0 +1,48 @@
+import itertools
+from src import generation_cache
+from src.generation_cache import GenerationCache
+
+
+def test_key_depends_on_every_input():
+    base = GenerationCache.key("llava", "prompt", ["img1"], {"max_new_tokens": 8})
+
+    assert base == GenerationCache.key("llava", "prompt", ("img1",), {"max_new_tokens": 8})
+    assert base != GenerationCache.key("qwen", "prompt", ["img1"], {"max_new_tokens": 8})
+    assert base != GenerationCache.key("llava", "prompt!", ["img1"], {"max_new_tokens": 8})
+    assert base != GenerationCache.key("llava", "prompt", ["img2"], {"max_new_tokens": 8})
+    assert base != GenerationCache.key("llava", "prompt", ["img1"], {"max_new_tokens": 9})
+
+
+def test_get_put_and_persistence(tmp_path):
+    path = str(tmp_path / "generations.sqlite")
+    cache = GenerationCache(path)
+    assert cache.get("k") is None
+    cache.put("k", "Paris")
+    assert cache.get("k") == "Paris"
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    cache.close()
+
+    reopened = GenerationCache(path)
+    assert reopened.get("k") == "Paris"
+    reopened.close()
+
+
+def test_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = itertools.count()
+    monkeypatch.setattr(generation_cache.time, "time", lambda: float(next(clock)))
+    monkeypatch.setattr(GenerationCache, "EVICT_EVERY", 1)
+
+    cache = GenerationCache(str(tmp_path / "generations.sqlite"), max_entries=100)
+    for i in range(100):
+        cache.put(f"k{i}", str(i))
+    # Touch the oldest entry so it is no longer the least recently used
+    assert cache.get("k0") == "0"
+
+    cache.put("k100", "100")
+
+    # One insert over the limit evicts the 2 (1 + 1%) least recently used
+    assert len(cache) == 99
+    assert cache.get("k0") == "0"
+    assert cache.get("k1") is None and cache.get("k2") is None
+    assert cache.get("k3") == "3" and cache.get("k100") == "100"
+    cache.close()
@@ -0,0 +1,239 @@
+import pytest
+import torch
+from PIL import Image
+from src.generator import Generator, _AnswerEndCriteria, answer_end
+
+
+@pytest.mark.parametrize("text, end", [
+    ("Paris", None),
+    ("Paris\nThe city", 5),
+    ("Paris. It is the capital", 5),
+    ("Paris.", None),  # may still continue ("Paris.com")
+    ("\nParis\n", 6),
+    ("St. Louis. Missouri", 9),
+    ("U.S. Army. More", 9),
+    ("J. K. Rowling\nwrote it", 13),
+    ("(Dr. No) is a film. x", 18),
+    ('"Mr. Smith". Next', 11),
+])
+def test_answer_end(text, end):
+    assert answer_end(text) == end
+
+
+class CharTokenizer:
+    """
+    One token per character; 0 is padding.
+    """
+
+    def batch_decode(self, ids, skip_special_tokens=True):
+        return ["".join(chr(int(c)) for c in row if int(c)) for row in ids]
+
+
+def encode(texts, prompt_length):
+    width = max(map(len, texts))
+    rows = [[ord("P")] * prompt_length + [ord(c) for c in t] + [0] * (width - len(t))
+            for t in texts]
+    return torch.tensor(rows)
+
+
+def test_criteria_marks_rows_done_when_their_answer_ends():
+    texts = ["Dr. Who is a show. More text follows here", "Paris\nmore", "no end at all"]
+    input_ids = encode(texts, prompt_length=4)
+    criteria = _AnswerEndCriteria(CharTokenizer(), prompt_length=4)
+
+    done_at = [None] * len(texts)
+    for step in range(1, input_ids.shape[1] - 4 + 1):
+        done = criteria(input_ids[:, :4 + step], None)
+        for row, is_done in enumerate(done.tolist()):
+            if is_done and done_at[row] is None:
+                done_at[row] = step
+
+    # Done once the character after the end is generated, and stays done
+    # even when the end has left the decoded window
+    assert done_at == [19, 6, None]
+    assert criteria.done.tolist() == [True, True, False]
+
+
+class PieceTokenizer:
+    """
+    Tokens are multi-character pieces; 0 is padding.
+    """
+
+    def __init__(self, pieces):
+        self.pieces = [None] + pieces
+
+    def batch_decode(self, ids, skip_special_tokens=True):
+        return ["".join(self.pieces[int(i)] for i in row if int(i)) for row in ids]
+
+
+def test_criteria_ignores_ends_seen_through_a_cut_word():
+    pieces = ["P", "Acme", " L", "td", ".", " Holdings", " Paris", "\n"]
+    tokenizer = PieceTokenizer(pieces)
+    criteria = _AnswerEndCriteria(tokenizer, prompt_length=2)
+    criteria.WINDOW = 3
+
+    def ids(*tokens):
+        return torch.tensor([[pieces.index(t) + 1 for t in ("P", "P") + tokens]])
+
+    # The window decodes to "td. Holdings", but the answer is "Acme Ltd. Holdings"
+    assert criteria(ids("Acme", " L", "td", ".", " Holdings"), None).tolist() == [False]
+    assert criteria(ids("Acme", " L", "td", ".", " Holdings", "\n", " Paris"), None).tolist() == [True]
+
+
+# Tiny random LLaVA on CPU, as in src/benchmark.py
+
+IMAGE_SIZE = 32
+PATCH_SIZE = 8
+HIDDEN_SIZE = 32
+
+
+class TinyGenerator(Generator):
+    """
+    Generator over a tiny random LLaVA with a byte-level tokenizer. EOS is
+    disabled so every call generates max_new_tokens tokens.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__("tiny/llava", device="cpu", dtype=torch.float32, **kwargs)
+
+    def _load_model(self):
+        from tokenizers import Tokenizer, models, pre_tokenizers, decoders, processors
+        from transformers import (
+            CLIPImageProcessor,
+            CLIPVisionConfig,
+            LlamaConfig,
+            LlavaConfig,
+            LlavaForConditionalGeneration,
+            LlavaProcessor,
+            PreTrainedTokenizerFast,
+        )
+        from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+        chars = ["<s>", "</s>", "<pad>"] + list(bytes_to_unicode().values())
+        backend = Tokenizer(models.BPE(vocab={c: i for i, c in enumerate(chars)}, merges=[]))
+        backend.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        backend.decoder = decoders.ByteLevel()
+        backend.post_processor = processors.TemplateProcessing(
+            single="<s> $A", special_tokens=[("<s>", 0)]
+        )
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=backend, bos_token="<s>", eos_token="</s>", pad_token="<pad>"
+        )
+        tokenizer.model_input_names = ["input_ids", "attention_mask"]
+        tokenizer.add_special_tokens({"additional_special_tokens": ["<image>"]})
+
+        image_processor = CLIPImageProcessor(
+            size={"shortest_edge": IMAGE_SIZE},
+            crop_size={"height": IMAGE_SIZE, "width": IMAGE_SIZE}
+        )
+        self.processor = LlavaProcessor(
+            image_processor=image_processor,
+            tokenizer=tokenizer,
+            patch_size=PATCH_SIZE,
+            vision_feature_select_strategy="default",
+            num_additional_image_tokens=1
+        )
+
+        config = LlavaConfig(
+            vision_config=CLIPVisionConfig(
+                hidden_size=HIDDEN_SIZE,
+                intermediate_size=HIDDEN_SIZE * 2,
+                num_hidden_layers=1,
+                num_attention_heads=2,
+                image_size=IMAGE_SIZE,
+                patch_size=PATCH_SIZE
+            ),
+            text_config=LlamaConfig(
+                hidden_size=HIDDEN_SIZE,
+                intermediate_size=HIDDEN_SIZE * 2,
+                num_hidden_layers=2,
+                num_attention_heads=2,
+                num_key_value_heads=2,
+                vocab_size=len(tokenizer),
+                bos_token_id=tokenizer.bos_token_id,
+                pad_token_id=tokenizer.pad_token_id
+            ),
+            image_token_index=tokenizer.convert_tokens_to_ids("<image>")
+        )
+        torch.manual_seed(0)
+        self.model = LlavaForConditionalGeneration(config).eval()
+        self.model.generation_config.pad_token_id = tokenizer.pad_token_id
+        self.model.generation_config.eos_token_id = None
+
+
+PREFIX = "USER: <image><image>\nUse the following information.\n\n"
+
+
+def tiny_images(seed, n=2):
+    g = torch.Generator().manual_seed(seed)
+    return [
+        Image.fromarray(torch.randint(0, 256, (40, 48, 3), generator=g, dtype=torch.uint8).numpy())
+        for _ in range(n)
+    ]
+
+
+def prefix_lookups(generator):
+    """
+    Record the cache every _prefix_kv call returned (None when unused).
+    """
+    results = []
+    prefix_kv = generator._prefix_kv
+
+    def spy(*args):
+        cache, length = prefix_kv(*args)
+        results.append(cache)
+        return cache, length
+
+    generator._prefix_kv = spy
+    return results
+
+
+def test_prefix_cache_matches_uncached_generation():
+    plain = TinyGenerator()
+    cached = TinyGenerator(prefix_cache_size=2)
+    lookups = prefix_lookups(cached)
+    images, image_ids = tiny_images(0), ["a", "b"]
+
+    for question in ("- caption one\nQuestion: who?", "- caption two\nQuestion: where?"):
+        expected = plain.generate(PREFIX + question, images, max_new_tokens=6, image_ids=image_ids)
+        output = cached.generate(
+            PREFIX + question, images, max_new_tokens=6, image_ids=image_ids, prefix=PREFIX
+        )
+        assert output == expected
+
+    # Computed by the first call and reused by the second
+    assert lookups[0] is not None and lookups[1] is lookups[0]
+    assert len(cached._prefix_cache) == 1
+
+    # Cropped back to the prefix after each call
+    prefix_ids, cache = cached._prefix_cache[(PREFIX, ("a", "b"))]
+    assert cache.get_seq_length() == prefix_ids.shape[1]
+
+
+def test_prefix_cache_is_keyed_by_image_ids_and_evicts_lru():
+    generator = TinyGenerator(prefix_cache_size=1)
+    prompt = PREFIX + "Question: what?"
+
+    generator.generate(prompt, tiny_images(0), max_new_tokens=2, image_ids=["a", "b"], prefix=PREFIX)
+    generator.generate(prompt, tiny_images(1), max_new_tokens=2, image_ids=["c", "d"], prefix=PREFIX)
+
+    assert list(generator._prefix_cache) == [(PREFIX, ("c", "d"))]
+
+
+def test_prefix_cache_misses():
+    plain = TinyGenerator()
+    generator = TinyGenerator(prefix_cache_size=2)
+    lookups = prefix_lookups(generator)
+    images = tiny_images(0)
+
+    # The prompt doesn't start with the prefix, or is nothing but the prefix
+    for prompt in ("USER: <image><image>\nOther text.", PREFIX):
+        output = generator.generate(
+            prompt, images, max_new_tokens=4, image_ids=["a", "b"], prefix=PREFIX
+        )
+        assert output == plain.generate(prompt, images, max_new_tokens=4, image_ids=["a", "b"])
+
+    # Images without doc ids can't be keyed
+    generator.generate(PREFIX + "Question: what?", images, max_new_tokens=2, prefix=PREFIX)
+
+    assert lookups == [None, None, None]
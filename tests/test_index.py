@@ -0,0 +1,123 @@
+import gzip
+import json
+import numpy as np
+import torch
+from PIL import Image
+from src.index import CorpusIndex, IVFIndex
+
+
+def random_unit_vectors(rng, n, dim):
+    vectors = rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def brute_force_ids(vectors, ids, query, k):
+    scores = vectors.astype(np.float16).astype(np.float32) @ query
+    return [ids[i] for i in np.argsort(-scores)[:k]]
+
+
+def recall_at_k(index, vectors, ids, queries, k, nprobe):
+    _, found = index.search(queries, k, nprobe=nprobe)
+    hits = sum(
+        len(set(f) & set(brute_force_ids(vectors, ids, q, k)))
+        for f, q in zip(found, queries)
+    )
+    return hits / (k * len(queries))
+
+
+def build_index(n=2000, dim=32, nlist=32, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = random_unit_vectors(rng, n, dim)
+    ids = [f"doc{i}" for i in range(n)]
+    index = IVFIndex(dim, nlist=nlist, nprobe=4).train(vectors, iters=10)
+    index.add(ids, vectors)
+    queries = random_unit_vectors(rng, 50, dim)
+    return index, vectors, ids, queries
+
+
+def test_probing_every_list_matches_brute_force():
+    index, vectors, ids, queries = build_index()
+    assert recall_at_k(index, vectors, ids, queries, k=10, nprobe=index.nlist) == 1.0
+
+
+def test_recall_grows_with_nprobe():
+    index, vectors, ids, queries = build_index()
+    low = recall_at_k(index, vectors, ids, queries, k=10, nprobe=1)
+    high = recall_at_k(index, vectors, ids, queries, k=10, nprobe=16)
+    assert low < high
+    assert high > 0.8
+
+
+def test_search_returns_best_first():
+    index, _, _, queries = build_index()
+    scores, ids = index.search(queries[:5], k=10)
+    for row_scores, row_ids in zip(scores, ids):
+        assert len(row_ids) == 10
+        assert row_scores == sorted(row_scores, reverse=True)
+
+
+def test_incremental_add_is_searchable():
+    index, _, _, _ = build_index()
+    new = np.zeros((1, index.dim), dtype=np.float32)
+    new[0, 0] = 1.0
+    index.add(["poison"], new)
+
+    _, ids = index.search(new, k=1, nprobe=index.nlist)
+    assert ids[0] == ["poison"]
+
+
+def test_save_load_round_trip(tmp_path):
+    index, _, _, queries = build_index(n=500, nlist=8)
+    index.save(str(tmp_path))
+    loaded = IVFIndex.load(str(tmp_path))
+
+    assert len(loaded) == len(index)
+    assert loaded.search(queries, k=5) == index.search(queries, k=5)
+
+
+class FakeStore:
+    def __init__(self, ids, dim):
+        self.id_to_row = {doc_id: row for row, doc_id in enumerate(ids)}
+        self.embeddings = np.ones((len(ids), dim), dtype=np.float16)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.id_to_row
+
+
+class FakeRetriever:
+    dim = 4
+
+    def __init__(self):
+        self.encoded_images = 0
+
+    def encode_text(self, texts):
+        return torch.ones((len(texts), self.dim))
+
+    def encode_images(self, images):
+        self.encoded_images += len(images)
+        return torch.ones((len(images), self.dim))
+
+
+def test_corpus_index_encodes_images_missing_from_the_store(tmp_path):
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    corpus = [{"id": f"img{i}", "path": f"img{i}.png", "title": f"title {i}"} for i in range(6)]
+    for ex in corpus:
+        Image.new("RGB", (4, 4)).save(image_dir / ex["path"])
+    with gzip.open(tmp_path / "MMQA_images.jsonl.gz", "wt") as f:
+        for ex in corpus:
+            f.write(json.dumps(ex) + "\n")
+
+    # The store only covers the images in the test metadata
+    metadata = {"img0": {"path": "img0.png", "caption": "a tower"},
+                "img1": {"path": "img1.png", "caption": "a river"}}
+    retriever = FakeRetriever()
+
+    index = CorpusIndex.build(
+        retriever, str(tmp_path / "MMQA_images.jsonl.gz"), metadata, str(image_dir),
+        embedding_store=FakeStore(["img0", "img1"], FakeRetriever.dim), nlist=2
+    )
+
+    assert retriever.encoded_images == 4
+    assert sorted(index.image_index.ids) == [f"img{i}" for i in range(6)]
+    assert index.captions["img0"] == "a tower" and index.captions["img5"] == "title 5"
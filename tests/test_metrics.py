@@ -0,0 +1,148 @@
+import re
+import json
+from src.metrics import RunMetrics, count, span
+
+
+def test_question_records_and_run_totals():
+    metrics = RunMetrics()
+
+    with metrics.question() as first:
+        metrics.add_time("retrieve", 0.5)
+        metrics.add_time("generate", 2.0)
+        metrics.count("tokens_generated", 10)
+    with metrics.question() as second:
+        metrics.add_time("generate", 1.0)
+        count(metrics, "tokens_generated", 2)
+    metrics.add_time("image_load", 0.25)
+
+    assert dict(first["stages"]) == {"retrieve": 0.5, "generate": 2.0}
+    assert first["tokens_per_sec"] == 5.0
+    assert second["tokens_per_sec"] == 2.0
+    assert first["peak_memory_bytes"] > 0
+
+    summary = metrics.summary()
+    assert summary["questions"] == 2
+    assert summary["counters"] == {"tokens_generated": 12}
+    assert summary["tokens_per_sec"] == 4.0
+    assert summary["stages"]["generate"]["seconds"] == 3.0
+    assert summary["stages"]["generate"]["calls"] == 2
+    assert summary["stages"]["generate"]["mean_ms"] == 1500.0
+    assert summary["stages"]["image_load"]["calls"] == 1
+    assert list(summary["stages"]) == ["generate", "image_load", "retrieve"]
+
+
+def test_resumed_question_is_counted_once():
+    metrics = RunMetrics()
+    with metrics.question() as record:
+        metrics.add_time("retrieve", 1.0)
+    with metrics.question(record):
+        metrics.add_time("generate", 1.0)
+
+    assert metrics.questions == 1
+    assert dict(record["stages"]) == {"retrieve": 1.0, "generate": 1.0}
+
+
+def test_batch_work_is_shared_evenly():
+    metrics = RunMetrics()
+    records = []
+    for _ in range(4):
+        with metrics.question() as record:
+            metrics.add_time("retrieve", 0.1)
+        records.append(record)
+
+    with metrics.batch() as batch:
+        metrics.add_time("generate", 2.0)
+        metrics.count("tokens_generated", 40)
+    metrics.share(batch, records)
+
+    assert metrics.questions == 4
+    for record in records:
+        assert record["stages"]["generate"] == 0.5
+        assert record["counters"]["tokens_generated"] == 10
+        assert record["tokens_per_sec"] == 20.0
+    assert RunMetrics.to_dict(records[0])["counters"] == {"tokens_generated": 10}
+
+
+def test_span_times_stages_and_is_a_no_op_without_metrics():
+    metrics = RunMetrics()
+    with span(metrics, "scoring"):
+        pass
+    with span(None, "scoring"):
+        pass
+    count(None, "tokens_generated")
+
+    assert metrics.stage_calls["scoring"] == 1
+    assert metrics.stage_seconds["scoring"] >= 0
+
+
+def test_write_json(tmp_path):
+    metrics = RunMetrics()
+    metrics.add_time("generate", 1.0)
+    path = tmp_path / "out" / "run.metrics.json"
+
+    metrics.write_json(str(path))
+
+    assert json.loads(path.read_text())["stages"]["generate"]["seconds"] == 1.0
+    assert not (tmp_path / "out" / "run.metrics.json.tmp").exists()
+
+
+LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def parse_prometheus(text):
+    """
+    ({metric name: {sorted (label, raw value) pairs: value}}, {name: type}).
+    """
+    samples, types = {}, {}
+    for line in text.splitlines():
+        if line.startswith("# TYPE"):
+            _, _, name, kind = line.split()
+            types[name] = kind
+        elif line and not line.startswith("#"):
+            series, value = line.rsplit(" ", 1)
+            name, _, labels = series.partition("{")
+            key = tuple(sorted(LABEL_RE.findall(labels)))
+            samples.setdefault(name, {})[key] = float(value)
+    return samples, types
+
+
+def test_write_prometheus(tmp_path):
+    metrics = RunMetrics()
+    with metrics.question():
+        metrics.add_time("generate", 2.0)
+        metrics.count("tokens_generated", 8)
+        metrics.count("prefix_cache_hits")
+    path = tmp_path / "run.prom"
+
+    metrics.write_prometheus(str(path), labels={"run": 'mmqa "poisoned"', "shard": 0})
+    text = path.read_text()
+    samples, types = parse_prometheus(text)
+
+    assert text.endswith("\n")
+    assert set(types) == set(samples)
+    assert types["rag_questions_total"] == "counter"
+    assert types["rag_tokens_per_second"] == "gauge"
+
+    # Label values are escaped; every sample carries the run labels
+    run = (("run", 'mmqa \\"poisoned\\"'), ("shard", "0"))
+
+    def key(*extra):
+        return tuple(sorted(run + extra))
+
+    assert samples["rag_questions_total"] == {key(): 1}
+    assert samples["rag_stage_seconds_total"] == {key(("stage", "generate")): 2.0}
+    assert samples["rag_stage_calls_total"] == {key(("stage", "generate")): 1}
+    assert samples["rag_events_total"] == {
+        key(("name", "prefix_cache_hits")): 1,
+        key(("name", "tokens_generated")): 8,
+    }
+    assert samples["rag_tokens_per_second"] == {key(): 4.0}
+
+
+def test_write_prometheus_without_labels(tmp_path):
+    path = tmp_path / "run.prom"
+    RunMetrics().write_prometheus(str(path))
+
+    text = path.read_text()
+    assert "rag_questions_total 0\n" in text
+    assert "{" not in text
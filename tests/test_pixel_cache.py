@@ -0,0 +1,37 @@
+import torch
+from src.pixel_cache import PixelValueCache
+
+
+def test_writers_sharing_a_directory_keep_their_entries(tmp_path):
+    # Two shard processes filling the same cache directory
+    first = PixelValueCache(str(tmp_path), "clip")
+    second = PixelValueCache(str(tmp_path), "clip")
+
+    first.put(["a", "b"], torch.full((2, 3, 2, 2), 1.0))
+    second.put(["c"], torch.full((1, 3, 2, 2), 2.0))
+    first.flush()
+    second.flush()
+
+    cache = PixelValueCache(str(tmp_path), "clip")
+    assert len(cache) == 3
+    assert (cache.get("a") == 1.0).all()
+    assert (cache.get("b") == 1.0).all()
+    assert (cache.get("c") == 2.0).all()
+
+
+def test_get_or_compute_only_computes_misses(tmp_path):
+    cache = PixelValueCache(str(tmp_path), "clip", shard_size=1)
+    cache.put(["a"], torch.zeros(1, 3, 2, 2))
+
+    computed = []
+
+    def compute(images):
+        computed.extend(images)
+        return torch.ones(len(images), 3, 2, 2)
+
+    pixel_values = cache.get_or_compute(["a", "b"], ["img_a", "img_b"], compute)
+
+    assert computed == ["img_b"]
+    assert pixel_values.shape == (2, 3, 2, 2)
+    assert (pixel_values[0] == 0).all() and (pixel_values[1] == 1).all()
+    assert "b" in PixelValueCache(str(tmp_path), "clip")
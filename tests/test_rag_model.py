@@ -0,0 +1,96 @@
+import zlib
+import torch
+from src.rag_model import RAGModel
+
+
+class FakeRetriever:
+    """
+    Deterministic pseudo-random unit embeddings per text / image, and
+    counts of what was encoded.
+    """
+
+    device = "cpu"
+
+    def __init__(self, dim=16):
+        self.dim = dim
+        self.encoded_texts = []
+        self.encoded_images = []
+
+    def _embed(self, key):
+        g = torch.Generator().manual_seed(zlib.crc32(key.encode("utf-8")))
+        v = torch.randn(self.dim, generator=g)
+        return v / v.norm()
+
+    def encode_text(self, texts):
+        self.encoded_texts.extend(texts)
+        return torch.stack([self._embed("text:" + t) for t in texts])
+
+    def encode_images(self, images, image_ids=None):
+        self.encoded_images.extend(images)
+        return torch.stack([self._embed("image:" + i) for i in images])
+
+    def score_texts(self, query_embs, text_embs):
+        return query_embs @ text_embs.T
+
+    def score_images(self, query_embs, image_embs):
+        return query_embs @ image_embs.T
+
+
+def example(question, image_ids, texts):
+    return {"question": question, "images": list(image_ids), "image_ids": list(image_ids),
+            "texts": list(texts)}
+
+
+EXAMPLES = [
+    example("who built the tower?", ["i1", "i2", "i3", "i4"], ["c1", "c2", "c3", "poison"]),
+    example("where is the river?", ["i3", "i5", "i6"], ["c3", "c5", "c6", "c7", "c8"]),
+    example("what color is the car?", ["i7", "i1", "i8", "i2", "i9"], ["c1", "c9", "c10"]),
+]
+
+
+def test_retrieve_batch_matches_retrieve():
+    rag = RAGModel(FakeRetriever(), None, top_k_images=3, top_k_texts=3)
+
+    batched = rag.retrieve_batch(EXAMPLES)
+    for ex, (top_images, top_texts, image_scores, text_scores) in zip(EXAMPLES, batched):
+        single = rag.retrieve(ex["question"], ex["images"], ex["texts"], image_ids=ex["image_ids"])
+
+        assert top_images == single[0]
+        assert top_texts == single[1]
+        torch.testing.assert_close(image_scores, single[2])
+        torch.testing.assert_close(text_scores, single[3])
+
+
+def test_retrieve_batch_encodes_shared_candidates_once():
+    retriever = FakeRetriever()
+    RAGModel(retriever, None).retrieve_batch(EXAMPLES)
+
+    assert sorted(retriever.encoded_images) == sorted({i for ex in EXAMPLES for i in ex["images"]})
+    texts = [t for t in retriever.encoded_texts if not t.endswith("?")]
+    assert sorted(texts) == sorted({t for ex in EXAMPLES for t in ex["texts"]})
+
+
+def test_masked_topk_clips_k_to_each_pool():
+    scores = torch.tensor([[0.1, 0.9, 0.5, 0.7], [0.8, 0.2, 0.6, 0.4]])
+    rows = [[3, 1], [0, 1, 2, 3]]
+
+    (top_a, pool_a), (top_b, pool_b) = RAGModel._masked_topk(scores, rows, k=3)
+
+    assert top_a == [1, 0]
+    torch.testing.assert_close(pool_a, scores[0, [3, 1]])
+    assert top_b == [0, 2, 3]
+    torch.testing.assert_close(pool_b, scores[1])
+
+
+def test_retrieve_clamps_k_to_small_pools():
+    rag = RAGModel(FakeRetriever(), None, top_k_images=3, top_k_texts=3)
+    ex = example("who built the tower?", ["i1", "i2"], ["c1"])
+
+    top_images, top_texts, image_scores, _ = rag.retrieve(
+        ex["question"], ex["images"], ex["texts"], image_ids=ex["image_ids"]
+    )
+
+    assert sorted(top_images) == [0, 1]
+    assert top_texts == [0]
+    assert top_images == image_scores.argsort(descending=True).tolist()
+    assert (top_images, top_texts) == rag.retrieve_batch([ex])[0][:2]
@@ -0,0 +1,80 @@
+import json
+import numpy as np
+import pytest
+from src.eval_rag import SCORED_COLUMNS, load_results
+from src.results_table import ResultsTable, columnar_path, write_results
+
+
+RECORDS = [
+    {
+        "qid": "a",
+        "model_answer": "Paris",
+        "gold_answers": [{"answer": "Paris", "type": "string"}],
+        "retrieved_captions": ["a tower", "a river"],
+        "text_scores": [0.31, 0.27],
+        "poison_injected": True,
+        "poison_caption": "scholarships moved",
+    },
+    {
+        "qid": "b",
+        "model_answer": "Rome",
+        "gold_answers": [{"answer": "Rome"}],
+        "retrieved_captions": [],
+        "text_scores": [0.5],
+        "poison_injected": False,
+        "poison_caption": None,
+    },
+    # Error records only have a few keys
+    {"qid": "c", "error": "CUDA out of memory"},
+]
+
+
+@pytest.fixture(params=[False, True], ids=["plain", "compressed"])
+def table(tmp_path, request):
+    path = str(tmp_path / "run.npz")
+    assert write_results(path, RECORDS, compress=request.param) == 3
+    table = ResultsTable(path)
+    yield table
+    table.close()
+
+
+def without_scores(record):
+    return {k: v for k, v in record.items() if k != "text_scores"}
+
+
+def test_round_trip(table):
+    records = list(table.records())
+
+    assert [without_scores(r) for r in records] == [
+        without_scores({k: v for k, v in r.items() if v is not None}) for r in RECORDS
+    ]
+    # Scores are stored as float16
+    for got, expected in zip(records, RECORDS):
+        if "text_scores" in expected:
+            np.testing.assert_allclose(got["text_scores"], expected["text_scores"], atol=1e-3)
+
+
+def test_column_selection(table):
+    assert table.columns[0] == "qid" and len(table) == 3
+    assert table.column("poison_injected") == [True, False, None]
+    assert list(table.records(["qid", "error", "not_a_column"])) == [
+        {"qid": "a"}, {"qid": "b"}, {"qid": "c", "error": "CUDA out of memory"}
+    ]
+
+    values, offsets = table.scores("text_scores")
+    assert values.dtype == np.float16 and offsets.tolist() == [0, 2, 3, 3]
+    with pytest.raises(ValueError):
+        table.scores("qid")
+
+
+def test_eval_reads_columnar_like_jsonl(tmp_path):
+    jsonl = tmp_path / "run.jsonl"
+    jsonl.write_text("".join(json.dumps(r) + "\n" for r in RECORDS))
+    npz = columnar_path(str(jsonl))
+    assert npz == str(tmp_path / "run.npz")
+    write_results(npz, RECORDS)
+
+    def scored(record):
+        return {k: v for k, v in record.items() if k in SCORED_COLUMNS and v is not None}
+
+    assert list(load_results(npz)) == [scored(r) for r in load_results(str(jsonl))]
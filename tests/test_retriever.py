@@ -0,0 +1,152 @@
+import json
+import pytest
+import torch
+from PIL import Image
+from src.retriever import Retriever
+from src.check_cpu_retriever import ranking_agreement
+
+
+# Tiny random CLIP on CPU, as in src/benchmark.py
+
+IMAGE_SIZE = 32
+HIDDEN_SIZE = 64
+
+WORDS = "the a red blue dog cat horse car river city tower bridge flag team player".split()
+
+
+def write_clip_tokenizer(directory):
+    """
+    Byte-level CLIP vocabulary with no merges.
+    """
+    from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+    chars = list(bytes_to_unicode().values())
+    vocab = {}
+    for suffix in ("", "</w>"):
+        for c in chars:
+            vocab[c + suffix] = len(vocab)
+    vocab["<|startoftext|>"] = len(vocab)
+    vocab["<|endoftext|>"] = len(vocab)
+
+    with open(directory / "vocab.json", "w") as f:
+        json.dump(vocab, f)
+    with open(directory / "merges.txt", "w") as f:
+        f.write("#version: 0.2\n")
+    return str(directory)
+
+
+class TinyRetriever(Retriever):
+    """
+    Retriever over a tiny random CLIP.
+    """
+
+    def __init__(self, tokenizer_dir, **kwargs):
+        self.tokenizer_dir = tokenizer_dir
+        super().__init__("tiny/clip", device="cpu", **kwargs)
+
+    def _load_model(self):
+        from transformers import (
+            CLIPConfig,
+            CLIPImageProcessor,
+            CLIPModel,
+            CLIPProcessor,
+            CLIPTokenizerFast,
+        )
+
+        tokenizer = CLIPTokenizerFast.from_pretrained(self.tokenizer_dir, model_max_length=77)
+        self.processor = CLIPProcessor(
+            image_processor=CLIPImageProcessor(
+                size={"shortest_edge": IMAGE_SIZE},
+                crop_size={"height": IMAGE_SIZE, "width": IMAGE_SIZE}
+            ),
+            tokenizer=tokenizer
+        )
+
+        layer = dict(
+            hidden_size=HIDDEN_SIZE,
+            intermediate_size=HIDDEN_SIZE * 2,
+            num_hidden_layers=2,
+            num_attention_heads=2
+        )
+        config = CLIPConfig(
+            text_config=dict(
+                **layer,
+                vocab_size=len(tokenizer),
+                max_position_embeddings=77,
+                bos_token_id=tokenizer.bos_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                pad_token_id=tokenizer.pad_token_id
+            ),
+            vision_config=dict(**layer, image_size=IMAGE_SIZE, patch_size=8),
+            projection_dim=32
+        )
+        torch.manual_seed(0)
+        self.model = CLIPModel(config).eval()
+
+
+@pytest.fixture(scope="module")
+def tokenizer_dir(tmp_path_factory):
+    return write_clip_tokenizer(tmp_path_factory.mktemp("clip_tokenizer"))
+
+
+def sentences(n, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return [
+        " ".join(WORDS[i] for i in torch.randint(0, len(WORDS), (int(k),), generator=g))
+        for k in torch.randint(3, 12, (n,), generator=g)
+    ]
+
+
+def images(n, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    return [
+        Image.fromarray(torch.randint(0, 256, (40, 48, 3), generator=g, dtype=torch.uint8).numpy())
+        for _ in range(n)
+    ]
+
+
+def rankings(retriever, queries, texts, pool):
+    query_embs = retriever.encode_text(queries)
+    text_scores = retriever.score_texts(query_embs, retriever.encode_text(texts))
+    image_scores = retriever.score_images(query_embs, retriever.encode_images(pool))
+    return text_scores, image_scores
+
+
+@pytest.mark.parametrize("backend", ["int8", "torchscript"])
+def test_cpu_backends_rank_like_torch(tokenizer_dir, backend):
+    queries, texts, pool = sentences(8, seed=1), sentences(24), images(12)
+
+    reference = rankings(TinyRetriever(tokenizer_dir), queries, texts, pool)
+    scores = rankings(TinyRetriever(tokenizer_dir, backend=backend), queries, texts, pool)
+
+    for expected, actual in zip(reference, scores):
+        assert actual.dtype == torch.float32
+        agreement = [ranking_agreement(e, a, k=3) for e, a in zip(expected, actual)]
+        assert sum(top1 for top1, _, _ in agreement) >= 0.75 * len(queries)
+        assert sum(overlap for _, overlap, _ in agreement) >= 0.75 * len(queries)
+
+        # Anything the backend ranks in the top-3 is within its score error
+        # of the reference top-3 (a random tiny model has many near ties)
+        error = max(diff for _, _, diff in agreement)
+        assert error < 0.1
+        for e, a in zip(expected, actual):
+            kth = e.topk(3).values[-1]
+            assert (e[a.topk(3).indices] >= kth - 2 * error).all()
+
+
+def test_torchscript_handles_new_batch_shapes(tokenizer_dir):
+    int8 = TinyRetriever(tokenizer_dir, backend="int8")
+    traced = TinyRetriever(tokenizer_dir, backend="torchscript", batch_size=4)
+
+    # Traced on the first batch; later batches differ in size and length
+    for texts in (sentences(4), sentences(3, seed=2), ["a much longer " + " ".join(WORDS)]):
+        torch.testing.assert_close(traced.encode_text(texts), int8.encode_text(texts))
+    for pool in (images(4), images(1, seed=3)):
+        torch.testing.assert_close(traced.encode_images(pool), int8.encode_images(pool))
+
+
+def test_cpu_backends_run_on_cpu(tokenizer_dir):
+    assert TinyRetriever(tokenizer_dir, backend="int8").device == "cpu"
+
+    with pytest.raises(ValueError, match="Unknown backend"):
+        TinyRetriever(tokenizer_dir, backend="onnx")
@@ -0,0 +1,103 @@
+from src import run_rag
+from src.utils import JSONLWriter, read_jsonl, shard_path
+
+
+def test_merge_shards(tmp_path, monkeypatch):
+    output_file = str(tmp_path / "run.jsonl")
+    monkeypatch.setattr(run_rag, "output_file_path", lambda: output_file)
+    monkeypatch.setattr(run_rag, "WRITE_COLUMNAR", False)
+    monkeypatch.setattr(
+        run_rag, "load_examples",
+        lambda name: [{"qid": q} for q in ("a", "b", "c", "d")]
+    )
+
+    shards = [
+        [{"qid": "b", "model_answer": "2"}, {"qid": "a", "error": "oom"}],
+        [{"qid": "a", "model_answer": "1"}, {"qid": "c", "error": "oom"}],
+    ]
+    for shard_id, records in enumerate(shards):
+        with JSONLWriter(shard_path(output_file, shard_id, 2)) as writer:
+            for record in records:
+                writer.write(record)
+
+    run_rag.merge_shards(2)
+
+    # Dataset order, one record per qid, successes preferred over errors
+    assert list(read_jsonl(output_file)) == [
+        {"qid": "a", "model_answer": "1"},
+        {"qid": "b", "model_answer": "2"},
+        {"qid": "c", "error": "oom"},
+    ]
+
+
+def test_columnar_output_keeps_the_retried_record(tmp_path):
+    from src.results_table import ResultsTable
+
+    output_file = str(tmp_path / "run.jsonl")
+    with JSONLWriter(output_file) as writer:
+        writer.write({"qid": "a", "error": "oom"})
+        writer.write({"qid": "b", "model_answer": "2"})
+        writer.write({"qid": "a", "model_answer": "1"})
+
+    run_rag.write_columnar(output_file)
+
+    table = ResultsTable(str(tmp_path / "run.npz"))
+    assert list(table.records()) == [
+        {"qid": "b", "model_answer": "2"},
+        {"qid": "a", "model_answer": "1"},
+    ]
+    table.close()
+
+
+class _RecordingRAG:
+    metrics = None
+
+    def __init__(self):
+        self.examples = []
+
+    def generate_batch(self, examples, max_new_tokens=128, batch_size=8):
+        self.examples.extend(examples)
+        return [
+            {"answer": "x", "retrieved_image_indices": [0], "retrieved_text_indices": [0],
+             "image_scores": [1.0], "text_scores": [1.0]}
+            for _ in examples
+        ]
+
+
+def test_client_mode_pool_skips_missing_image_files(tmp_path, monkeypatch):
+    from PIL import Image
+
+    Image.new("RGB", (4, 4)).save(tmp_path / "a.png")
+    image_metadata = {
+        "a": {"path": "a.png", "caption": "caption a"},
+        "b": {"path": "b.png", "caption": "caption b"},
+    }
+    data = [{"qid": "q", "question": "?", "metadata": {"image_doc_ids": ["a", "b", "c"]}}]
+    monkeypatch.setattr(run_rag, "IMAGE_DIR", str(tmp_path))
+
+    pools = {}
+    for load_images in (True, False):
+        rag = _RecordingRAG()
+        list(run_rag.run_pool(rag, data, image_metadata, None, load_images=load_images))
+        pools[load_images] = [(ex["image_ids"], ex["texts"]) for ex in rag.examples]
+
+    # "b" has no file, so neither mode puts it or its caption in the pool
+    assert pools[False] == pools[True] == [(["a"], ["caption a"])]
+
+
+def test_missing_poisoned_metadata_falls_back_to_clean_captions(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_rag, "USE_POISONED_CAPTIONS", True)
+    monkeypatch.setattr(run_rag, "dataset_path", lambda name, key: str(tmp_path / key))
+
+    run_rag.fall_back_to_clean_captions()
+    assert run_rag.USE_POISONED_CAPTIONS is False
+    assert "clean_caption_baseline" in run_rag.output_file_path()
+
+
+def test_existing_poisoned_metadata_keeps_the_poisoned_run(tmp_path, monkeypatch):
+    (tmp_path / "poisoned_metadata").write_text("{}")
+    monkeypatch.setattr(run_rag, "USE_POISONED_CAPTIONS", True)
+    monkeypatch.setattr(run_rag, "dataset_path", lambda name, key: str(tmp_path / key))
+
+    run_rag.fall_back_to_clean_captions()
+    assert run_rag.USE_POISONED_CAPTIONS is True
@@ -0,0 +1,110 @@
+import math
+import torch
+import pytest
+from PIL import Image
+from src.select_poison import candidate_matrix, score_candidates, select_poison_captions
+
+
+# Unit vectors in a 3-d embedding space
+VECTORS = {
+    "query": [1.0, 0.0, 0.0],
+    "on query": [1.0, 0.0, 0.0],
+    "on image": [0.0, 1.0, 0.0],
+    "between": [math.sqrt(0.5), math.sqrt(0.5), 0.0],
+    "off": [0.0, 0.0, 1.0],
+    "red": [0.0, 1.0, 0.0],
+}
+
+
+class FakeRetriever:
+    """
+    Embeds texts from VECTORS and images from their solid colour.
+    """
+
+    def encode_text(self, texts):
+        return torch.tensor([VECTORS[t] for t in texts])
+
+    def encode_images(self, images, image_ids=None):
+        colours = {(255, 0, 0): "red"}
+        return torch.tensor([VECTORS[colours[img.getpixel((0, 0))]] for img in images])
+
+
+class FakeStore:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __contains__(self, doc_id):
+        return doc_id in self.rows
+
+    def gather(self, doc_ids):
+        return torch.tensor([self.rows[i] for i in doc_ids])
+
+
+def test_candidate_matrix_skips_images_without_candidates():
+    image_ids, texts, segment = candidate_matrix({
+        "a": {"poisoned_candidates": ["a1", "a2"]},
+        "b": {"poisoned_candidates": []},
+        "c": {"poisoned_candidates": ["c1"]},
+    })
+
+    assert image_ids == ["a", "c"]
+    assert texts == ["a1", "a2", "c1"]
+    assert segment.tolist() == [0, 0, 1]
+
+
+def test_score_candidates_matches_a_per_image_loop():
+    image_ids = ["a", "b"]
+    texts = ["on query", "on image", "between", "off", "on image"]
+    segment = torch.tensor([0, 0, 0, 1, 1])
+    image_embs = torch.tensor([VECTORS["red"], [0.0, 0.0, 0.0]])
+    available = torch.tensor([True, False])
+
+    scores = score_candidates(
+        FakeRetriever(), "query", image_ids, texts, segment,
+        image_embs, available, query_weight=0.5
+    )
+
+    query = [VECTORS[t][0] for t in texts]
+    image = [VECTORS[t][1] for t in texts]
+    expected = [0.5 * q + 0.5 * i for q, i in zip(query[:3], image[:3])] + query[3:]
+
+    assert torch.allclose(scores["combined"], torch.tensor(expected))
+    # "between" has the best mean for a; b has no image so only the query counts
+    assert scores["best"].tolist() == [2, 0]
+    assert scores["offsets"].tolist() == [0, 3]
+    assert scores["counts"].tolist() == [3, 2]
+    assert torch.isnan(scores["image"][3:]).all()
+
+
+def test_query_weight_one_ignores_the_image():
+    scores = score_candidates(
+        FakeRetriever(), "query", ["a"], ["on image", "on query"], torch.tensor([0, 0]),
+        torch.tensor([VECTORS["red"]]), torch.tensor([True]), query_weight=1.0
+    )
+    assert scores["best"].tolist() == [1]
+
+
+def test_select_poison_captions(tmp_path):
+    Image.new("RGB", (4, 4), (255, 0, 0)).save(tmp_path / "b.png")
+    poisoned_metadata = {
+        # Embedding from the store
+        "a": {"path": "missing.png", "poisoned_candidates": ["on query", "between"]},
+        # Encoded from disk
+        "b": {"path": "b.png", "poisoned_candidates": ["off", "between"]},
+        # No embedding at all
+        "c": {"path": "missing.png", "poisoned_candidates": ["off", "on image", "on query"]},
+        "d": {"path": "missing.png", "poisoned_candidates": []},
+    }
+    store = FakeStore({"a": VECTORS["red"]})
+
+    select_poison_captions(
+        FakeRetriever(), poisoned_metadata, "query", str(tmp_path), embedding_store=store
+    )
+
+    selected = {k: m.get("selected_candidate") for k, m in poisoned_metadata.items()}
+    assert selected == {"a": "between", "b": "between", "c": "on query", "d": None}
+    assert poisoned_metadata["c"]["selected_index"] == 2
+    assert poisoned_metadata["c"]["candidate_scores"]["image"] == [None, None, None]
+    assert poisoned_metadata["b"]["candidate_scores"]["query"] == pytest.approx(
+        [0.0, VECTORS["between"][0]]
+    )
@@ -0,0 +1,133 @@
+import time
+import threading
+import pytest
+from src.server import Batcher
+
+
+class FakeRAG:
+    metrics = None
+
+    def __init__(self):
+        self.calls = []
+
+    def generate(self, question, images, texts, max_new_tokens=128, image_ids=None,
+                 text_ids=None):
+        self.calls.append(("generate", [question]))
+        if question == "bad":
+            raise ValueError("bad example")
+        return {"answer": question.upper(), "max_new_tokens": max_new_tokens}
+
+    def generate_batch(self, examples, max_new_tokens=128, batch_size=8):
+        self.calls.append(("generate_batch", [ex["question"] for ex in examples]))
+        if any(ex["question"] == "bad" for ex in examples):
+            raise RuntimeError("batch failed")
+        return [
+            {"answer": ex["question"].upper(), "max_new_tokens": max_new_tokens}
+            for ex in examples
+        ]
+
+
+def example(question):
+    return {"question": question, "images": [], "texts": [], "image_ids": []}
+
+
+class HeldBatcher(Batcher):
+    """
+    Batcher whose worker waits until `release` is set, so a test can queue
+    requests before the first batch is collected.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.release = threading.Event()
+        super().__init__(*args, **kwargs)
+
+    def _collect(self):
+        self.release.wait()
+        return super()._collect()
+
+
+def test_requests_queued_together_share_a_batch():
+    rag = FakeRAG()
+    batcher = HeldBatcher(rag, max_batch_size=8, max_wait=0.05)
+
+    futures = [batcher.submit("generate", example(q), 16) for q in ("a", "b", "c")]
+    batcher.release.set()
+
+    assert [f.result(timeout=5)["answer"] for f in futures] == ["A", "B", "C"]
+    assert rag.calls == [("generate_batch", ["a", "b", "c"])]
+    assert batcher.stats()["batches"] == 1
+
+
+def test_batches_are_capped_at_max_batch_size():
+    rag = FakeRAG()
+    batcher = HeldBatcher(rag, max_batch_size=2, max_wait=0.05)
+
+    futures = [batcher.submit("generate", example(q), 16) for q in ("a", "b", "c")]
+    batcher.release.set()
+
+    assert [f.result(timeout=5)["answer"] for f in futures] == ["A", "B", "C"]
+    assert rag.calls == [("generate_batch", ["a", "b"]), ("generate", ["c"])]
+
+
+def test_batches_are_grouped_by_max_new_tokens():
+    rag = FakeRAG()
+    batcher = HeldBatcher(rag, max_batch_size=8, max_wait=0.05)
+
+    futures = [
+        batcher.submit("generate", example("a"), 16),
+        batcher.submit("generate", example("b"), 32),
+        batcher.submit("generate", example("c"), 16),
+    ]
+    batcher.release.set()
+
+    assert [f.result(timeout=5)["max_new_tokens"] for f in futures] == [16, 32, 16]
+    assert sorted(rag.calls) == [("generate", ["b"]), ("generate_batch", ["a", "c"])]
+
+
+def test_requests_after_the_deadline_go_in_the_next_batch():
+    rag = FakeRAG()
+    batcher = Batcher(rag, max_batch_size=8, max_wait=0.05)
+
+    first = batcher.submit("generate", example("a"), 16)
+    assert first.result(timeout=5)["answer"] == "A"
+
+    # The first request's deadline has passed, so it was sent alone
+    time.sleep(0.1)
+    second = batcher.submit("generate", example("b"), 16)
+    assert second.result(timeout=5)["answer"] == "B"
+
+    assert rag.calls == [("generate", ["a"]), ("generate", ["b"])]
+    assert batcher.stats()["batches"] == 2
+
+
+def test_collect_waits_for_requests_until_the_deadline():
+    batcher = HeldBatcher(FakeRAG(), max_batch_size=2, max_wait=2.0)
+
+    futures = [batcher.submit("generate", example("a"), 16)]
+    batcher.release.set()
+    time.sleep(0.1)
+    futures.append(batcher.submit("generate", example("b"), 16))
+
+    assert [f.result(timeout=5)["answer"] for f in futures] == ["A", "B"]
+    assert batcher.stats()["batches"] == 1
+
+
+def test_failed_batch_falls_back_to_per_request():
+    rag = FakeRAG()
+    batcher = HeldBatcher(rag, max_batch_size=8, max_wait=0.05)
+
+    futures = [batcher.submit("generate", example(q), 16) for q in ("a", "bad", "c")]
+    batcher.release.set()
+
+    assert futures[0].result(timeout=5)["answer"] == "A"
+    assert futures[2].result(timeout=5)["answer"] == "C"
+    # Only the bad example fails
+    with pytest.raises(ValueError, match="bad example"):
+        futures[1].result(timeout=5)
+
+    assert rag.calls == [
+        ("generate_batch", ["a", "bad", "c"]),
+        ("generate", ["a"]),
+        ("generate", ["bad"]),
+        ("generate", ["c"]),
+    ]
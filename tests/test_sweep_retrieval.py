@@ -0,0 +1,29 @@
+import numpy as np
+from src.sweep_retrieval import poison_variants, rank_against
+
+
+def test_rank_against_puts_ties_after_the_pool():
+    pool = np.array([0.1, 0.5, 0.3, 0.5])
+    ranks = rank_against(pool, np.array([0.6, 0.5, 0.3, 0.0, -np.inf]))
+    assert ranks.tolist() == [1, 3, 4, 5, 5]
+
+
+def test_rank_against_matches_sorting_the_pool():
+    rng = np.random.default_rng(0)
+    pool = rng.normal(size=50).astype(np.float32)
+    scores = rng.normal(size=20).astype(np.float32)
+
+    for score, rank in zip(scores, rank_against(pool, scores)):
+        assert rank == 1 + int((pool >= score).sum())
+
+
+def test_poison_variants_follow_the_first_poisoned_image():
+    poisoned = {
+        "img2": {"poisoned_candidates": ["p0", "p1"], "selected_candidate": "p1"},
+        "img3": {"poisoned_candidates": ["q0"]},
+    }
+    variants, image = poison_variants(["img1", "img2", "img3"], poisoned)
+
+    assert image == "img2"
+    assert variants == {"clean": None, "candidate_0": "p0", "candidate_1": "p1", "selected": "p1"}
+    assert poison_variants(["img1"], poisoned) == ({"clean": None}, None)
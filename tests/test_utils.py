@@ -0,0 +1,78 @@
+import json
+from src.utils import (
+    JSONLWriter,
+    latest_per_qid,
+    load_done_qids,
+    read_jsonl,
+    shard_of,
+    shard_path,
+)
+
+
+def test_writer_appends_across_runs(tmp_path):
+    path = str(tmp_path / "results" / "run.jsonl")
+
+    with JSONLWriter(path) as writer:
+        writer.write({"qid": "a"})
+    with JSONLWriter(path) as writer:
+        writer.write({"qid": "b"})
+
+    assert [r["qid"] for r in read_jsonl(path)] == ["a", "b"]
+
+
+def test_writer_drops_partial_last_line(tmp_path):
+    path = tmp_path / "run.jsonl"
+    path.write_text(json.dumps({"qid": "a"}) + "\n" + '{"qid": "b", "mod')
+
+    # A crashed run's last line is skipped when reading...
+    assert [r["qid"] for r in read_jsonl(str(path))] == ["a"]
+
+    # ... and cut off before new records are appended
+    with JSONLWriter(str(path)) as writer:
+        writer.write({"qid": "c"})
+    assert [r["qid"] for r in read_jsonl(str(path))] == ["a", "c"]
+
+
+def test_load_done_qids_missing_file(tmp_path):
+    assert load_done_qids(str(tmp_path / "none.jsonl")) == set()
+
+
+def test_load_done_qids_retries_errors(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    with JSONLWriter(path) as writer:
+        writer.write({"qid": "ok", "model_answer": "x"})
+        writer.write({"qid": "failed", "error": "CUDA out of memory"})
+        writer.write({"qid": "retried", "error": "timeout"})
+        writer.write({"qid": "retried", "model_answer": "y"})
+
+    assert load_done_qids(path) == {"ok", "retried"}
+
+
+def test_shard_of_is_deterministic_and_covers_all_shards():
+    qids = [f"q{i}" for i in range(400)]
+    shards = [shard_of(qid, 4) for qid in qids]
+
+    assert shards == [shard_of(qid, 4) for qid in qids]
+    assert set(shards) == {0, 1, 2, 3}
+    assert all(shard_of(qid, 1) == 0 for qid in qids)
+
+
+def test_shard_path():
+    assert shard_path("results/run.jsonl", 0, 1) == "results/run.jsonl"
+    assert shard_path("results/run.jsonl", 1, 4) == "results/run.shard1of4.jsonl"
+
+
+def test_latest_per_qid_keeps_retries():
+    records = [
+        {"qid": "a", "error": "oom"},
+        {"qid": "b", "model_answer": "x"},
+        {"model_answer": "no qid"},
+        {"qid": "a", "model_answer": "y"},
+        {"model_answer": "no qid either"},
+    ]
+    assert latest_per_qid(records) == [
+        {"qid": "b", "model_answer": "x"},
+        {"model_answer": "no qid"},
+        {"qid": "a", "model_answer": "y"},
+        {"model_answer": "no qid either"},
+    ]